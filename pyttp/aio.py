@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import io
+import itertools
+import socket
+import sys
+import time
+
+from pyttp import network
+from pyttp.core import *
+from pyttp.wsgi import CONTINUE_RESPONSE, DummyLogger, buildEnviron, requestInput
+
+
+def isAsyncApp(app):
+    """Async applications are coroutine functions taking (environ, start_response)."""
+    return inspect.iscoroutinefunction(app) or inspect.iscoroutinefunction(getattr(app, "__call__", None))
+
+
+class StreamBuffer(network.ReadBuffer):
+    """
+    ReadBuffer on an asyncio StreamReader.
+    The event loop fills it with fillAsync(). fill() is meant for the
+    threads running WSGI applications; it waits for the loop to receive
+    the next block, so SocketFileWrapper works on top of it unchanged.
+    A thread waiting longer than timeout seconds gets socket.timeout, so
+    a stalled client cannot hold it forever.
+    """
+
+    def __init__(self, reader, loop, sock = None, timeout = None):
+        network.ReadBuffer.__init__(self, sock)
+        self.reader = reader
+        self.loop = loop
+        self.timeout = timeout
+
+    async def fillAsync(self):
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+        data = await self.reader.read(self.blockSize)
+        self.buf += data
+        return len(data)
+
+    def fill(self):
+        future = asyncio.run_coroutine_threadsafe(self.fillAsync(), self.loop)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise socket.timeout("Request body not received in time")
+
+    def receiveInto(self, view):
+        # the socket belongs to the loop
+        self.fill()
+        return self.readInto(view)
+
+
+class ResponseFraming(object):
+    """
+    Turns status, headers and body of an application's response into
+    HTTP/1.1 messages, using the same rules as WSGIHandler: bodies of
+    known size are delimited by Content-Length, others are chunked (or
+    delimited by closing the connection for HTTP/1.0 clients).
+    """
+
+    def __init__(self, req, status, headers, connectionSetting):
+        try:
+            self.statusCode = int(status[:3])
+            statusString = status[3:].strip()
+        except Exception:
+            self.statusCode = 200
+            statusString = 'OK'
+        self.status = Status("HTTP/1.1", self.statusCode, statusString)
+        self.headers = [Header("Server", "PyTTP/0.0.1")]
+        self.contentLength = None
+        for name, value in headers or []:
+            if name.lower() == 'content-length':
+                try:
+                    self.contentLength = int(value)
+                except ValueError:
+                    pass
+                continue
+            self.headers.append(Header(name, value))
+        self.connectionSetting = connectionSetting
+        self.sendBody = (self.statusCode not in (204, 304) and self.statusCode >= 200
+                         and req.type.verb != "HEAD")
+        self.version = req.type.version
+        self.chunked = False
+        self.remaining = None
+
+    @property
+    def keepAlive(self):
+        return self.connectionSetting == "keep-alive"
+
+    def head(self, contentLength = None):
+        if contentLength is None:
+            contentLength = self.contentLength
+        headers = list(self.headers)
+        if self.statusCode in (204, 304) or self.statusCode < 200:
+            pass
+        elif contentLength is not None:
+            headers.append(Header("Content-Length", str(contentLength)))
+            self.remaining = contentLength
+        elif self.version == "1.1":
+            self.chunked = True
+            headers.append(Header("Transfer-Encoding", "chunked"))
+        else:
+            self.connectionSetting = "close"
+        headers.insert(1, Header("Connection", self.connectionSetting))
+        return str(Response(self.status, headers, "")).encode()
+
+    def complete(self, body):
+        """Head and body of a response whose body is known completely."""
+        if self.contentLength is not None:
+            body = body[:self.contentLength]
+            if len(body) < self.contentLength:
+                self.connectionSetting = "close"
+        head = self.head(len(body))
+        if self.sendBody:
+            return head + body
+        return head
+
+    def chunk(self, data):
+        if not self.sendBody or not data:
+            return b''
+        if self.chunked:
+            return b"%x\r\n%s\r\n" % (len(data), data)
+        if self.remaining is not None:
+            data = data[:self.remaining]
+            self.remaining -= len(data)
+        return data
+
+    def end(self):
+        if self.sendBody and self.chunked:
+            return b"0\r\n\r\n"
+        if self.remaining:
+            #application sent less than it announced
+            self.connectionSetting = "close"
+        return b''
+
+
+class AsyncConnection(object):
+    """
+    Serves the requests of one connection of an AsyncListener.
+    """
+
+    def __init__(self, listener, reader, writer):
+        self.listener = listener
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.addr = writer.get_extra_info("peername") or ('', 0)
+        self.buffer = StreamBuffer(reader, self.loop, writer.get_extra_info("socket"), listener.bodyTimeout)
+        if writer.get_extra_info("sslcontext") is not None:
+            self.urlScheme = "https"
+        else:
+            self.urlScheme = "http"
+
+    async def serve(self):
+        listener = self.listener
+        timeout = listener.headerTimeout
+        try:
+            while True:
+                if not len(self.buffer):
+                    if not await asyncio.wait_for(self.buffer.fillAsync(), timeout):
+                        break
+                req = await asyncio.wait_for(self.readHead(), listener.headerTimeout)
+                if not await self.handleRequest(req):
+                    break
+                timeout = listener.keepAliveTimeout
+        except RequestParserException as e:
+            listener.logger.log("INFO", "%s:%s sent invalid request: %s" % (self.addr[0], self.addr[1], e))
+            await self.sendError(e.status)
+        except (asyncio.TimeoutError, socket.timeout, network.SocketExhausted, ConnectionError):
+            pass
+        finally:
+            self.writer.close()
+
+    async def readHead(self):
+        parser = IncrementalRequestParser(self.listener.maxRequestLine, self.listener.maxHeaders,
+                                          self.listener.maxHeaderSize)
+        while not self.buffer.feed(parser):
+            if not await self.buffer.fillAsync():
+                raise network.SocketExhausted
+        return parser.request
+
+    async def send(self, *pieces):
+        self.writer.writelines(piece for piece in pieces if piece)
+        await self.writer.drain()
+
+    def sendFromThread(self, *pieces):
+        asyncio.run_coroutine_threadsafe(self.send(*pieces), self.loop).result()
+
+    async def sendError(self, status):
+        code, _, reason = status.partition(' ')
+        payload = (status + "\r\n").encode()
+        headers = [Header("Server", "PyTTP/0.0.1"),
+                   Header("Connection", "close"),
+                   Header("Content-Type", "text/plain"),
+                   Header("Content-Length", str(len(payload)))]
+        try:
+            await self.send(str(Response(Status("HTTP/1.1", code, reason), headers, "")).encode(), payload)
+        except ConnectionError:
+            pass
+
+    async def handleRequest(self, req):
+        """Serve one request; returns True if the connection may be kept alive."""
+        listener = self.listener
+        environ = buildEnviron(req, self.addr, listener.port, self.urlScheme)
+        environ['pyttp.start_time'] = time.time()
+        environ['wsgi.errors'] = listener.logger
+        listener.logger.log("INFO", "%s:%s requesting \"%s\"" % (self.addr[0], self.addr[1], req.type.resource))
+        wsgiInput = requestInput(environ, self.buffer,
+                                 sendContinue=functools.partial(self.sendFromThread, CONTINUE_RESPONSE))
+        connectionSetting = environ.get("HTTP_CONNECTION", "keep-alive").lower()
+        if listener.isAsync:
+            framing = await self.callAsync(environ, req, wsgiInput, connectionSetting)
+        else:
+            framing = await self.loop.run_in_executor(listener.executor, self.callThreaded,
+                                                      environ, req, wsgiInput, connectionSetting)
+        return framing is not None and framing.keepAlive
+
+    async def callAsync(self, environ, req, wsgiInput, connectionSetting):
+        """
+        Run an async application on the loop. The request body is read
+        completely before, so the application gets a plain file.
+        """
+        maxBodySize = self.listener.maxBodySize
+        if wsgiInput.remaining > maxBodySize:
+            raise RequestParserException("Request body too large", req, "413 Payload Too Large")
+        if wsgiInput.chunked:
+            # decoded by a pool thread, which StreamBuffer.fill releases
+            # with socket.timeout if the client stalls
+            body = await self.loop.run_in_executor(self.listener.executor, wsgiInput.read, maxBodySize + 1)
+            if len(body) > maxBodySize:
+                raise RequestParserException("Request body too large", req, "413 Payload Too Large")
+        else:
+            contentLength = wsgiInput.remaining
+            if wsgiInput.sendContinue is not None and len(self.buffer) < contentLength:
+                wsgiInput.sendContinue = None
+                await self.send(CONTINUE_RESPONSE)
+            while len(self.buffer) < contentLength:
+                if not await asyncio.wait_for(self.buffer.fillAsync(), self.listener.bodyTimeout):
+                    raise network.SocketExhausted
+            body = self.buffer.read(contentLength)
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['wsgi.multithread'] = False
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return response.setdefault('prePayload', []).append
+        framing = None
+        body = None
+        try:
+            body = await self.listener.app(environ, start_response)
+            if hasattr(body, "__aiter__"):
+                async for chunk in body:
+                    if chunk:
+                        if framing is None:
+                            framing = ResponseFraming(req, response['status'], response['headers'], connectionSetting)
+                            prePayload = map(self.toBytes, response.get('prePayload', []))
+                            await self.send(framing.head(), *map(framing.chunk, prePayload))
+                        await self.send(framing.chunk(self.toBytes(chunk)))
+                if framing is not None:
+                    await self.send(framing.end())
+                    return framing
+                body = []
+            framing = ResponseFraming(req, response['status'], response['headers'], connectionSetting)
+            payload = b''.join(map(self.toBytes, itertools.chain(response.get('prePayload', []), body)))
+            await self.send(framing.complete(payload))
+            return framing
+        except Exception:
+            self.logException()
+            if framing is None:
+                await self.sendError("500 Internal Error")
+            return None
+        finally:
+            if hasattr(body, "aclose"):
+                await body.aclose()
+
+    def callThreaded(self, environ, req, wsgiInput, connectionSetting):
+        """
+        Run a WSGI application in a pool thread. The request body is
+        received and the response sent by the loop while the thread waits.
+        """
+        environ['wsgi.input'] = wsgiInput
+        response = {'prePayload': []}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return response['prePayload'].append
+        framing = None
+        body = None
+        try:
+            body = self.listener.app(environ, start_response)
+            chunks = iter(body)
+            if isinstance(body, (list, tuple)):
+                complete = True
+            else:
+                #get the first chunks so that start_response will be called now
+                first = next(chunks, None)
+                second = next(chunks, None) if first is not None else None
+                complete = second is None
+                if complete:
+                    chunks = iter([first or b''])
+                else:
+                    chunks = itertools.chain([first, second], chunks)
+            framing = ResponseFraming(req, response['status'], response['headers'], connectionSetting)
+            prePayload = list(map(self.toBytes, response['prePayload']))
+            if complete:
+                payload = b''.join(prePayload + [self.toBytes(chunk) for chunk in chunks])
+                self.sendFromThread(framing.complete(payload))
+            else:
+                self.sendFromThread(framing.head(), *map(framing.chunk, prePayload))
+                for chunk in chunks:
+                    self.sendFromThread(framing.chunk(self.toBytes(chunk)))
+                self.sendFromThread(framing.end())
+        except Exception:
+            self.logException()
+            if framing is None:
+                asyncio.run_coroutine_threadsafe(self.sendError("500 Internal Error"), self.loop).result()
+            return None
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+        if framing.keepAlive and not wsgiInput.drain():
+            framing.connectionSetting = "close"
+        return framing
+
+    def toBytes(self, chunk):
+        if isinstance(chunk, str):
+            return chunk.encode()
+        return chunk
+
+    def logException(self):
+        import traceback
+        formatted_exception = ''.join(traceback.format_exception(*sys.exc_info()))
+        if self.listener.debug:
+            print("[DEBUG]:", formatted_exception)
+        self.listener.logger.log("EXC", formatted_exception)
+
+
+class AsyncListener(object):
+    """
+    asyncio-based server, an alternative to WSGIListener for I/O-bound
+    applications with many concurrent clients.
+
+    Connections, keep-alive and request heads are handled by a single
+    event loop, so idle and slow clients cost no thread. Plain WSGI
+    applications run in a pool of up to nThreads threads; their request
+    bodies are received and their responses sent by the loop. Async
+    applications (coroutine functions taking environ and start_response,
+    e.g. an AsyncControllerWSGIApp) run on the loop itself. They get the
+    request body read completely (up to maxBodySize bytes) and may return
+    an async iterable to stream their response.
+    """
+
+    def __init__(self, app, port, nThreads = None, logger=DummyLogger(), debug=None,
+                 headerTimeout = 10.0, bodyTimeout = 30.0, keepAliveTimeout = 5.0,
+                 maxBodySize = 1048576, maxRequestLine = 8190, maxHeaders = 100, maxHeaderSize = 8190):
+        self.app = app
+        self.port = port
+        self.logger = logger
+        self.debug = debug
+        self.isAsync = isAsyncApp(app)
+        self.headerTimeout = headerTimeout
+        self.bodyTimeout = bodyTimeout
+        self.keepAliveTimeout = keepAliveTimeout
+        self.maxBodySize = maxBodySize
+        self.maxRequestLine = maxRequestLine
+        self.maxHeaders = maxHeaders
+        self.maxHeaderSize = maxHeaderSize
+        self.executor = concurrent.futures.ThreadPoolExecutor(nThreads or 32)
+        self.server = None
+
+    def serve(self, listenSocket = None):
+        try:
+            asyncio.run(self.run(listenSocket))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def run(self, listenSocket = None):
+        if listenSocket is None:
+            listenSocket = network.openListenSocket(self.port)
+        self.server = await asyncio.start_server(self.handleConnection, sock=listenSocket)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handleConnection(self, reader, writer):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            network.tuneSocket(sock)
+        await AsyncConnection(self, reader, writer).serve()
@@ -1,13 +1,176 @@
 
+import binascii
+import collections
+import email.utils
+import itertools
 import mimetypes
 import os
 import re
+import stat as statmod
+import threading
+import time
+import zlib
+
+from pyttp.network import fileChunks
 
 
 """
 Collection of useful WSGI apps.
 """
 
+def parse_byte_ranges(value, size):
+    """
+    Parse the value of a Range header for a file of size bytes.
+    Returns a list of inclusive (first, last) offsets, sorted with
+    overlapping and adjacent ranges merged, an empty list if no range
+    is satisfiable, or None if the header is invalid and to be ignored.
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        first, dash, last = entry.partition('-')
+        first, last = first.strip(), last.strip()
+        if not dash or not (first.isdigit() or first == '') or not (last.isdigit() or last == ''):
+            return None
+        if not first:
+            if not last:
+                return None
+            # suffix range: the final bytes of the file
+            if int(last) and size:
+                ranges.append((max(size - int(last), 0), size - 1))
+            continue
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        if first < size:
+            ranges.append((first, min(int(last), size - 1) if last else size - 1))
+    if not ranges:
+        return []
+    ranges.sort()
+    merged = [ranges[0]]
+    for first, last in ranges[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def negotiate_encoding(accept_encoding, codings):
+    """
+    Return the one of codings, in order of preference, that the client
+    rates best in its Accept-Encoding header, or None if it accepts none.
+    """
+    qualities = {}
+    for entry in accept_encoding.split(','):
+        coding, _, params = entry.partition(';')
+        coding = coding.strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        quality = 1.0
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding] = max(quality, qualities.get(coding, 0.0))
+    wildcard = qualities.pop('*', 0.0)
+    best, best_quality = None, 0.0
+    for coding in codings:
+        quality = qualities.get(coding, wildcard)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def etag_matches(header, etag):
+    """Weak comparison of etag with the entity tags listed in an If-None-Match header."""
+    if header.strip() == '*':
+        return True
+    etag = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def not_modified(environ, etag=None, last_modified=None):
+    """
+    Whether a GET or HEAD request is conditional on a representation the
+    client has already: its If-None-Match lists etag or, without
+    If-None-Match, nothing changed since If-Modified-Since. last_modified
+    is a timestamp.
+    """
+    if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'):
+        return False
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return etag is not None and etag_matches(if_none_match, etag)
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is None or last_modified is None:
+        return False
+    since = email.utils.parsedate_tz(if_modified_since)
+    if since is None:
+        return False
+    return int(last_modified) <= email.utils.mktime_tz(since)
+
+
+
+class FileRange(object):
+
+    """
+    File-like view of length bytes of a file, starting at offset.
+    Reads are positional, so several views may share one file handle;
+    fileno() and tell() let servers hand the range to sendfile().
+    """
+
+    def __init__(self, filehandle, offset, length):
+        self.filehandle = filehandle
+        self.position = offset
+        self.end = offset + length
+
+
+    def fileno(self):
+        return self.filehandle.fileno()
+
+
+    def tell(self):
+        return self.position
+
+
+    def seek(self, position):
+        self.position = position
+
+
+    def remaining(self):
+        return max(self.end - self.position, 0)
+
+
+    def read(self, size=-1):
+        remaining = self.end - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        data = os.pread(self.fileno(), size, self.position)
+        self.position += len(data)
+        return data
+
+
+    def close(self):
+        self.filehandle.close()
+
+
+
 class Router(object):
 
     """
@@ -65,24 +228,177 @@ class Router(object):
 
 
 
+class FileEntry(object):
+
+    """
+    A file as served by FileServer: its stat result, MIME type and
+    response headers, plus its content while it is cached. For a
+    compressed sidecar, source is the file it was compressed from.
+    """
+
+    def __init__(self, filename, stat, mime, max_cache_age, data=None, encoding=None, vary=False, source=None):
+        self.filename = filename
+        self.stat = stat
+        self.source = source
+        self.mime = mime
+        self.data = data
+        # cheap entity tag derived from inode, size and modification time
+        self.etag = '"%x-%x-%x"' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self.last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        self.headers = [('Content-Type', mime),
+                        ('Accept-Ranges', 'bytes'),
+                        ('ETag', self.etag),
+                        ('Last-Modified', self.last_modified),
+                        ('Cache-Control', 'public, max-age=%s' % max_cache_age)]
+        if encoding is not None:
+            self.headers.append(('Content-Encoding', encoding))
+        if vary:
+            self.headers.append(('Vary', 'Accept-Encoding'))
+        self.checked = time.time()
+
+
+    def changed(self, stat):
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns) != \
+               (self.stat.st_ino, self.stat.st_size, self.stat.st_mtime_ns)
+
+
+
+class FileCache(object):
+
+    """
+    Size-bounded LRU cache of small files for FileServer.
+
+    Files of at most max_file_size bytes are kept in memory along with
+    their headers; once all of them exceed max_size bytes, the least
+    recently used ones are dropped. An entry used more than revalidate
+    seconds after its last check is compared with a fresh stat() of its
+    file and dropped if the file changed or is gone. hits and misses
+    count lookups.
+
+    Example:
+    FileServer("static", cache=FileCache(max_size=16 * 1024 * 1024))
+    """
+
+    def __init__(self, max_size=33554432, max_file_size=262144, revalidate=1.0):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.revalidate = revalidate
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def get(self, key):
+        """Return the valid entry for key or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            if time.time() - entry.checked < self.revalidate:
+                self.hits += 1
+                return entry
+        try:
+            stat = os.stat(entry.filename)
+            # a sidecar is outdated once its source is modified
+            if entry.source is not None and os.stat(entry.source).st_mtime_ns > stat.st_mtime_ns:
+                stat = None
+        except OSError:
+            stat = None
+        with self.lock:
+            if stat is None or entry.changed(stat):
+                if self.entries.get(key) is entry:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            entry.checked = time.time()
+            self.hits += 1
+        return entry
+
+
+    def put(self, key, entry):
+        if len(entry.data) > self.max_file_size or len(entry.data) > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.size += len(entry.data)
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= len(entry.data)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+
 class FileServer(object):
 
     """
     Serve files.
+
+    Hot small files can be kept in memory by passing a FileCache; hits
+    skip path resolution, MIME type guessing and opening the file.
+
+    With precompressed set, clients accepting gzip get foo.css.gz instead
+    of foo.css if it exists and is not older, with Content-Encoding gzip.
+    pyttp.precompress creates such files ahead of time.
+
+    Byte range requests are answered with 206 Partial Content, several
+    ranges as multipart/byteranges. Ranges are read with positional reads
+    through FileRange (or sent with sendfile), so files never need to fit
+    into memory; large ones are sent from a shared memory mapping.
     """
 
 
-    def __init__(self, document_root, directory_listing=True, max_cache_age=3600000):
+    archive_types = {'gzip': 'application/gzip',
+                     'bzip2': 'application/x-bzip2',
+                     'xz': 'application/x-xz',
+                     'compress': 'application/x-compress',
+                     'br': 'application/x-brotli'}
+
+
+    def __init__(self, document_root, directory_listing=True, max_cache_age=3600000, max_ranges=16,
+                 cache=None, precompressed=False):
         """
         directory_listing: Allow directory listing if True.
+        max_ranges: Requests for more byte ranges get the whole file.
+        cache: A FileCache to serve small files from memory.
+        precompressed: Serve foo.css.gz for foo.css to clients accepting gzip.
         """
         self.document_root = os.path.normpath(document_root)
         self.directory_listing = directory_listing
         self.max_cache_age=max_cache_age
+        self.max_ranges = max_ranges
+        self.cache = cache
+        self.precompressed = precompressed
 
 
     def __call__(self, environ, start_response):
-        import urllib
+        encoding = None
+        if self.precompressed and negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''), ('gzip',)):
+            encoding = 'gzip'
+        key = (self.document_root, environ["PATH_INFO"], encoding)
+        if self.cache is not None:
+            entry = self.cache.get(key)
+            if entry is not None:
+                return self.serve_file(environ, start_response, entry)
+        import urllib.parse
         path = urllib.parse.unquote(environ["PATH_INFO"][1:])
         filename = os.path.normpath(os.path.join(self.document_root, path))
 
@@ -95,51 +411,425 @@ class FileServer(object):
             status = "404 Not found"
             headers = [('Content-type', 'text/plain')]
             start_response(status, headers)
-            yield "File %s not found" % path
+            return ["File %s not found" % path]
 
         elif os.path.isdir(filename):
             if not self.directory_listing:
                 status = "401 Access denied"
                 headers = [('Content-type', 'text/html; charset=UTF-8')]
                 start_response(status, headers)
-                yield 'Unable to open file %s' % path
+                return ['Unable to open file %s' % path]
             status = "200 OK"
             headers = [('Content-type', 'text/html; charset=UTF-8')]
             start_response(status, headers)
-            yield "<html><head><title>%s</title></head><body>" % path
-            import glob
-            entries = glob.glob("%s/*" % filename)
-            yield "<table>"
-            parentDir, _ = os.path.split(filename)
-            if parentDir == self.document_root:
-                yield '<tr><td><a href="/">..</a></td><td></td></tr>'
-            else:
-                yield '<tr><td><a href="%s">..</a></td><td></td></tr>' % parentDir[len(self.document_root):]
-            for entry in sorted(entries, key=lambda x: x.lower()):
-                yield '<tr><td><a href="%s">%s</a></td><td>%sKB</td></tr>' % (entry[len(self.document_root):], os.path.basename(entry), os.path.getsize(entry) / 1024)
-            yield "</body></html>"
-
+            return self.list_directory(path, filename)
 
         else:
             mime, enc = mimetypes.guess_type(filename)
+            if enc is not None:
+                # foo.tar.gz is a gzip file, not a tar file in gzip coding
+                mime = self.archive_types.get(enc, 'application/octet-stream')
             if mime is None:
                 _, ext = os.path.splitext(filename)
                 mime = "application/{}".format(ext)
 
-            try:
-                with open(filename,"rb") as filehandle:
-                    status = "200 OK"
-                    headers = [('Content-Type', mime),
-                               ('Cache-Control', 'public, max-age=%s' % self.max_cache_age)]
+            filehandle = None
+            source = None
+            if encoding is not None:
+                filehandle = self.open_sidecar(filename)
+                if filehandle is not None:
+                    source = filename
+                    filename += '.gz'
+                else:
+                    # cached under the coding actually served, so that a
+                    # sidecar created later is picked up
+                    encoding = None
+                    key = (self.document_root, environ["PATH_INFO"], None)
+                    if self.cache is not None:
+                        entry = self.cache.get(key)
+                        if entry is not None:
+                            return self.serve_file(environ, start_response, entry)
+            if filehandle is None:
+                try:
+                    filehandle = open(filename, "rb")
+                except Exception as e:
+                    status = "401 Access denied"
+                    headers = [('Content-type', 'text/plain')]
                     start_response(status, headers)
-                    while True:
-                        data = filehandle.read(65536)
-                        yield data
-                        if len(data) < 65536:
-                            break
-            except Exception as e:
-                status = "401 Access denied"
-                headers = [('Content-type', 'text/plain')]
-                start_response(status, headers)
-                yield 'Unable to open file %s' % path
+                    return ['Unable to open file %s' % path]
+            stat = os.fstat(filehandle.fileno())
+            entry = FileEntry(filename, stat, mime, self.max_cache_age,
+                              encoding=encoding, vary=self.precompressed, source=source)
+            if self.cache is not None and stat.st_size <= self.cache.max_file_size:
+                data = filehandle.read()
+                if len(data) == stat.st_size and not entry.changed(os.fstat(filehandle.fileno())):
+                    filehandle.close()
+                    entry.data = data
+                    self.cache.put(key, entry)
+                    return self.serve_file(environ, start_response, entry)
+                # modified while being read; leave it to the next request
+                filehandle.seek(0)
+            return self.serve_file(environ, start_response, entry, filehandle)
+
+
+    def serve_file(self, environ, start_response, entry, filehandle=None):
+        """
+        Send the whole file or, for a satisfiable Range request, the
+        requested byte ranges with 206 Partial Content. The content comes
+        from entry.data if the file is cached, else from filehandle.
+        """
+        size = entry.stat.st_size
+        data = entry.data
+        headers = list(entry.headers)
+
+        if not_modified(environ, entry.etag, entry.stat.st_mtime):
+            if filehandle is not None:
+                filehandle.close()
+            # no representation metadata, the client has the representation
+            start_response("304 Not Modified",
+                           [(name, value) for name, value in headers
+                            if name.lower() not in ('content-length', 'content-type', 'content-encoding')])
+            return []
+
+        ranges = None
+        if environ.get('REQUEST_METHOD', 'GET') == 'GET' and 'HTTP_RANGE' in environ \
+                and self.range_valid(environ.get('HTTP_IF_RANGE'), entry.etag, entry.last_modified):
+            ranges = parse_byte_ranges(environ['HTTP_RANGE'], size)
+            if ranges is not None and len(ranges) > self.max_ranges:
+                ranges = None
+
+        if ranges is None:
+            headers.insert(1, ('Content-Length', str(size)))
+            start_response("200 OK", headers)
+            if data is not None:
+                return [data]
+            return self.send_file(environ, filehandle)
+        if not ranges:
+            if filehandle is not None:
+                filehandle.close()
+            headers = [('Content-Type', 'text/plain'),
+                       ('Content-Range', 'bytes */%d' % size)]
+            start_response("416 Range Not Satisfiable", headers)
+            return [b'Range not satisfiable']
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers[1:1] = [('Content-Length', str(end - start + 1)),
+                            ('Content-Range', 'bytes %d-%d/%d' % (start, end, size))]
+            start_response("206 Partial Content", headers)
+            if data is not None:
+                return [data[start:end + 1]]
+            return self.send_file(environ, FileRange(filehandle, start, end - start + 1))
+
+        boundary = binascii.hexlify(os.urandom(12)).decode()
+        parts = []
+        length = len(boundary) + 6
+        for start, end in ranges:
+            part_head = ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+                         % (boundary, entry.mime, start, end, size)).encode()
+            parts.append((part_head, start, end - start + 1))
+            length += len(part_head) + end - start + 1 + 2
+        headers[0] = ('Content-Type', 'multipart/byteranges; boundary=%s' % boundary)
+        headers.insert(1, ('Content-Length', str(length)))
+        start_response("206 Partial Content", headers)
+        if data is not None:
+            body = []
+            for part_head, start, length in parts:
+                body.extend((part_head, data[start:start + length], b'\r\n'))
+            body.append(('--%s--\r\n' % boundary).encode())
+            return body
+        return self.read_parts(filehandle, parts, boundary)
+
+
+    def open_sidecar(self, filename):
+        """
+        Open the gzip compressed copy of filename, if there is one at
+        least as recent as the file itself.
+        """
+        try:
+            sidecar = open(filename + '.gz', 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            stat = os.fstat(sidecar.fileno())
+            if statmod.S_ISREG(stat.st_mode) and stat.st_mtime_ns >= os.stat(filename).st_mtime_ns:
+                return sidecar
+        except OSError:
+            pass
+        sidecar.close()
+        return None
+
+
+    def range_valid(self, if_range, etag, last_modified):
+        """Whether a Range request may be answered; If-Range must name the current file."""
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            return if_range == etag
+        return if_range == last_modified
+
+
+    def send_file(self, environ, filehandle):
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(filehandle, 65536)
+        return self.read_file(filehandle)
+
+
+    def list_directory(self, path, filename):
+        yield "<html><head><title>%s</title></head><body>" % path
+        import glob
+        entries = glob.glob("%s/*" % filename)
+        yield "<table>"
+        parentDir, _ = os.path.split(filename)
+        if parentDir == self.document_root:
+            yield '<tr><td><a href="/">..</a></td><td></td></tr>'
+        else:
+            yield '<tr><td><a href="%s">..</a></td><td></td></tr>' % parentDir[len(self.document_root):]
+        for entry in sorted(entries, key=lambda x: x.lower()):
+            yield '<tr><td><a href="%s">%s</a></td><td>%sKB</td></tr>' % (entry[len(self.document_root):], os.path.basename(entry), os.path.getsize(entry) / 1024)
+        yield "</body></html>"
+
+
+    def read_file(self, filehandle):
+        try:
+            if isinstance(filehandle, FileRange):
+                length = filehandle.remaining()
+            else:
+                length = os.fstat(filehandle.fileno()).st_size - filehandle.tell()
+            for data in fileChunks(filehandle, length):
+                yield data
+        finally:
+            filehandle.close()
+
+
+    def read_parts(self, filehandle, parts, boundary):
+        with filehandle:
+            for part_head, offset, length in parts:
+                yield part_head
+                for data in fileChunks(FileRange(filehandle, offset, length), length):
+                    yield data
+                yield b'\r\n'
+            yield ('--%s--\r\n' % boundary).encode()
+
+
+
+class Compressor(object):
+
+    """
+    Compress responses of another WSGI app with gzip or deflate.
+
+    The coding is negotiated from the Accept-Encoding request header;
+    gzip is preferred when the client rates both the same.
+    Responses are left alone if they are already encoded, their type is
+    in incompressible_types (images, archives, ...) or their body is
+    shorter than min_size. Everything else is compressed chunk by chunk,
+    so streamed responses keep streaming: each chunk the app yields is
+    flushed out compressed right away.
+
+    level trades CPU for size: 1 is fastest, 9 smallest; 6 is zlib's
+    default. For pages going over slow links a higher level pays off.
+
+    Example:
+    app = Compressor(Router([...]), level=6)
+    """
+
+    incompressible_types = ('image/', 'video/', 'audio/', 'font/woff',
+                            'application/zip', 'application/gzip',
+                            'application/x-gzip', 'application/x-bzip2',
+                            'application/x-xz', 'application/x-7z-compressed',
+                            'application/x-rar-compressed', 'application/pdf',
+                            'application/octet-stream', 'text/event-stream')
+    compressible_types = ('image/svg+xml', 'image/x-icon', 'image/bmp')
+
+    codings = {'gzip': 16 + zlib.MAX_WBITS,
+               'deflate': zlib.MAX_WBITS}
+
+
+    def __init__(self, app, level=6, min_size=256):
+        if not 0 <= level <= 9:
+            raise ValueError("Compression level must be between 0 and 9")
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+
+
+    def negotiate(self, accept_encoding):
+        """Return the best coding the client accepts, or None for identity."""
+        return negotiate_encoding(accept_encoding, ('gzip', 'deflate'))
+
+
+    @classmethod
+    def compressible_type(cls, content_type):
+        """Whether bodies of content_type (without parameters) are worth compressing."""
+        content_type = content_type.lower()
+        if content_type.startswith(cls.compressible_types):
+            return True
+        return not content_type.startswith(cls.incompressible_types)
+
+
+    def compressible(self, status, headers):
+        if status[:1] != '2' or status[:3] in ('204', '206'):
+            return False
+        content_type = ''
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding' and value.strip().lower() != 'identity':
+                return False
+            if name == 'cache-control' and 'no-transform' in value.lower():
+                return False
+            if name == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+        return bool(content_type) and self.compressible_type(content_type)
+
+
+    def __call__(self, environ, start_response):
+        response = {}
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            response['exc_info'] = exc_info
+            return written.append
+
+        result = self.app(environ, capture)
+        chunks = None
+        if 'status' not in response:
+            # the app calls start_response when first iterated
+            chunks = iter(result)
+            first = next(chunks, None)
+            chunks = itertools.chain([] if first is None else [first], chunks)
+        status, headers = response['status'], response['headers']
+
+        if not self.compressible(status, headers):
+            return self.passthrough(start_response, response, written, result, chunks)
+
+        # from here on the body sent depends on Accept-Encoding
+        headers = [(name, value) for name, value in headers if name.lower() != 'vary']
+        headers.append(('Vary', self.vary(response['headers'])))
+        response['headers'] = headers
+        coding = self.negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        content_length = None
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    pass
+        if coding is None or (content_length is not None and content_length < self.min_size):
+            return self.passthrough(start_response, response, written, result, chunks)
+
+        # look at the start of the body to see whether it is worth compressing
+        head = [self.to_bytes(chunk) for chunk in written]
+        if chunks is None and isinstance(result, (list, tuple)):
+            head.extend(self.to_bytes(chunk) for chunk in result)
+            exhausted = True
+        else:
+            if chunks is None:
+                chunks = iter(result)
+            exhausted = False
+            size = sum(len(chunk) for chunk in head)
+            while size < self.min_size:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                chunk = self.to_bytes(chunk)
+                head.append(chunk)
+                size += len(chunk)
+        head = b''.join(head)
+        if exhausted:
+            self.close(result)
+            if len(head) < self.min_size:
+                start_response(status, headers, response['exc_info'])
+                return [head]
+
+        headers = [(name, self.weaken(value) if name.lower() == 'etag' else value)
+                   for name, value in headers
+                   if name.lower() not in ('content-length', 'content-encoding')]
+        headers.append(('Content-Encoding', coding))
+        start_response(status, headers, response['exc_info'])
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.codings[coding])
+        if exhausted:
+            return [compressor.compress(head) + compressor.flush()]
+        return self.compress(compressor, head, chunks, result)
+
+
+    def passthrough(self, start_response, response, written, result, chunks):
+        """Hand the unchanged response on, keeping file wrappers and lists intact."""
+        write = start_response(response['status'], response['headers'], response['exc_info'])
+        for chunk in written:
+            write(chunk)
+        if chunks is None:
+            return result
+        return ClosingIterator(chunks, result)
+
+
+    def compress(self, compressor, head, chunks, result):
+        try:
+            data = compressor.compress(head) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield data
+            for chunk in chunks:
+                chunk = self.to_bytes(chunk)
+                if not chunk:
+                    continue
+                data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            self.close(result)
+
+
+    def vary(self, headers):
+        values = [value for name, value in headers if name.lower() == 'vary']
+        fields = [field.strip() for value in values for field in value.split(',') if field.strip()]
+        if '*' in fields:
+            return '*'
+        if 'accept-encoding' not in [field.lower() for field in fields]:
+            fields.append('Accept-Encoding')
+        return ', '.join(fields)
+
+
+    def weaken(self, etag):
+        """A compressed body is no longer byte-identical to what a strong ETag names."""
+        if etag.startswith('W/'):
+            return etag
+        return 'W/' + etag
+
+
+    def to_bytes(self, chunk):
+        if isinstance(chunk, str):
+            return chunk.encode()
+        return chunk
+
+
+    def close(self, result):
+        if hasattr(result, 'close'):
+            result.close()
+
+
+
+class ClosingIterator(object):
+
+    """
+    Iterate chunks, passing close() on to the original response.
+    """
+
+    def __init__(self, chunks, result):
+        self.chunks = chunks
+        self.result = result
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        return next(self.chunks)
+
 
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
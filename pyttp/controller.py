@@ -1,4 +1,6 @@
 import cgi
+import hashlib
+import inspect
 import string
 
 try:
@@ -6,6 +8,7 @@ try:
 except:
     import http.cookies as Cookie
 
+from pyttp.apps import not_modified
 from pyttp.template import Template
 
 class Http404(Exception):
@@ -47,17 +50,52 @@ def inject_header(header):
     def decorator(func):
         def inner(*args, **kwargs):
             response = func(*args, **kwargs)
+            if inspect.isawaitable(response):
+                return _inject_header_async(response, header)
             response.headers.append(header)
             return response
         return inner
     return decorator
 
 
+async def _inject_header_async(awaitable, header):
+    response = await awaitable
+    response.headers.append(header)
+    return response
+
+
+def hash_etag(func):
+    """
+    Have the responses of an action carry an ETag hashed from their
+    rendered body, so repeated requests can be answered with 304.
+    """
+    def inner(*args, **kwargs):
+        response = func(*args, **kwargs)
+        if inspect.isawaitable(response):
+            return _hash_etag_async(response)
+        response.hash_etag = True
+        return response
+    return inner
+
+
+async def _hash_etag_async(awaitable):
+    response = await awaitable
+    response.hash_etag = True
+    return response
+
+
 class ControllerResponse:
     """
     Response to be returned by actions as expected by the ControllerWSGIApp.
+
+    With hash_etag set (or the action decorated with hash_etag) a
+    successful response gets an ETag computed from its rendered body and
+    requests naming that ETag in If-None-Match get 304 Not Modified.
+    The body is still rendered, but not sent.
     """
 
+    hash_etag = False
+
     def __init__(self, payload, status="200 OK", headers=None):
         self.payload = payload
         self.status = status
@@ -84,6 +122,48 @@ class ControllerResponse:
         else:
             raise Exception("Expected payload to be str or bytes, not {}".format(type(payload)))
 
+    def iterable(self):
+        """
+        The WSGI response iterable.
+        """
+        return [self.render()]
+
+    def respond(self, environ):
+        """
+        The WSGI status, headers and iterable, answering a conditional
+        request with 304 if hash_etag is set and the body is unchanged.
+        """
+        body = self.iterable()
+        if not self.hash_etag or not self.status.startswith("200") or not isinstance(body, list):
+            return self.status, self.headers, body
+        etag = '"%s"' % hashlib.blake2b(b''.join(body), digest_size=16).hexdigest()
+        headers = [(name, value) for name, value in self.headers if name.lower() != 'etag']
+        headers.append(('ETag', etag))
+        if not_modified(environ, etag):
+            headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+            return "304 Not Modified", headers, []
+        return self.status, headers, body
+
+
+class EventStreamResponse(ControllerResponse):
+    """
+    Streams the events of a pyttp.sse.Broker subscription, e.g.
+    EventStreamResponse(broker.subscribe("news")). Under WSGIHandler the
+    connection is served by the EventStreamHub, not by a worker thread.
+    """
+
+    def __init__(self, stream, status="200 OK", headers=None):
+        super(EventStreamResponse, self).__init__(b'', status, headers)
+        self.stream = stream
+        names = set(name.lower() for name, value in self.headers)
+        if "content-type" not in names:
+            self.headers.append(("Content-Type", "text/event-stream"))
+        if "cache-control" not in names:
+            self.headers.append(("Cache-Control", "no-cache"))
+
+    def iterable(self):
+        return self.stream
+
 
 class EmptyResponse(ControllerResponse):
 
@@ -255,31 +335,39 @@ class ControllerWSGIApp(object):
         self.resp_processors = resp_processors or []
 
     def __call__(self, environ, start_response):
-        path = environ["PATH_INFO"]
         try:
-            handler, args = self.root._dispatch(path)
-            request = self.build_request(handler, environ)
-            for proc in self.req_processors:
-                request = proc(request)
-            response = handler(request, *args)
-            for proc in self.resp_processors:
-                response = proc(response, request)
-            if hasattr(response, "inject_request"):
-                response.inject_request(request)
-        except Http404:
-            response = self.handler404(environ)
-
-        except Redirection as redirect:
-            response = RedirectionResponse(redirect.location)
-
+            handler, args, request = self.dispatch(environ)
+            response = self.process_response(handler(request, *args), request)
         except Exception as e:
-            if self.handler500:
-                response = self.handler500(environ, e)
-            else:
-                raise
-
-        start_response(response.status, response.headers)
-        yield response.render()
+            response = self.handle_exception(environ, e)
+
+        status, headers, body = response.respond(environ)
+        start_response(status, headers)
+        return body
+
+    def dispatch(self, environ):
+        handler, args = self.root._dispatch(environ["PATH_INFO"])
+        request = self.build_request(handler, environ)
+        for proc in self.req_processors:
+            request = proc(request)
+        return handler, args, request
+
+    def process_response(self, response, request):
+        for proc in self.resp_processors:
+            response = proc(response, request)
+        if hasattr(response, "inject_request"):
+            response.inject_request(request)
+        return response
+
+    def handle_exception(self, environ, e):
+        if isinstance(e, Http404):
+            return self.handler404(environ)
+        elif isinstance(e, Redirection):
+            return RedirectionResponse(e.location)
+        elif self.handler500:
+            return self.handler500(environ, e)
+        else:
+            raise e
 
     @staticmethod
     def build_request(lookup, environ):
@@ -334,6 +422,29 @@ class ControllerWSGIApp(object):
         return request
 
 
+class AsyncControllerWSGIApp(ControllerWSGIApp):
+    """
+    ControllerWSGIApp for pyttp.aio.AsyncListener. Actions may be
+    coroutines; they are awaited on the event loop, so waiting for an
+    upstream service does not block a thread. Plain actions are called
+    directly on the loop and should therefore be quick.
+    """
+
+    async def __call__(self, environ, start_response):
+        try:
+            handler, args, request = self.dispatch(environ)
+            response = handler(request, *args)
+            if inspect.isawaitable(response):
+                response = await response
+            response = self.process_response(response, request)
+        except Exception as e:
+            response = self.handle_exception(environ, e)
+
+        status, headers, body = response.respond(environ)
+        start_response(status, headers)
+        return body
+
+
 if __name__ == "__main__":
 
     import os
@@ -5,13 +5,27 @@ class PyTTPException(Exception):
     pass
 
 class RequestParserException(PyTTPException):
+
+    status = "400 Bad Request"
     
-    def __init__(self, msg, req):
+    def __init__(self, msg, req, status=None):
         self.msg = msg
         self.req = req
+        if status:
+            self.status = status
         
     def __str__(self):
-        return "RequestParser: %s %s" % (self.msg, self.req.encode("string_escape"))
+        return "RequestParser: %s %r" % (self.msg, self.req)
+
+
+class RequestLineTooLong(RequestParserException):
+
+    status = "414 URI Too Long"
+
+
+class RequestHeaderFieldsTooLarge(RequestParserException):
+
+    status = "431 Request Header Fields Too Large"
         
 
 class Header(object):
@@ -70,6 +84,98 @@ class Request(object):
         return "Request(%s, %s)" % (repr(self.type), repr(self.headers))
 
 
+class IncrementalRequestParser(object):
+    """
+    Resumable HTTP/1.x request head parser.
+
+    Feed it the receive buffer whenever new data arrived. Only complete
+    lines are consumed; an incomplete line stays in the caller's buffer
+    until the next feed, so nothing is copied or buffered here. Limits on
+    the request line, the number of header fields and the size of a
+    single field are checked as soon as the data is seen, so a caller can
+    stop receiving as early as possible.
+
+    Example:
+        parser = IncrementalRequestParser()
+        consumed = parser.feed(buf, start)
+        if parser.done:
+            request = parser.request
+    """
+
+    STATE_REQUEST_LINE = "R"
+    STATE_HEADERS = "H"
+    STATE_DONE = "D"
+
+    def __init__(self, maxRequestLine=8190, maxHeaders=100, maxHeaderSize=8190):
+        self.maxRequestLine = maxRequestLine
+        self.maxHeaders = maxHeaders
+        self.maxHeaderSize = maxHeaderSize
+        self.state = self.STATE_REQUEST_LINE
+        self.type = None
+        self.headers = []
+        self.request = None
+
+    @property
+    def done(self):
+        return self.state == self.STATE_DONE
+
+    def feed(self, data, start=0):
+        """
+        Parse complete lines of data beginning at offset start.
+        Returns the number of bytes consumed; bytes following the head
+        are never consumed.
+        """
+        pos = start
+        end = len(data)
+        while self.state != self.STATE_DONE:
+            lineEnd = data.find(b'\n', pos)
+            if lineEnd < 0:
+                self.checkLineLength(end - pos, data[pos:pos + 64])
+                break
+            self.checkLineLength(lineEnd - pos, data[pos:pos + 64])
+            line = data[pos:lineEnd]
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            pos = lineEnd + 1
+            if self.state == self.STATE_REQUEST_LINE:
+                # ignore empty lines preceding the request line
+                if line:
+                    self.type = self.parseRequestLine(line)
+                    self.state = self.STATE_HEADERS
+            elif line:
+                if len(self.headers) >= self.maxHeaders:
+                    raise RequestHeaderFieldsTooLarge("Too many header fields!", bytes(line))
+                self.headers.append(self.parseHeader(line))
+            else:
+                self.request = Request(self.type, self.headers)
+                self.state = self.STATE_DONE
+        return pos - start
+
+    def checkLineLength(self, length, excerpt):
+        if self.state == self.STATE_REQUEST_LINE:
+            if length > self.maxRequestLine:
+                raise RequestLineTooLong("Request line too long!", bytes(excerpt))
+        elif length > self.maxHeaderSize:
+            raise RequestHeaderFieldsTooLarge("Header field too large!", bytes(excerpt))
+
+    def parseRequestLine(self, line):
+        try:
+            verb, resource, version = line.decode("latin-1").split(' ')
+        except ValueError:
+            raise RequestParserException("Malformed type!", bytes(line))
+        if not version.startswith("HTTP/"):
+            raise RequestParserException("Malformed version!", bytes(line))
+        if verb.upper() not in Type.allowedVerbs:
+            raise RequestParserException("Invalid HTTP verb!", bytes(line), "501 Not Implemented")
+        return Type(verb, resource, version)
+
+    def parseHeader(self, line):
+        name, sep, value = line.decode("latin-1").partition(':')
+        if not sep or not name or name != name.strip() or line[:1] in (b' ', b'\t'):
+            raise RequestParserException("Malformed header!", bytes(line))
+        return Header(name, value.strip(' \t'))
+
+
 class RequestParser(object):
     
     def __init__(self):
@@ -77,37 +183,11 @@ class RequestParser(object):
     
     
     def parse(self, requestString):
-        the_request = requestString.split(b'\r\n\r\n')
-        requestHeaderString = the_request[0]
-        try:
-            payload = b'\r\n\r\n'.join(the_request[1:])
-        except:
+        parser = IncrementalRequestParser()
+        consumed = parser.feed(requestString)
+        if not parser.done:
             raise RequestParserException("Malformed Request!", requestString)
-        try:
-            lines = requestHeaderString.split(b'\r\n')
-        except AttributeError:
-            raise RequestParserException("Expected string!", requestString)
-        try:
-            typeString = lines[0]
-            verb, resource, version = typeString.decode().split(' ')
-        except ValueError:
-            raise RequestParserException("Malformed type!", requestString)
-        type = Type(verb, resource, version)
-        
-        headers = []
-        for headerString in lines[1:-1]:
-            try:
-                if not headerString:
-                    continue
-                fields = headerString.decode().split(':')
-                name = fields[0]
-                value = (':'.join(fields[1:])).strip(' ')
-                headers.append(Header(name, value))
-            except:
-                raise RequestParserException("Malformed header!", requestString)
-
-            
-        return Request(type, headers), payload
+        return parser.request, requestString[consumed:]
 
 
 class Status(object):
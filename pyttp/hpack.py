@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import collections
+
+from pyttp.core import PyTTPException
+
+
+class HPACKError(PyTTPException):
+    pass
+
+
+# RFC 7541, Appendix A
+STATIC_TABLE = [
+    (":authority", ""),
+    (":method", "GET"),
+    (":method", "POST"),
+    (":path", "/"),
+    (":path", "/index.html"),
+    (":scheme", "http"),
+    (":scheme", "https"),
+    (":status", "200"),
+    (":status", "204"),
+    (":status", "206"),
+    (":status", "304"),
+    (":status", "400"),
+    (":status", "404"),
+    (":status", "500"),
+    ("accept-charset", ""),
+    ("accept-encoding", "gzip, deflate"),
+    ("accept-language", ""),
+    ("accept-ranges", ""),
+    ("accept", ""),
+    ("access-control-allow-origin", ""),
+    ("age", ""),
+    ("allow", ""),
+    ("authorization", ""),
+    ("cache-control", ""),
+    ("content-disposition", ""),
+    ("content-encoding", ""),
+    ("content-language", ""),
+    ("content-length", ""),
+    ("content-location", ""),
+    ("content-range", ""),
+    ("content-type", ""),
+    ("cookie", ""),
+    ("date", ""),
+    ("etag", ""),
+    ("expect", ""),
+    ("expires", ""),
+    ("from", ""),
+    ("host", ""),
+    ("if-match", ""),
+    ("if-modified-since", ""),
+    ("if-none-match", ""),
+    ("if-range", ""),
+    ("if-unmodified-since", ""),
+    ("last-modified", ""),
+    ("link", ""),
+    ("location", ""),
+    ("max-forwards", ""),
+    ("proxy-authenticate", ""),
+    ("proxy-authorization", ""),
+    ("range", ""),
+    ("referer", ""),
+    ("refresh", ""),
+    ("retry-after", ""),
+    ("server", ""),
+    ("set-cookie", ""),
+    ("strict-transport-security", ""),
+    ("transfer-encoding", ""),
+    ("user-agent", ""),
+    ("vary", ""),
+    ("via", ""),
+    ("www-authenticate", ""),
+]
+
+STATIC_INDEX = {}
+STATIC_NAME_INDEX = {}
+for index, (name, value) in enumerate(STATIC_TABLE, 1):
+    STATIC_INDEX.setdefault((name, value), index)
+    STATIC_NAME_INDEX.setdefault(name, index)
+
+
+# RFC 7541, Appendix B: (code, length in bits) of every octet and EOS
+HUFFMAN_CODES = [
+    (0x1ff8, 13), (0x7fffd8, 23), (0xfffffe2, 28), (0xfffffe3, 28),
+    (0xfffffe4, 28), (0xfffffe5, 28), (0xfffffe6, 28), (0xfffffe7, 28),
+    (0xfffffe8, 28), (0xffffea, 24), (0x3ffffffc, 30), (0xfffffe9, 28),
+    (0xfffffea, 28), (0x3ffffffd, 30), (0xfffffeb, 28), (0xfffffec, 28),
+    (0xfffffed, 28), (0xfffffee, 28), (0xfffffef, 28), (0xffffff0, 28),
+    (0xffffff1, 28), (0xffffff2, 28), (0x3ffffffe, 30), (0xffffff3, 28),
+    (0xffffff4, 28), (0xffffff5, 28), (0xffffff6, 28), (0xffffff7, 28),
+    (0xffffff8, 28), (0xffffff9, 28), (0xffffffa, 28), (0xffffffb, 28),
+    (0x14, 6), (0x3f8, 10), (0x3f9, 10), (0xffa, 12),
+    (0x1ff9, 13), (0x15, 6), (0xf8, 8), (0x7fa, 11),
+    (0x3fa, 10), (0x3fb, 10), (0xf9, 8), (0x7fb, 11),
+    (0xfa, 8), (0x16, 6), (0x17, 6), (0x18, 6),
+    (0x0, 5), (0x1, 5), (0x2, 5), (0x19, 6),
+    (0x1a, 6), (0x1b, 6), (0x1c, 6), (0x1d, 6),
+    (0x1e, 6), (0x1f, 6), (0x5c, 7), (0xfb, 8),
+    (0x7ffc, 15), (0x20, 6), (0xffb, 12), (0x3fc, 10),
+    (0x1ffa, 13), (0x21, 6), (0x5d, 7), (0x5e, 7),
+    (0x5f, 7), (0x60, 7), (0x61, 7), (0x62, 7),
+    (0x63, 7), (0x64, 7), (0x65, 7), (0x66, 7),
+    (0x67, 7), (0x68, 7), (0x69, 7), (0x6a, 7),
+    (0x6b, 7), (0x6c, 7), (0x6d, 7), (0x6e, 7),
+    (0x6f, 7), (0x70, 7), (0x71, 7), (0x72, 7),
+    (0xfc, 8), (0x73, 7), (0xfd, 8), (0x1ffb, 13),
+    (0x7fff0, 19), (0x1ffc, 13), (0x3ffc, 14), (0x22, 6),
+    (0x7ffd, 15), (0x3, 5), (0x23, 6), (0x4, 5),
+    (0x24, 6), (0x5, 5), (0x25, 6), (0x26, 6),
+    (0x27, 6), (0x6, 5), (0x74, 7), (0x75, 7),
+    (0x28, 6), (0x29, 6), (0x2a, 6), (0x7, 5),
+    (0x2b, 6), (0x76, 7), (0x2c, 6), (0x8, 5),
+    (0x9, 5), (0x2d, 6), (0x77, 7), (0x78, 7),
+    (0x79, 7), (0x7a, 7), (0x7b, 7), (0x7ffe, 15),
+    (0x7fc, 11), (0x3ffd, 14), (0x1ffd, 13), (0xffffffc, 28),
+    (0xfffe6, 20), (0x3fffd2, 22), (0xfffe7, 20), (0xfffe8, 20),
+    (0x3fffd3, 22), (0x3fffd4, 22), (0x3fffd5, 22), (0x7fffd9, 23),
+    (0x3fffd6, 22), (0x7fffda, 23), (0x7fffdb, 23), (0x7fffdc, 23),
+    (0x7fffdd, 23), (0x7fffde, 23), (0xffffeb, 24), (0x7fffdf, 23),
+    (0xffffec, 24), (0xffffed, 24), (0x3fffd7, 22), (0x7fffe0, 23),
+    (0xffffee, 24), (0x7fffe1, 23), (0x7fffe2, 23), (0x7fffe3, 23),
+    (0x7fffe4, 23), (0x1fffdc, 21), (0x3fffd8, 22), (0x7fffe5, 23),
+    (0x3fffd9, 22), (0x7fffe6, 23), (0x7fffe7, 23), (0xffffef, 24),
+    (0x3fffda, 22), (0x1fffdd, 21), (0xfffe9, 20), (0x3fffdb, 22),
+    (0x3fffdc, 22), (0x7fffe8, 23), (0x7fffe9, 23), (0x1fffde, 21),
+    (0x7fffea, 23), (0x3fffdd, 22), (0x3fffde, 22), (0xfffff0, 24),
+    (0x1fffdf, 21), (0x3fffdf, 22), (0x7fffeb, 23), (0x7fffec, 23),
+    (0x1fffe0, 21), (0x1fffe1, 21), (0x3fffe0, 22), (0x1fffe2, 21),
+    (0x7fffed, 23), (0x3fffe1, 22), (0x7fffee, 23), (0x7fffef, 23),
+    (0xfffea, 20), (0x3fffe2, 22), (0x3fffe3, 22), (0x3fffe4, 22),
+    (0x7ffff0, 23), (0x3fffe5, 22), (0x3fffe6, 22), (0x7ffff1, 23),
+    (0x3ffffe0, 26), (0x3ffffe1, 26), (0xfffeb, 20), (0x7fff1, 19),
+    (0x3fffe7, 22), (0x7ffff2, 23), (0x3fffe8, 22), (0x1ffffec, 25),
+    (0x3ffffe2, 26), (0x3ffffe3, 26), (0x3ffffe4, 26), (0x7ffffde, 27),
+    (0x7ffffdf, 27), (0x3ffffe5, 26), (0xfffff1, 24), (0x1ffffed, 25),
+    (0x7fff2, 19), (0x1fffe3, 21), (0x3ffffe6, 26), (0x7ffffe0, 27),
+    (0x7ffffe1, 27), (0x3ffffe7, 26), (0x7ffffe2, 27), (0xfffff2, 24),
+    (0x1fffe4, 21), (0x1fffe5, 21), (0x3ffffe8, 26), (0x3ffffe9, 26),
+    (0xffffffd, 28), (0x7ffffe3, 27), (0x7ffffe4, 27), (0x7ffffe5, 27),
+    (0xfffec, 20), (0xfffff3, 24), (0xfffed, 20), (0x1fffe6, 21),
+    (0x3fffe9, 22), (0x1fffe7, 21), (0x1fffe8, 21), (0x7ffff3, 23),
+    (0x3fffea, 22), (0x3fffeb, 22), (0x1ffffee, 25), (0x1ffffef, 25),
+    (0xfffff4, 24), (0xfffff5, 24), (0x3ffffea, 26), (0x7ffff4, 23),
+    (0x3ffffeb, 26), (0x7ffffe6, 27), (0x3ffffec, 26), (0x3ffffed, 26),
+    (0x7ffffe7, 27), (0x7ffffe8, 27), (0x7ffffe9, 27), (0x7ffffea, 27),
+    (0x7ffffeb, 27), (0xffffffe, 28), (0x7ffffec, 27), (0x7ffffed, 27),
+    (0x7ffffee, 27), (0x7ffffef, 27), (0x7fffff0, 27), (0x3ffffee, 26),
+    (0x3fffffff, 30),
+]
+
+EOS = 256
+HUFFMAN_DECODE = dict(((length, code), symbol) for symbol, (code, length) in enumerate(HUFFMAN_CODES))
+
+
+def huffmanEncode(data):
+    bits = 0
+    nBits = 0
+    for octet in bytearray(data):
+        code, length = HUFFMAN_CODES[octet]
+        bits = (bits << length) | code
+        nBits += length
+    # pad with the most significant bits of EOS, i.e. ones
+    padding = -nBits % 8
+    bits = (bits << padding) | ((1 << padding) - 1)
+    nBits += padding
+    return bits.to_bytes(nBits // 8, "big")
+
+
+def huffmanDecode(data):
+    decoded = bytearray()
+    code = 0
+    length = 0
+    for octet in bytearray(data):
+        for shift in range(7, -1, -1):
+            code = (code << 1) | ((octet >> shift) & 1)
+            length += 1
+            symbol = HUFFMAN_DECODE.get((length, code))
+            if symbol is not None:
+                if symbol == EOS:
+                    raise HPACKError("EOS in Huffman-coded string")
+                decoded.append(symbol)
+                code = 0
+                length = 0
+            elif length > 30:
+                raise HPACKError("Invalid Huffman code")
+    if length > 7 or code != (1 << length) - 1:
+        raise HPACKError("Invalid Huffman padding")
+    return bytes(decoded)
+
+
+def encodeInteger(value, prefixBits, flags = 0):
+    """Integer with an N-bit prefix; flags fill the bits above the prefix."""
+    limit = (1 << prefixBits) - 1
+    if value < limit:
+        return bytearray([flags | value])
+    encoded = bytearray([flags | limit])
+    value -= limit
+    while value >= 128:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return encoded
+
+
+def decodeInteger(data, pos, prefixBits):
+    """Returns the integer starting at data[pos] and the position after it."""
+    limit = (1 << prefixBits) - 1
+    try:
+        value = data[pos] & limit
+        pos += 1
+        if value < limit:
+            return value, pos
+        shift = 0
+        while True:
+            octet = data[pos]
+            pos += 1
+            value += (octet & 0x7f) << shift
+            shift += 7
+            if not octet & 0x80:
+                return value, pos
+            if shift > 28:
+                raise HPACKError("Integer too large")
+    except IndexError:
+        raise HPACKError("Truncated integer")
+
+
+def encodeString(string, huffman = True):
+    data = string.encode("latin-1")
+    if huffman:
+        compressed = huffmanEncode(data)
+        if len(compressed) < len(data):
+            return encodeInteger(len(compressed), 7, 0x80) + compressed
+    return encodeInteger(len(data), 7) + data
+
+
+def decodeString(data, pos):
+    huffman = data[pos] & 0x80
+    length, pos = decodeInteger(data, pos, 7)
+    if pos + length > len(data):
+        raise HPACKError("Truncated string")
+    string = bytes(data[pos:pos + length])
+    if huffman:
+        string = huffmanDecode(string)
+    return string.decode("latin-1"), pos + length
+
+
+class HeaderTable(object):
+    """
+    Static and dynamic table. Index 1 to 61 address the static table,
+    the dynamic table follows with the newest entry first.
+    """
+
+    entryOverhead = 32
+
+    def __init__(self, maxSize = 4096):
+        self.maxSize = maxSize
+        self.size = 0
+        self.entries = collections.deque()
+
+    def __len__(self):
+        return len(STATIC_TABLE) + len(self.entries)
+
+    def get(self, index):
+        if 0 < index <= len(STATIC_TABLE):
+            return STATIC_TABLE[index - 1]
+        index -= len(STATIC_TABLE) + 1
+        if 0 <= index < len(self.entries):
+            return self.entries[index]
+        raise HPACKError("Invalid table index %s" % (index + len(STATIC_TABLE) + 1))
+
+    def add(self, name, value):
+        size = len(name) + len(value) + self.entryOverhead
+        self.entries.appendleft((name, value))
+        self.size += size
+        self.evict()
+
+    def resize(self, maxSize):
+        self.maxSize = maxSize
+        self.evict()
+
+    def evict(self):
+        while self.size > self.maxSize and self.entries:
+            name, value = self.entries.pop()
+            self.size -= len(name) + len(value) + self.entryOverhead
+
+    def search(self, name, value):
+        """
+        Returns (index, True) for an entry matching name and value,
+        (index, False) for one matching the name only or (None, False).
+        """
+        index = STATIC_INDEX.get((name, value))
+        if index:
+            return index, True
+        nameIndex = STATIC_NAME_INDEX.get(name)
+        for i, entry in enumerate(self.entries, len(STATIC_TABLE) + 1):
+            if entry[0] == name:
+                if entry[1] == value:
+                    return i, True
+                if nameIndex is None:
+                    nameIndex = i
+        return nameIndex, False
+
+
+class Encoder(object):
+    """
+    HPACK (RFC 7541) header block encoder.
+    Headers are added to the dynamic table except for sensitive ones,
+    which are sent as never-indexed literals. Names and values are str,
+    mapped to bytes as latin-1 like the HTTP/1.x request parser does.
+    """
+
+    sensitive = ("authorization", "cookie", "set-cookie", "proxy-authorization")
+
+    def __init__(self, maxTableSize = 4096):
+        self.table = HeaderTable(maxTableSize)
+        self.pendingSize = None
+
+    def setMaxTableSize(self, maxSize):
+        """The peer's SETTINGS_HEADER_TABLE_SIZE; announced in the next block."""
+        maxSize = min(maxSize, 4096)
+        if maxSize != self.table.maxSize:
+            self.table.resize(maxSize)
+            self.pendingSize = maxSize
+
+    def encode(self, headers):
+        block = bytearray()
+        if self.pendingSize is not None:
+            block += encodeInteger(self.pendingSize, 5, 0x20)
+            self.pendingSize = None
+        for name, value in headers:
+            name = name.lower()
+            index, exact = self.table.search(name, value)
+            if exact:
+                block += encodeInteger(index, 7, 0x80)
+                continue
+            if name in self.sensitive:
+                prefix = encodeInteger(index or 0, 4, 0x10)
+            else:
+                prefix = encodeInteger(index or 0, 6, 0x40)
+                self.table.add(name, value)
+            block += prefix
+            if not index:
+                block += encodeString(name)
+            block += encodeString(value)
+        return bytes(block)
+
+
+class Decoder(object):
+    """
+    Header block decoder. maxTableSize is the limit announced to the
+    peer in SETTINGS_HEADER_TABLE_SIZE.
+    """
+
+    def __init__(self, maxTableSize = 4096, maxHeaderListSize = 65536):
+        self.table = HeaderTable(maxTableSize)
+        self.maxTableSize = maxTableSize
+        self.maxHeaderListSize = maxHeaderListSize
+
+    def decode(self, block):
+        headers = []
+        listSize = 0
+        pos = 0
+        while pos < len(block):
+            octet = block[pos]
+            if octet & 0x80:
+                index, pos = decodeInteger(block, pos, 7)
+                name, value = self.table.get(index)
+            elif octet & 0xe0 == 0x20:
+                if headers:
+                    raise HPACKError("Table size update after header field")
+                size, pos = decodeInteger(block, pos, 5)
+                if size > self.maxTableSize:
+                    raise HPACKError("Table size %s exceeds limit" % size)
+                self.table.resize(size)
+                continue
+            else:
+                if octet & 0x40:
+                    prefixBits = 6
+                else:
+                    prefixBits = 4
+                index, pos = decodeInteger(block, pos, prefixBits)
+                if index:
+                    name = self.table.get(index)[0]
+                else:
+                    name, pos = decodeString(block, pos)
+                value, pos = decodeString(block, pos)
+                if octet & 0x40:
+                    self.table.add(name, value)
+            listSize += len(name) + len(value) + HeaderTable.entryOverhead
+            if listSize > self.maxHeaderListSize:
+                raise HPACKError("Header list too large")
+            headers.append((name, value))
+        return headers
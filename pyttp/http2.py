@@ -0,0 +1,820 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import socket
+import ssl
+import struct
+import sys
+import threading
+import time
+
+from pyttp import network
+from pyttp.core import *
+from pyttp.hpack import Encoder, Decoder, HPACKError
+from pyttp.network import ReadBuffer, WorkerPool, SocketExhausted
+from pyttp.wsgi import buildEnviron, requestContentLength
+
+
+PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+# frame types
+DATA = 0x0
+HEADERS = 0x1
+PRIORITY = 0x2
+RST_STREAM = 0x3
+SETTINGS = 0x4
+PUSH_PROMISE = 0x5
+PING = 0x6
+GOAWAY = 0x7
+WINDOW_UPDATE = 0x8
+CONTINUATION = 0x9
+
+# flags
+END_STREAM = 0x1
+ACK = 0x1
+END_HEADERS = 0x4
+PADDED = 0x8
+PRIORITY_FLAG = 0x20
+
+# settings
+SETTINGS_HEADER_TABLE_SIZE = 0x1
+SETTINGS_ENABLE_PUSH = 0x2
+SETTINGS_MAX_CONCURRENT_STREAMS = 0x3
+SETTINGS_INITIAL_WINDOW_SIZE = 0x4
+SETTINGS_MAX_FRAME_SIZE = 0x5
+SETTINGS_MAX_HEADER_LIST_SIZE = 0x6
+
+# error codes
+NO_ERROR = 0x0
+PROTOCOL_ERROR = 0x1
+INTERNAL_ERROR = 0x2
+FLOW_CONTROL_ERROR = 0x3
+STREAM_CLOSED = 0x5
+FRAME_SIZE_ERROR = 0x6
+REFUSED_STREAM = 0x7
+CANCEL = 0x8
+COMPRESSION_ERROR = 0x9
+
+DEFAULT_WINDOW_SIZE = 65535
+MAX_WINDOW_SIZE = 2 ** 31 - 1
+DEFAULT_FRAME_SIZE = 16384
+
+# connection-specific headers are not allowed in HTTP/2 (RFC 7540, 8.1.2.2)
+HOP_BY_HOP = ("connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade")
+
+
+class HTTP2Error(PyTTPException):
+    """
+    Protocol violation. A streamId other than 0 makes it a stream error,
+    which resets the stream only; otherwise the connection is closed.
+    """
+
+    def __init__(self, code, msg, streamId = 0):
+        self.code = code
+        self.msg = msg
+        self.streamId = streamId
+
+    def __str__(self):
+        return "HTTP2: %s (error code %s, stream %s)" % (self.msg, self.code, self.streamId)
+
+
+def packFrame(frameType, flags, streamId, payload = b''):
+    return struct.pack(">I", len(payload))[1:] + struct.pack(">BBI", frameType, flags, streamId) + payload
+
+
+def readFrame(readBuffer, maxFrameSize = DEFAULT_FRAME_SIZE):
+    """
+    Read one frame from readBuffer.
+    Returns frame type, flags, stream id and payload.
+    """
+    while len(readBuffer) < 9:
+        if not readBuffer.fill():
+            raise SocketExhausted
+    # nothing is consumed before the frame is complete, so a timeout may interrupt it
+    header = readBuffer.peek(9)
+    length = struct.unpack(">I", b'\0' + header[:3])[0]
+    frameType, flags, streamId = struct.unpack(">BBI", header[3:])
+    streamId &= 0x7fffffff
+    if length > maxFrameSize:
+        raise HTTP2Error(FRAME_SIZE_ERROR, "Frame of %s bytes" % length)
+    while len(readBuffer) < 9 + length:
+        if not readBuffer.fill():
+            raise SocketExhausted
+    readBuffer.read(9)
+    return frameType, flags, streamId, readBuffer.read(length)
+
+
+def stripPadding(flags, payload, streamId):
+    if flags & PADDED:
+        if not payload:
+            raise HTTP2Error(PROTOCOL_ERROR, "Missing pad length")
+        padLength = payload[0]
+        if padLength >= len(payload):
+            raise HTTP2Error(PROTOCOL_ERROR, "Padding exceeds frame")
+        return payload[1:len(payload) - padLength]
+    return payload
+
+
+def packSettings(settings):
+    return b''.join(struct.pack(">HI", key, value) for key, value in settings)
+
+
+def unpackSettings(payload):
+    if len(payload) % 6:
+        raise HTTP2Error(FRAME_SIZE_ERROR, "SETTINGS of %s bytes" % len(payload))
+    return [struct.unpack(">HI", payload[i:i + 6]) for i in range(0, len(payload), 6)]
+
+
+def isHTTP2(conn, readBuffer):
+    """
+    Whether the client speaks HTTP/2, either negotiated through ALPN or
+    with prior knowledge, i.e. starting with the connection preface.
+    """
+    if isinstance(conn, ssl.SSLSocket) and conn.selected_alpn_protocol() == "h2":
+        return True
+    while len(readBuffer) < len(PREFACE):
+        if not PREFACE.startswith(readBuffer.peek(len(PREFACE))):
+            return False
+        if not readBuffer.fill():
+            return False
+    return readBuffer.peek(len(PREFACE)) == PREFACE
+
+
+class HTTP2Stream(object):
+    """
+    A request stream of an HTTP2Connection. Serves as wsgi.input, too:
+    reads block until the client sent more DATA or ended the stream.
+    """
+
+    def __init__(self, connection, streamId, headers, sendWindow):
+        self.connection = connection
+        self.id = streamId
+        self.headers = headers
+        self.sendWindow = sendWindow
+        self.data = bytearray()
+        self.ended = False
+        self.reset = False
+        self.closed = False
+        self.unconsumed = 0
+
+    def feed(self, data, endStream):
+        with self.connection.condition:
+            self.data += data
+            self.unconsumed += len(data)
+            if endStream:
+                self.ended = True
+            self.connection.condition.notify_all()
+
+    def waitFor(self, test):
+        with self.connection.condition:
+            while not test() and not self.ended and not self.reset and not self.connection.closed:
+                self.connection.condition.wait()
+
+    def take(self, n):
+        """Remove up to n bytes from the buffer; called with the condition held."""
+        data = bytes(self.data[:n])
+        del self.data[:n]
+        self.unconsumed -= len(data)
+        return data
+
+    def read(self, n = -1):
+        if n is None or n < 0:
+            self.waitFor(lambda: False)
+            n = len(self.data)
+        else:
+            self.waitFor(lambda: len(self.data) >= n)
+        with self.connection.condition:
+            data = self.take(n)
+        self.connection.consumed(self, len(data))
+        return data
+
+    def readline(self, max_char = None):
+        def complete():
+            return b'\n' in self.data or max_char is not None and len(self.data) >= max_char
+        self.waitFor(complete)
+        with self.connection.condition:
+            end = self.data.find(b'\n') + 1 or len(self.data)
+            if max_char is not None and max_char >= 0:
+                end = min(end, max_char)
+            data = self.take(end)
+        self.connection.consumed(self, len(data))
+        return data
+
+    def readlines(self):
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+        return lines
+
+    def __iter__(self):
+        return iter(self.readlines())
+
+    def close(self):
+        pass
+
+
+class HTTP2Connection(object):
+    """
+    Server side of an HTTP/2 connection (RFC 7540).
+
+    The thread calling serve() reads and dispatches frames. Every request
+    stream runs the WSGI application in a thread of a shared WorkerPool,
+    so a slow response does not hold up the other streams. Responses are
+    written by the stream threads; HEADERS go out together with their
+    header block state, DATA frames wait for the connection and stream
+    send windows. Received data is acknowledged with WINDOW_UPDATE as the
+    application consumes it.
+    """
+
+    pool = None
+    poolLock = threading.Lock()
+    maxStreamThreads = 64
+
+    def __init__(self, app, conn, addr, port, readBuffer = None, logger = None, debug = None,
+                 maxConcurrentStreams = 100, initialWindowSize = 1048576, idleTimeout = 5.0):
+        self.app = app
+        self.conn = conn
+        self.addr = addr
+        self.port = port
+        self.readBuffer = readBuffer or ReadBuffer(conn)
+        self.logger = logger
+        self.debug = debug
+        self.maxConcurrentStreams = maxConcurrentStreams
+        self.initialWindowSize = initialWindowSize
+        self.idleTimeout = idleTimeout
+        if isinstance(conn, ssl.SSLSocket):
+            self.urlScheme = "https"
+        else:
+            self.urlScheme = "http"
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        self.streams = {}
+        self.lastStreamId = 0
+        self.condition = threading.Condition()
+        self.writeLock = threading.Lock()
+        self.sendWindow = DEFAULT_WINDOW_SIZE
+        self.peerWindowSize = DEFAULT_WINDOW_SIZE
+        self.peerFrameSize = DEFAULT_FRAME_SIZE
+        self.recvWindow = initialWindowSize
+        self.closed = False
+        self.goingAway = False
+
+    @classmethod
+    def getPool(cls):
+        with cls.poolLock:
+            if cls.pool is None:
+                cls.pool = WorkerPool(cls.runStream, 0, cls.maxStreamThreads)
+                cls.pool.start()
+            return cls.pool
+
+    def send(self, *frames):
+        with self.writeLock:
+            self.conn.sendall(b''.join(frames))
+
+    def serve(self):
+        self.conn.settimeout(self.idleTimeout)
+        try:
+            self.send(packFrame(SETTINGS, 0, 0, packSettings([
+                          (SETTINGS_MAX_CONCURRENT_STREAMS, self.maxConcurrentStreams),
+                          (SETTINGS_INITIAL_WINDOW_SIZE, self.initialWindowSize)])),
+                      packFrame(WINDOW_UPDATE, 0, 0,
+                                struct.pack(">I", self.initialWindowSize - DEFAULT_WINDOW_SIZE)))
+            while len(self.readBuffer) < len(PREFACE):
+                if not self.readBuffer.fill():
+                    raise SocketExhausted
+            if self.readBuffer.read(len(PREFACE)) != PREFACE:
+                raise HTTP2Error(PROTOCOL_ERROR, "Invalid connection preface")
+            frameType, flags, streamId, payload = readFrame(self.readBuffer)
+            if frameType != SETTINGS or flags & ACK:
+                raise HTTP2Error(PROTOCOL_ERROR, "Expected SETTINGS")
+            self.handleSettings(flags, payload)
+            while not (self.goingAway and not self.streams):
+                try:
+                    frame = readFrame(self.readBuffer)
+                except socket.timeout:
+                    if self.streams:
+                        continue
+                    self.goAway(NO_ERROR)
+                    break
+                self.handleFrame(*frame)
+        except HTTP2Error as e:
+            if self.logger:
+                self.logger.log("INFO", "%s:%s %s" % (self.addr[0], self.addr[1], e))
+            self.goAway(e.code)
+        except HPACKError as e:
+            self.goAway(COMPRESSION_ERROR)
+        except (socket.error, ssl.SSLError, SocketExhausted):
+            pass
+        finally:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+
+    def drain(self):
+        """Refuse new streams and close the connection once the active ones are done."""
+        self.goingAway = True
+        self.goAway(NO_ERROR)
+        with self.condition:
+            if not self.streams:
+                network.abortConnection(self.conn)
+
+    def goAway(self, code):
+        try:
+            self.send(packFrame(GOAWAY, 0, 0, struct.pack(">II", self.lastStreamId, code)))
+        except (socket.error, ssl.SSLError):
+            pass
+
+    def handleFrame(self, frameType, flags, streamId, payload):
+        if frameType == DATA:
+            self.handleData(flags, streamId, payload)
+        elif frameType == HEADERS:
+            self.handleHeaders(flags, streamId, payload)
+        elif frameType == SETTINGS:
+            if streamId:
+                raise HTTP2Error(PROTOCOL_ERROR, "SETTINGS on a stream")
+            self.handleSettings(flags, payload)
+        elif frameType == WINDOW_UPDATE:
+            self.handleWindowUpdate(streamId, payload)
+        elif frameType == PING:
+            if streamId or len(payload) != 8:
+                raise HTTP2Error(PROTOCOL_ERROR, "Invalid PING")
+            if not flags & ACK:
+                self.send(packFrame(PING, ACK, 0, payload))
+        elif frameType == RST_STREAM:
+            if not streamId or len(payload) != 4:
+                raise HTTP2Error(PROTOCOL_ERROR, "Invalid RST_STREAM")
+            with self.condition:
+                stream = self.streams.get(streamId)
+                if stream is not None:
+                    stream.reset = True
+                    self.condition.notify_all()
+        elif frameType == GOAWAY:
+            self.goingAway = True
+        elif frameType in (PUSH_PROMISE, CONTINUATION):
+            raise HTTP2Error(PROTOCOL_ERROR, "Unexpected frame type %s" % frameType)
+        elif frameType == PRIORITY:
+            if not streamId or len(payload) != 5:
+                raise HTTP2Error(PROTOCOL_ERROR, "Invalid PRIORITY")
+        # unknown frame types are ignored
+
+    def handleSettings(self, flags, payload):
+        if flags & ACK:
+            return
+        with self.condition:
+            for key, value in unpackSettings(payload):
+                if key == SETTINGS_INITIAL_WINDOW_SIZE:
+                    if value > MAX_WINDOW_SIZE:
+                        raise HTTP2Error(FLOW_CONTROL_ERROR, "Initial window size %s" % value)
+                    delta = value - self.peerWindowSize
+                    self.peerWindowSize = value
+                    for stream in self.streams.values():
+                        stream.sendWindow += delta
+                elif key == SETTINGS_MAX_FRAME_SIZE:
+                    if not DEFAULT_FRAME_SIZE <= value <= 16777215:
+                        raise HTTP2Error(PROTOCOL_ERROR, "Max frame size %s" % value)
+                    self.peerFrameSize = value
+                elif key == SETTINGS_HEADER_TABLE_SIZE:
+                    with self.writeLock:
+                        self.encoder.setMaxTableSize(value)
+            self.condition.notify_all()
+        self.send(packFrame(SETTINGS, ACK, 0))
+
+    def handleWindowUpdate(self, streamId, payload):
+        if len(payload) != 4:
+            raise HTTP2Error(FRAME_SIZE_ERROR, "Invalid WINDOW_UPDATE")
+        increment = struct.unpack(">I", payload)[0] & 0x7fffffff
+        resetCode = None
+        with self.condition:
+            if not streamId:
+                if not increment:
+                    raise HTTP2Error(PROTOCOL_ERROR, "Window increment of 0")
+                self.sendWindow += increment
+                if self.sendWindow > MAX_WINDOW_SIZE:
+                    raise HTTP2Error(FLOW_CONTROL_ERROR, "Connection window overflow")
+            else:
+                stream = self.streams.get(streamId)
+                if stream is not None:
+                    stream.sendWindow += increment
+                    if not increment or stream.sendWindow > MAX_WINDOW_SIZE:
+                        stream.reset = True
+                        resetCode = PROTOCOL_ERROR if not increment else FLOW_CONTROL_ERROR
+            self.condition.notify_all()
+        if resetCode is not None:
+            self.resetStream(streamId, resetCode)
+
+    def readHeaderBlock(self, flags, streamId, payload):
+        """Payload of HEADERS plus the CONTINUATION frames following it."""
+        payload = stripPadding(flags, payload, streamId)
+        if flags & PRIORITY_FLAG:
+            payload = payload[5:]
+        block = bytearray(payload)
+        while not flags & END_HEADERS:
+            frameType, flags, continued, payload = readFrame(self.readBuffer)
+            if frameType != CONTINUATION or continued != streamId:
+                raise HTTP2Error(PROTOCOL_ERROR, "Expected CONTINUATION")
+            block += payload
+            if len(block) > 65536:
+                raise HTTP2Error(PROTOCOL_ERROR, "Header block too large")
+        return bytes(block)
+
+    def handleHeaders(self, flags, streamId, payload):
+        if not streamId or not streamId % 2:
+            raise HTTP2Error(PROTOCOL_ERROR, "Invalid stream id %s" % streamId)
+        block = self.readHeaderBlock(flags, streamId, payload)
+        # the block has to be decoded in any case to keep the table in sync
+        headers = self.decoder.decode(block)
+        with self.condition:
+            stream = self.streams.get(streamId)
+            if stream is not None:
+                # trailers; only the end of the stream matters
+                if not flags & END_STREAM:
+                    raise HTTP2Error(PROTOCOL_ERROR, "Trailers without END_STREAM")
+                stream.feed(b'', True)
+                return
+            if streamId <= self.lastStreamId:
+                raise HTTP2Error(STREAM_CLOSED, "Stream %s was closed" % streamId)
+            self.lastStreamId = streamId
+            refused = self.goingAway or len(self.streams) >= self.maxConcurrentStreams
+            if not refused:
+                stream = HTTP2Stream(self, streamId, headers, self.peerWindowSize)
+                stream.ended = bool(flags & END_STREAM)
+                self.streams[streamId] = stream
+        if refused:
+            self.resetStream(streamId, REFUSED_STREAM)
+            return
+        self.getPool().put((self, stream))
+
+    def handleData(self, flags, streamId, payload):
+        size = len(payload)
+        with self.condition:
+            if size > self.recvWindow:
+                raise HTTP2Error(FLOW_CONTROL_ERROR, "Connection window exceeded")
+            self.recvWindow -= size
+            stream = self.streams.get(streamId)
+            discarded = stream is None or stream.ended
+        if discarded:
+            # nobody is going to consume the data
+            self.creditWindow(0, size)
+            if not streamId or streamId > self.lastStreamId:
+                raise HTTP2Error(PROTOCOL_ERROR, "DATA on idle stream %s" % streamId)
+            if stream is not None:
+                self.resetStream(streamId, STREAM_CLOSED)
+            # otherwise the data was in flight when the stream was closed
+            return
+        data = stripPadding(flags, payload, streamId)
+        if size > len(data):
+            # padding counts against the window, but is never consumed
+            self.creditWindow(0, size - len(data))
+        stream.feed(data, flags & END_STREAM)
+
+    def creditWindow(self, streamId, size):
+        """
+        Send WINDOW_UPDATE for size bytes. Not to be called with the
+        condition held: the send may block on a slow peer, and the
+        frame reader and the other streams need the condition meanwhile.
+        """
+        if size:
+            if not streamId:
+                with self.condition:
+                    self.recvWindow += size
+            self.send(packFrame(WINDOW_UPDATE, 0, streamId, struct.pack(">I", size)))
+
+    def consumed(self, stream, size):
+        """Called once the application read size bytes of stream."""
+        self.creditWindow(0, size)
+        if not stream.ended:
+            self.creditWindow(stream.id, size)
+
+    def resetStream(self, streamId, code):
+        self.send(packFrame(RST_STREAM, 0, streamId, struct.pack(">I", code)))
+
+    def sendHeaders(self, stream, headers, endStream):
+        with self.writeLock:
+            block = self.encoder.encode(headers)
+            frames = []
+            first = True
+            while first or block:
+                piece, block = block[:self.peerFrameSize], block[self.peerFrameSize:]
+                flags = 0
+                if not block:
+                    flags |= END_HEADERS
+                if first:
+                    if endStream:
+                        flags |= END_STREAM
+                    frames.append(packFrame(HEADERS, flags, stream.id, piece))
+                else:
+                    frames.append(packFrame(CONTINUATION, flags, stream.id, piece))
+                first = False
+            self.conn.sendall(b''.join(frames))
+
+    def sendData(self, stream, data, endStream = False):
+        data = memoryview(data)
+        while True:
+            with self.condition:
+                while (data and (self.sendWindow <= 0 or stream.sendWindow <= 0)
+                       and not stream.reset and not self.closed):
+                    self.condition.wait()
+                if stream.reset or self.closed:
+                    raise SocketExhausted
+                size = min(len(data), self.sendWindow, stream.sendWindow, self.peerFrameSize)
+                self.sendWindow -= size
+                stream.sendWindow -= size
+            piece, data = data[:size], data[size:]
+            last = not data
+            self.send(packFrame(DATA, END_STREAM if last and endStream else 0, stream.id, piece))
+            if last:
+                return
+
+    def runStream(self, stream):
+        """Serve a request stream; runs in a pool thread."""
+        status = [None, None]
+        prePayload = []
+        def start_response(statusLine, headers, exc_info = None):
+            status[0] = statusLine
+            status[1] = headers
+            return prePayload.append
+        payload = None
+        headersSent = False
+        try:
+            environ = self.buildEnviron(stream)
+            payload = self.app(environ, start_response)
+            chunks = iter(payload)
+            # start_response has been called once the first chunk is there
+            first = next(chunks, None)
+            headers, sendBody = self.responseHeaders(stream, status[0], status[1])
+            pending = b''.join(map(self.toBytes, prePayload))
+            if first is not None:
+                pending += self.toBytes(first)
+            complete = isinstance(payload, (list, tuple))
+            if complete:
+                pending += b''.join(self.toBytes(chunk) for chunk in chunks)
+                if not any(name == "content-length" for name, value in headers):
+                    headers.append(("content-length", str(len(pending))))
+            endStream = not sendBody or (complete and not pending)
+            self.sendHeaders(stream, headers, endStream)
+            headersSent = True
+            if not endStream:
+                for chunk in chunks:
+                    chunk = self.toBytes(chunk)
+                    if chunk:
+                        if pending:
+                            self.sendData(stream, pending)
+                        pending = chunk
+                self.sendData(stream, pending, True)
+        except HTTP2Error as e:
+            self.resetStream(stream.id, e.code)
+        except (socket.error, ssl.SSLError, SocketExhausted):
+            pass
+        except Exception:
+            import traceback
+            formatted_exception = ''.join(traceback.format_exception(*sys.exc_info()))
+            if self.debug:
+                print("[DEBUG]:", formatted_exception)
+            if self.logger:
+                self.logger.log("EXC", formatted_exception)
+            try:
+                if headersSent:
+                    self.resetStream(stream.id, INTERNAL_ERROR)
+                else:
+                    self.sendHeaders(stream, [(":status", "500"), ("content-length", "0")], True)
+            except (socket.error, ssl.SSLError):
+                pass
+        finally:
+            if hasattr(payload, "close"):
+                payload.close()
+            self.closeStream(stream)
+
+    def closeStream(self, stream):
+        with self.condition:
+            self.streams.pop(stream.id, None)
+            unconsumed = stream.unconsumed
+            stream.unconsumed = 0
+            ended = stream.ended
+            if self.goingAway and not self.streams:
+                # wake up the reader to close the connection
+                network.abortConnection(self.conn)
+            self.condition.notify_all()
+        try:
+            # data the application did not read still counts against the connection window
+            self.creditWindow(0, unconsumed)
+            if not ended and not stream.reset:
+                # tell the client to stop sending the body nobody is going to read
+                self.resetStream(stream.id, NO_ERROR)
+        except (socket.error, ssl.SSLError):
+            pass
+
+    def buildEnviron(self, stream):
+        pseudo = {}
+        headers = []
+        for name, value in stream.headers:
+            if name.startswith(":"):
+                if headers or name in pseudo:
+                    raise HTTP2Error(PROTOCOL_ERROR, "Misplaced pseudo-header %s" % name, stream.id)
+                pseudo[name] = value
+            elif name in HOP_BY_HOP or name != name.lower():
+                raise HTTP2Error(PROTOCOL_ERROR, "Invalid header %s" % name, stream.id)
+            else:
+                headers.append(Header(name, value))
+        if not all(name in pseudo for name in (":method", ":scheme", ":path")):
+            raise HTTP2Error(PROTOCOL_ERROR, "Missing pseudo-header", stream.id)
+        if ":authority" in pseudo and not any(header.name == "host" for header in headers):
+            headers.append(Header("host", pseudo[":authority"]))
+        cookies = [header.value for header in headers if header.name == "cookie"]
+        if len(cookies) > 1:
+            headers = [header for header in headers if header.name != "cookie"]
+            headers.append(Header("cookie", "; ".join(cookies)))
+        req = Request(Type(pseudo[":method"], pseudo[":path"], "HTTP/1.1"), headers)
+        req.type.version = "2"
+        environ = buildEnviron(req, self.addr, self.port, self.urlScheme)
+        environ['pyttp.start_time'] = time.time()
+        requestContentLength(environ)
+        environ['wsgi.input'] = stream
+        environ['wsgi.errors'] = self.logger
+        return environ
+
+    def responseHeaders(self, stream, statusLine, appHeaders):
+        try:
+            code = int(statusLine[:3])
+        except (TypeError, ValueError):
+            code = 200
+        headers = [(":status", str(code)), ("server", "PyTTP/0.0.1")]
+        for name, value in appHeaders or []:
+            name = name.lower()
+            if name not in HOP_BY_HOP:
+                headers.append((name, value))
+        method = dict(stream.headers).get(":method")
+        sendBody = code >= 200 and code not in (204, 304) and method != "HEAD"
+        return headers, sendBody
+
+    def toBytes(self, chunk):
+        if isinstance(chunk, str):
+            return chunk.encode()
+        return chunk
+
+
+class HTTP2Client(object):
+    """
+    Minimal HTTP/2 client for testing servers locally. Several requests
+    may be sent before any response is read; their streams are served
+    concurrently by the server.
+
+        client = HTTP2Client("localhost", 8080)
+        ids = [client.request("GET", path) for path in ("/a", "/b")]
+        status, headers, body = client.getResponse(ids[0])
+
+    With useSSL, "h2" is negotiated through ALPN; otherwise the client
+    relies on prior knowledge of the server supporting h2c.
+    """
+
+    def __init__(self, host, port, useSSL = False, timeout = 10.0, verify = False):
+        self.host = host
+        self.port = port
+        conn = socket.create_connection((host, port), timeout)
+        if useSSL:
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            context.set_alpn_protocols(["h2"])
+            conn = context.wrap_socket(conn, server_hostname = host)
+            if conn.selected_alpn_protocol() != "h2":
+                conn.close()
+                raise HTTP2Error(PROTOCOL_ERROR, "Server did not negotiate h2")
+            self.scheme = "https"
+        else:
+            self.scheme = "http"
+        self.conn = conn
+        self.readBuffer = ReadBuffer(conn)
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        self.nextStreamId = 1
+        self.responses = {}
+        self.sendWindow = DEFAULT_WINDOW_SIZE
+        self.streamWindows = {}
+        self.peerWindowSize = DEFAULT_WINDOW_SIZE
+        self.peerFrameSize = DEFAULT_FRAME_SIZE
+        conn.sendall(PREFACE + packFrame(SETTINGS, 0, 0, packSettings([(SETTINGS_ENABLE_PUSH, 0)])))
+
+    def request(self, method, path, headers = None, body = b''):
+        """Send a request; returns its stream id."""
+        streamId = self.nextStreamId
+        self.nextStreamId += 2
+        block = self.encoder.encode([(":method", method), (":scheme", self.scheme),
+                                     (":authority", "%s:%s" % (self.host, self.port)), (":path", path)]
+                                    + [(name.lower(), value) for name, value in headers or []])
+        flags = END_HEADERS
+        if not body:
+            flags |= END_STREAM
+        self.responses[streamId] = {"status": None, "headers": [], "body": bytearray(), "done": False}
+        self.streamWindows[streamId] = self.peerWindowSize
+        self.conn.sendall(packFrame(HEADERS, flags, streamId, block))
+        body = memoryview(body)
+        while body:
+            while min(self.sendWindow, self.streamWindows[streamId]) <= 0:
+                self.handleFrame(*readFrame(self.readBuffer, 16777215))
+            size = min(len(body), self.sendWindow, self.streamWindows[streamId], self.peerFrameSize)
+            self.sendWindow -= size
+            self.streamWindows[streamId] -= size
+            piece, body = body[:size], body[size:]
+            self.conn.sendall(packFrame(DATA, 0 if body else END_STREAM, streamId, piece.tobytes()))
+        return streamId
+
+    def getResponse(self, streamId):
+        """Wait for the response on a stream; returns status, headers and body."""
+        response = self.responses[streamId]
+        while not response["done"]:
+            self.handleFrame(*readFrame(self.readBuffer, 16777215))
+        del self.responses[streamId]
+        return response["status"], response["headers"], bytes(response["body"])
+
+    def get(self, *paths):
+        """Fetch paths concurrently; returns a response per path."""
+        ids = [self.request("GET", path) for path in paths]
+        return [self.getResponse(streamId) for streamId in ids]
+
+    def handleFrame(self, frameType, flags, streamId, payload):
+        response = self.responses.get(streamId)
+        if frameType == SETTINGS and not flags & ACK:
+            for key, value in unpackSettings(payload):
+                if key == SETTINGS_INITIAL_WINDOW_SIZE:
+                    for other in self.streamWindows:
+                        self.streamWindows[other] += value - self.peerWindowSize
+                    self.peerWindowSize = value
+                elif key == SETTINGS_MAX_FRAME_SIZE:
+                    self.peerFrameSize = value
+                elif key == SETTINGS_HEADER_TABLE_SIZE:
+                    self.encoder.setMaxTableSize(value)
+            self.conn.sendall(packFrame(SETTINGS, ACK, 0))
+        elif frameType == PING and not flags & ACK:
+            self.conn.sendall(packFrame(PING, ACK, 0, payload))
+        elif frameType == WINDOW_UPDATE:
+            increment = struct.unpack(">I", payload)[0] & 0x7fffffff
+            if streamId:
+                if streamId in self.streamWindows:
+                    self.streamWindows[streamId] += increment
+            else:
+                self.sendWindow += increment
+        elif frameType == HEADERS:
+            block = bytearray(stripPadding(flags, payload, streamId)[5 if flags & PRIORITY_FLAG else 0:])
+            while not flags & END_HEADERS:
+                frameType, flags, continued, payload = readFrame(self.readBuffer, 16777215)
+                block += payload
+            headers = self.decoder.decode(bytes(block))
+            if response is not None:
+                if response["status"] is None:
+                    response["status"] = int(dict(headers)[":status"])
+                response["headers"] += [(name, value) for name, value in headers if not name.startswith(":")]
+                if flags & END_STREAM:
+                    response["done"] = True
+        elif frameType == DATA:
+            data = stripPadding(flags, payload, streamId)
+            if payload:
+                self.conn.sendall(packFrame(WINDOW_UPDATE, 0, 0, struct.pack(">I", len(payload))) +
+                                  packFrame(WINDOW_UPDATE, 0, streamId, struct.pack(">I", len(payload))))
+            if response is not None:
+                response["body"] += data
+                if flags & END_STREAM:
+                    response["done"] = True
+        elif frameType == RST_STREAM:
+            code = struct.unpack(">I", payload)[0]
+            if response is not None and not response["done"]:
+                if code == NO_ERROR and response["status"] is not None:
+                    response["done"] = True
+                else:
+                    raise HTTP2Error(code, "Stream reset by server", streamId)
+        elif frameType == GOAWAY:
+            lastStreamId, code = struct.unpack(">II", payload[:8])
+            for other, pending in self.responses.items():
+                if other > lastStreamId and not pending["done"]:
+                    raise HTTP2Error(code, "Connection closed by server", other)
+
+    def close(self):
+        try:
+            self.conn.sendall(packFrame(GOAWAY, 0, 0, struct.pack(">II", 0, NO_ERROR)))
+        except socket.error:
+            pass
+        self.conn.close()
+
+
+if __name__ == "__main__":
+
+    try:
+        from urllib.parse import urlsplit
+    except ImportError:
+        from urlparse import urlsplit
+
+    urls = [urlsplit(url) for url in sys.argv[1:]]
+    if not urls:
+        print("Usage: python -m pyttp.http2 URL [URL ...]")
+        sys.exit(1)
+    first = urls[0]
+    useSSL = first.scheme == "https"
+    client = HTTP2Client(first.hostname, first.port or (443 if useSSL else 80), useSSL)
+    start = time.time()
+    paths = [(url.path or "/") + ("?" + url.query if url.query else "") for url in urls]
+    for path, (status, headers, body) in zip(paths, client.get(*paths)):
+        print(status, path, "%s bytes" % len(body))
+    print("%.1f ms" % ((time.time() - start) * 1000.))
+    client.close()
@@ -11,8 +11,453 @@ try:
 except ImportError:
     import queue as Queue
 import threading
+import heapq
 
+import selectors
 import ssl
+import mmap
+import os
+import stat
+import signal
+import errno
+from pyttp.timers import TimerWheel
+
+class SocketExhausted(Exception):
+    pass
+
+
+class BufferLimitExceeded(PyTTPException):
+    pass
+
+
+class ReadBuffer(object):
+    """
+    Per-connection receive buffer.
+
+    Data is received in large blocks into a bytearray; a read cursor marks
+    how much of it has been consumed already. Consumed bytes are discarded
+    lazily when the buffer is filled again.
+    """
+
+    blockSize = 65536
+
+    def __init__(self, sock, data = b''):
+        self.sock = sock
+        self.buf = bytearray(data)
+        self.pos = 0
+        self.detached = False
+
+    def __len__(self):
+        return len(self.buf) - self.pos
+
+    def fill(self):
+        """
+        Receive one block from the socket.
+        Returns the number of bytes received; 0 means the peer closed
+        the connection.
+        """
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+        data = self.sock.recv(self.blockSize)
+        self.buf += data
+        return len(data)
+
+    def find(self, sep, start = 0):
+        index = self.buf.find(sep, self.pos + start)
+        if index < 0:
+            return index
+        return index - self.pos
+
+    def detach(self):
+        """
+        Hand the connection over to a new owner: the listener serving
+        it neither closes it nor reads from it once the handler returned.
+        """
+        self.detached = True
+
+    def peek(self, n):
+        """Return up to n buffered bytes without consuming them."""
+        return bytes(self.buf[self.pos:self.pos + n])
+
+    def read(self, n = -1):
+        """Return up to n buffered bytes without touching the socket."""
+        if n < 0:
+            end = len(self.buf)
+        else:
+            end = min(self.pos + n, len(self.buf))
+        with memoryview(self.buf) as view:
+            data = bytes(view[self.pos:end])
+        self.pos = end
+        return data
+
+    def readInto(self, view):
+        """Move up to len(view) buffered bytes into view; returns how many."""
+        n = min(len(view), len(self))
+        with memoryview(self.buf) as source:
+            view[:n] = source[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def receiveInto(self, view):
+        """
+        Receive from the socket straight into view, bypassing the buffer,
+        which has to be empty. Returns 0 if the peer closed the connection.
+        """
+        return self.sock.recv_into(view)
+
+    def feed(self, parser):
+        """
+        Feed the buffered data to an incremental parser and consume
+        what it parsed. Returns True once the parser is done.
+        """
+        self.pos += parser.feed(self.buf, self.pos)
+        return parser.done
+
+    def readUntil(self, sep, maxSize = None):
+        """
+        Return everything up to and including sep, receiving more data
+        from the socket as needed.
+        """
+        start = 0
+        while True:
+            index = self.find(sep, start)
+            if index >= 0:
+                return self.read(index + len(sep))
+            if maxSize is not None and len(self) > maxSize:
+                raise BufferLimitExceeded(maxSize)
+            start = max(0, len(self) - len(sep) + 1)
+            if not self.fill():
+                raise SocketExhausted
+
+
+def tuneSocket(conn):
+    """
+    Disable Nagle's algorithm on an accepted connection. Responses are
+    written in as few sends as possible, so the last segment should go
+    out immediately instead of waiting for the client's delayed ACK.
+    """
+    try:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+
+def abortConnection(conn):
+    """
+    Shut a connection down from another thread: reads blocked on it
+    return EOF, so the thread serving it is released right away.
+    """
+    try:
+        # bypass SSLSocket.shutdown which would tear down the TLS state
+        # under the feet of the reading thread
+        socket.socket.shutdown(conn, socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def setCork(conn, cork):
+    """Hold back partial frames while corked (Linux only)."""
+    if hasattr(socket, "TCP_CORK") and not isinstance(conn, ssl.SSLSocket):
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(cork))
+        except OSError:
+            pass
+
+
+IOV_MAX = 1024
+
+def sendBuffers(conn, buffers, nonBlocking = False):
+    """
+    Send a list of buffers with vectored sendmsg() calls, falling
+    back to a single sendall() where sendmsg() is not available.
+    With nonBlocking, sending stops as soon as the socket would block
+    and the unsent rest of the buffers is returned.
+    """
+    if isinstance(conn, ssl.SSLSocket) and nonBlocking:
+        return sendSSLNonBlocking(conn, b''.join(buffers))
+    if isinstance(conn, ssl.SSLSocket) or not hasattr(conn, "sendmsg"):
+        conn.sendall(b''.join(buffers))
+        return []
+    views = [memoryview(buf) for buf in buffers if len(buf)]
+    while views:
+        try:
+            if nonBlocking:
+                sent = conn.sendmsg(views[:IOV_MAX], [], socket.MSG_DONTWAIT)
+            else:
+                sent = conn.sendmsg(views[:IOV_MAX])
+        except BlockingIOError:
+            break
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+    return views
+
+
+def sendSSLNonBlocking(conn, data):
+    """
+    Send data on a TLS connection without waiting for the peer and
+    return what is left unsent. A write that would block has to be
+    retried starting with the same bytes, so the rest stays one piece.
+    """
+    timeout = conn.gettimeout()
+    conn.settimeout(0.0)
+    view = memoryview(data)
+    try:
+        while view:
+            try:
+                sent = conn.send(view)
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+                break
+            view = view[sent:]
+    finally:
+        conn.settimeout(timeout)
+    if view:
+        return [view]
+    return []
+
+
+class MappedFile(object):
+    """
+    Read-only memory mapping of a file, shared by all its senders.
+
+    acquire() returns the mapping of the current version of an open file,
+    creating it on first use; every acquire() is paired with a release().
+    Concurrent downloads of a file thus share the page cache pages it
+    lives in, and slices of view go to the socket without read buffers.
+    A mapping is unmapped once released and no slice of it is left.
+
+    Mapped files must not be truncated in place (replace them by renaming
+    a new version over them): touching pages beyond the new end of file
+    kills the process with SIGBUS.
+    """
+
+    mappings = {}
+    lock = threading.Lock()
+
+    def __init__(self, key, fileno, size):
+        self.key = key
+        self.size = size
+        self.view = memoryview(mmap.mmap(fileno, size, access = mmap.ACCESS_READ))
+        self.refs = 0
+
+    @classmethod
+    def acquire(cls, fileno):
+        info = os.fstat(fileno)
+        if not stat.S_ISREG(info.st_mode) or not info.st_size:
+            raise ValueError("Only non-empty regular files can be mapped")
+        key = (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+        with cls.lock:
+            mapping = cls.mappings.get(key)
+            if mapping is None:
+                mapping = cls.mappings[key] = MappedFile(key, fileno, info.st_size)
+            mapping.refs += 1
+        return mapping
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            if not self.refs and self.mappings.get(self.key) is self:
+                del self.mappings[self.key]
+
+
+def fileChunks(filelike, length, blockSize = 65536, mmapThreshold = 262144):
+    """
+    Yield up to length bytes of filelike from its current position on.
+    For at least mmapThreshold bytes of a regular file these are
+    memoryview slices of its MappedFile, otherwise blocks read from it.
+    """
+    mapping = None
+    if length >= mmapThreshold:
+        try:
+            mapping = MappedFile.acquire(filelike.fileno())
+        except (AttributeError, ValueError, OSError):
+            mapping = None
+    if mapping is None:
+        while length > 0:
+            data = filelike.read(min(blockSize, length))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+        return
+    try:
+        position = filelike.tell()
+        end = min(position + length, mapping.size)
+        while position < end:
+            piece = mapping.view[position:min(position + blockSize, end)]
+            position += len(piece)
+            filelike.seek(position)
+            yield piece
+    finally:
+        mapping.release()
+
+
+class DelayedFlusher(threading.Thread):
+    """
+    Background thread flushing WriteBuffers whose flush deadline passed.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.condition = threading.Condition()
+        self.scheduled = []
+        self.counter = 0
+
+    def schedule(self, writeBuffer, deadline):
+        with self.condition:
+            self.counter += 1
+            heapq.heappush(self.scheduled, (deadline, self.counter, writeBuffer))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.scheduled:
+                    self.condition.wait()
+                deadline, _, writeBuffer = self.scheduled[0]
+                delay = deadline - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.scheduled)
+            writeBuffer.flushScheduled()
+
+
+class WriteBuffer(object):
+    """
+    Coalesces small writes on a connection.
+
+    Written pieces are collected and go out in one vectored send once
+    bufferSize bytes are pending or flushDelay seconds after the first
+    piece was buffered, whichever comes first. A piece of bufferSize
+    bytes or more is sent right away together with what is pending, so
+    large streamed content keeps the low-latency path.
+    """
+
+    flusher = None
+    flusherLock = threading.Lock()
+
+    def __init__(self, conn, bufferSize = 16384, flushDelay = 0.02):
+        self.conn = conn
+        self.bufferSize = bufferSize
+        self.flushDelay = flushDelay
+        self.pieces = []
+        self.pending = 0
+        self.scheduled = False
+        self.error = None
+        self.lock = threading.Lock()
+
+    def write(self, *pieces):
+        with self.lock:
+            if self.error:
+                raise self.error
+            for piece in pieces:
+                if piece:
+                    self.pieces.append(piece)
+                    self.pending += len(piece)
+            if self.pending >= self.bufferSize:
+                self._flush()
+            elif self.pending and not self.scheduled and self.flushDelay:
+                self.scheduled = True
+                self.getFlusher().schedule(self, time.time() + self.flushDelay)
+
+    def flush(self):
+        with self.lock:
+            if self.error:
+                raise self.error
+            self._flush()
+
+    def flushScheduled(self):
+        # called by the flusher thread which must not block on a slow
+        # client; whatever does not fit is sent by the next write or flush
+        if not self.lock.acquire(False):
+            # held by a write or flush which may be blocked sending
+            self.getFlusher().schedule(self, time.time() + self.flushDelay)
+            return
+        try:
+            self.scheduled = False
+            if not self.pieces:
+                return
+            try:
+                self.pieces = sendBuffers(self.conn, self.pieces, nonBlocking = True)
+            except Exception as e:
+                self.pieces = []
+                self.error = e
+            self.pending = sum(len(piece) for piece in self.pieces)
+        finally:
+            self.lock.release()
+
+    def _flush(self):
+        self.scheduled = False
+        if self.pieces:
+            pieces = self.pieces
+            self.pieces = []
+            self.pending = 0
+            sendBuffers(self.conn, pieces)
+
+    @classmethod
+    def getFlusher(cls):
+        with cls.flusherLock:
+            if cls.flusher is None:
+                cls.flusher = DelayedFlusher()
+                cls.flusher.start()
+            return cls.flusher
+
+
+LISTEN_FD_VARIABLE = "PYTTP_LISTEN_FD"
+
+
+def inheritedListenSocket():
+    """
+    The listening socket handed over through PYTTP_LISTEN_FD, or None.
+    The variable is removed, the caller owns the socket.
+    """
+    inherited = os.environ.pop(LISTEN_FD_VARIABLE, None)
+    if inherited is None:
+        return None
+    listenSocket = socket.socket(fileno = int(inherited))
+    listenSocket.set_inheritable(False)
+    return listenSocket
+
+
+def openListenSocket(port, reusePort = False, backlog = 128, bindTimeout = 30.0):
+    """
+    Open the listening socket on port.
+    A socket handed over by a previous instance of the program through
+    the environment variable PYTTP_LISTEN_FD is adopted instead, unless
+    every process binds its own with reusePort; it is closed then. While
+    the port is still in use, binding is retried for bindTimeout seconds.
+    """
+    inherited = inheritedListenSocket()
+    if inherited is not None:
+        if not reusePort:
+            print("Using inherited listening socket for port {}.".format(port))
+            return inherited
+        # it would keep queueing connections nobody accepts
+        inherited.close()
+    listenSocket = socket.socket()
+    listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reusePort:
+        listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    print("Binding to port {} ...".format(port))
+    giveUp = time.time() + bindTimeout
+    while True:
+        try:
+            listenSocket.bind(('', port))
+            break
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE or time.time() > giveUp:
+                listenSocket.close()
+                raise
+            time.sleep(0.5)
+    print(" succesful.")
+    listenSocket.listen(backlog)
+    return listenSocket
+
 
 class HTTPListener(object):
     
@@ -166,9 +611,168 @@ class ParallelSocketListener(object):
 
         
 
+class WorkerPool(object):
+    """
+    Elastic pool of worker threads calling work(*item) for queued items.
+
+    The pool keeps at least minThreads threads. A thread is added whenever
+    an item is queued while fewer threads are idle than items are waiting,
+    up to maxThreads. Threads idle for longer than idleTimeout seconds exit
+    again as long as more than minThreads are left.
+
+    With maxQueue, put() refuses items while maxQueue items are waiting.
+    With maxWait, items which waited longer than maxWait seconds are not
+    worked on anymore. Both kinds of items are passed to shed(*item)
+    instead and counted in shedFull and shedExpired.
+
+    queueDepth, busyWorkers and threadCount serve as gauges.
+    """
+
+    def __init__(self, work, minThreads = 1, maxThreads = 32, idleTimeout = 30.0,
+                 maxQueue = None, maxWait = None, shed = None):
+        self.work = work
+        self.maxThreads = max(1, maxThreads)
+        self.minThreads = max(0, min(minThreads, self.maxThreads))
+        self.idleTimeout = idleTimeout
+        self.maxWait = maxWait
+        self.shed = shed
+        self.queue = Queue.Queue(maxQueue or 0)
+        self.lock = threading.Lock()
+        self.threads = set()
+        self.idleWorkers = 0
+        self.busyWorkers = 0
+        self.spawned = 0
+        self.shedFull = 0
+        self.shedExpired = 0
+
+    @property
+    def queueDepth(self):
+        return self.queue.qsize()
+
+    @property
+    def threadCount(self):
+        return len(self.threads)
+
+    def stats(self):
+        with self.lock:
+            return {"threads": len(self.threads),
+                    "busy": self.busyWorkers,
+                    "idle": self.idleWorkers,
+                    "queued": self.queue.qsize(),
+                    "shedFull": self.shedFull,
+                    "shedExpired": self.shedExpired}
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.minThreads:
+                self.spawn()
+
+    def spawn(self):
+        # needs self.lock
+        self.spawned += 1
+        thread = threading.Thread(target=self.run, name="Worker-%s" % self.spawned)
+        thread.daemon = True
+        self.threads.add(thread)
+        thread.start()
+
+    def put(self, item):
+        """Queue item; returns False if it was shed because the queue is full."""
+        try:
+            self.queue.put_nowait((item, time.time()))
+        except Queue.Full:
+            with self.lock:
+                self.shedFull += 1
+            self.shedItem(item)
+            return False
+        with self.lock:
+            if self.idleWorkers < self.queue.qsize() and len(self.threads) < self.maxThreads:
+                self.spawn()
+        return True
+
+    def shedItem(self, item):
+        if self.shed is not None:
+            try:
+                self.shed(*item)
+            except Exception as e:
+                print(e)
+
+    def run(self):
+        me = threading.current_thread()
+        while True:
+            with self.lock:
+                self.idleWorkers += 1
+            try:
+                entry = self.queue.get(timeout=self.idleTimeout)
+            except Queue.Empty:
+                with self.lock:
+                    self.idleWorkers -= 1
+                    if len(self.threads) > self.minThreads:
+                        self.threads.discard(me)
+                        return
+                continue
+            with self.lock:
+                self.idleWorkers -= 1
+                if entry is None:
+                    self.threads.discard(me)
+                    return
+                item, queued = entry
+                if self.maxWait is not None and time.time() - queued > self.maxWait:
+                    self.shedExpired += 1
+                    expired = True
+                else:
+                    self.busyWorkers += 1
+                    expired = False
+            if expired:
+                self.shedItem(item)
+                continue
+            try:
+                self.work(*item)
+            except Exception as e:
+                print(e)
+            finally:
+                with self.lock:
+                    self.busyWorkers -= 1
+
+    def stop(self):
+        """
+        Stop the threads once they finished their current item. Items
+        still waiting are shed, so a full queue cannot block the stop.
+        """
+        with self.lock:
+            threads = list(self.threads)
+            self.minThreads = 0
+        while True:
+            try:
+                item, queued = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.shedItem(item)
+        for thread in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+
 class ThreadedSocketListener(object):
+    """
+    Accepts connections and serves them from an elastic WorkerPool of
+    at least minThreads and at most nThreads threads.
 
-    def __init__(self, port = None, handler = None, timeout = None, nThreads = None):
+    Under overload, connections are shed with a pre-rendered
+    503 Service Unavailable response when maxQueue connections are
+    already waiting or when a connection waited more than maxWait
+    seconds for a worker.
+    """
+
+    idleTimeout = 30.0
+    retryAfter = 5
+    drainTimeout = 30.0
+    # signals delivered to a worker thread are only handled once the
+    # main thread returns from accept()
+    acceptInterval = 1.0
+
+    def __init__(self, port = None, handler = None, timeout = None, nThreads = None, minThreads = None,
+                 maxQueue = None, maxWait = None):
         if port != None:
             self.port = port
         else:
@@ -179,13 +783,24 @@ class ThreadedSocketListener(object):
         if nThreads:
             self.nThreads = nThreads
         else:
-            self.nThreads = 4
+            self.nThreads = 32
+        if minThreads is None:
+            minThreads = min(4, self.nThreads)
+        self.minThreads = minThreads
             
-        self.queue = Queue.Queue()
-
-        self.threads = []
-        for tid in range(self.nThreads):
-            self.threads.append(threading.Thread(target=self.handlerDispatch, args=(tid, self.queue, self.handler)))
+        self.overloadResponse = (b"HTTP/1.1 503 Service Unavailable\r\n"
+                                 b"Connection: close\r\n"
+                                 b"Retry-After: " + str(self.retryAfter).encode() + b"\r\n"
+                                 b"Content-Type: text/plain\r\n"
+                                 b"Content-Length: 20\r\n"
+                                 b"\r\n"
+                                 b"Service Unavailable\n")
+        self.pool = WorkerPool(self.handleConnection, self.minThreads, self.nThreads, self.idleTimeout,
+                               maxQueue, maxWait, self.shedConnection)
+        self.draining = False
+        self.sharedSocket = False
+        self.active = set()
+        self.activeLock = threading.Lock()
         
         import atexit
         atexit.register(self.clearThreads)
@@ -193,79 +808,594 @@ class ThreadedSocketListener(object):
     def clearThreads(self):
         print("Cleaning up ...\n")
         print("\tThreads ...")
-        for tid in range(self.nThreads):    
-            self.queue.put((None, None))
-        for thread in self.threads:
-            thread.join()
+        self.pool.stop()
         print(" done.")
 
-    def serve(self):
-        for tid in range(self.nThreads):
-            self.threads[tid].start()
+    def stats(self):
+        return self.pool.stats()
+
+    def listen(self):
+        return openListenSocket(self.port)
+
+    def serve(self, listenSocket = None):
+        self.pool.start()
         cycle = 0
         try:        
-            listenSocket = socket.socket()
-            listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            print("Binding to port {} ...".format(self.port))
+            if listenSocket is None:
+                listenSocket = self.listen()
+            listenSocket.settimeout(self.acceptInterval)
             while True:
                 try:
-                    listenSocket.bind(('', self.port))
-                    break
-                except:
+                    conn, addr = listenSocket.accept()
+                except socket.timeout:
                     continue
-            print(" succesful.")
-                
-                
-            listenSocket.listen(5)
-            while True:
-                conn, addr = listenSocket.accept()
-                self.queue.put((conn, addr))
+                tuneSocket(conn)
+                self.dispatch(conn, addr)
                 cycle += 1
 
         except KeyboardInterrupt:
-            self.clearThreads()
-            listenSocket.close()
+            self.stopAccepting(listenSocket)
+            self.drain()
             print("Served %s connections." % cycle)
         except Exception as e:
-            print(e)
+            print("Listener on port %s failed: %s" % (self.port, e))
             self.clearThreads()
+            if listenSocket is not None:
+                listenSocket.close()
+
+
+    def stopAccepting(self, listenSocket):
+        """
+        Take over the connections still queued on listenSocket and close it;
+        closing the last reference to a socket with queued connections
+        would reset them. A socket shared with other processes is left
+        untouched, its queue is served by the others.
+        """
+        self.draining = True
+        if self.sharedSocket:
             listenSocket.close()
+            return
+        try:
+            listenSocket.setblocking(False)
+            while True:
+                conn, addr = listenSocket.accept()
+                conn.setblocking(True)
+                tuneSocket(conn)
+                self.dispatch(conn, addr)
+        except OSError:
+            pass
+        listenSocket.close()
 
+    def drain(self, timeout = None):
+        """
+        Let the workers finish what they are serving, then stop them.
+        A handler providing drain() is told to close idle keep-alive
+        connections and to close busy ones after the current response.
+        Connections still open after timeout seconds are aborted.
+        """
+        self.draining = True
+        if timeout is None:
+            timeout = self.drainTimeout
+        if hasattr(self.handler, "drain"):
+            self.handler.drain()
+        giveUp = time.time() + timeout
+        while (self.pool.busyWorkers or self.pool.queueDepth) and time.time() < giveUp:
+            time.sleep(0.05)
+        with self.activeLock:
+            for conn in self.active:
+                abortConnection(conn)
+        self.clearThreads()
 
-    def handlerDispatch(self, tid, queue, handler):
-        
-        while True:
-            conn, addr = queue.get()
-            if not conn:
-                return
-            handler.ready = True
-            handler(conn, addr)
+    def dispatch(self, conn, addr):
+        self.pool.put((conn, addr))
+
+    def handleConnection(self, conn, addr):
+        with self.activeLock:
+            self.active.add(conn)
+        try:
+            self.handler.ready = True
+            self.handler(conn, addr)
+        finally:
+            with self.activeLock:
+                self.active.discard(conn)
+
+    def shedConnection(self, conn, addr):
+        """
+        Answer with the pre-rendered 503 response without blocking
+        and close the connection.
+        """
+        try:
+            conn.setblocking(False)
+            # discard what arrived of the request so closing does not reset
+            while conn.recv(65536):
+                pass
+        except (socket.error, ssl.SSLError):
+            pass
+        try:
+            conn.send(self.overloadResponse)
+            conn.shutdown(socket.SHUT_WR)
+        except (socket.error, ssl.SSLError):
+            pass
+        conn.close()
 
 
 
 class ThreadedSSLListener(ThreadedSocketListener):
+    """
+    Threaded listener for TLS connections.
+
+    All connections are wrapped from one SSLContext built at startup, so
+    certificate and key are loaded once and clients can resume sessions
+    through session tickets or the server-side session cache. Sending
+    reloadSignal (SIGUSR1) loads the certificate again; connections
+    accepted afterwards use the new context.
+
+    Handshakes run non-blocking in a TLSHandshaker thread. Worker threads
+    only get connections which completed the handshake and sent data
+    within handshakeTimeout seconds, so slow or malicious clients cannot
+    tie up the workers.
+    """
+
+    ciphers = "ECDHE+AESGCM:ECDHE+CHACHA20:DHE+AESGCM:DHE+CHACHA20:!aNULL:!MD5:!DSS"
+    alpnProtocols = ["http/1.1"]
+    reloadSignal = signal.SIGUSR1
     
-    def __init__(self, certFile, keyFile, sslVersion, port = None, handler = None, timeout = None, nThreads = None):
-        ThreadedSocketListener.__init__(self, port, handler, timeout, nThreads)
+    def __init__(self, certFile, keyFile, sslVersion = None, port = None, handler = None, timeout = None, nThreads = None,
+                 handshakeTimeout = 10.0, minThreads = None, maxQueue = None, maxWait = None):
+        ThreadedSocketListener.__init__(self, port, handler, timeout, nThreads, minThreads, maxQueue, maxWait)
         self.certFile = certFile
         self.keyFile = keyFile
         self.sslVersion = sslVersion
-        
-    def handlerDispatch(self, tid, queue, handler):
+        self.context = self.makeContext()
+        self.handshaker = TLSHandshaker(self, handshakeTimeout)
+
+    def makeContext(self):
+        if self.sslVersion is None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.minimum_version = ssl.TLSVersion.TLSv1_2
+        else:
+            context = ssl.SSLContext(self.sslVersion)
+        context.options |= ssl.OP_NO_COMPRESSION | ssl.OP_CIPHER_SERVER_PREFERENCE
+        context.set_ciphers(self.ciphers)
+        context.set_alpn_protocols(self.alpnProtocols)
+        context.load_cert_chain(self.certFile, self.keyFile)
+        return context
+
+    def reloadCertificate(self, signum = None, frame = None):
+        try:
+            self.context = self.makeContext()
+            print("Reloaded certificate %s." % self.certFile)
+        except (ssl.SSLError, IOError) as e:
+            print("Failed to reload certificate %s: %s" % (self.certFile, e))
+
+    def serve(self, listenSocket = None):
+        try:
+            signal.signal(self.reloadSignal, self.reloadCertificate)
+        except ValueError:
+            # not running in the main thread
+            pass
+        self.handshaker.start()
+        ThreadedSocketListener.serve(self, listenSocket)
+
+    def dispatch(self, conn, addr):
+        self.handshaker.add(conn, addr)
+
+
+class TLSHandshaker(threading.Thread):
+    """
+    Performs the TLS handshakes of a ThreadedSSLListener.
+
+    Sockets are switched to non-blocking mode and driven by a selector
+    until the handshake completed and the first request data arrived.
+    Only then they are put on the listener's worker pool. Connections which
+    do not get there within handshakeTimeout seconds are closed.
+    """
+
+    def __init__(self, listener, handshakeTimeout = 10.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.listener = listener
+        self.handshakeTimeout = handshakeTimeout
+        self.selector = selectors.DefaultSelector()
+        self.incoming = Queue.Queue()
+        self.deadlines = {}
+        self.wakeupReader, self.wakeupWriter = socket.socketpair()
+        self.wakeupReader.setblocking(False)
+
+    def add(self, conn, addr):
+        self.incoming.put((conn, addr))
+        self.wakeupWriter.send(b'\0')
+
+    def run(self):
+        self.selector.register(self.wakeupReader, selectors.EVENT_READ, None)
         while True:
-            conn, addr = queue.get()
-            if not conn:
+            for key, mask in self.selector.select(timeout=1.0):
+                if key.fileobj is self.wakeupReader:
+                    self.wrapIncoming()
+                else:
+                    self.handshake(key.fileobj, key.data)
+            self.expireHandshakes()
+
+    def wrapIncoming(self):
+        try:
+            while self.wakeupReader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while True:
+            try:
+                conn, addr = self.incoming.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                conn.setblocking(False)
+                sslConn = self.listener.context.wrap_socket(conn, server_side=True,
+                                                            do_handshake_on_connect=False)
+            except (ssl.SSLError, socket.error):
+                conn.close()
+                continue
+            self.deadlines[sslConn] = time.time() + self.handshakeTimeout
+            self.selector.register(sslConn, selectors.EVENT_READ, [addr, False])
+            self.handshake(sslConn, self.selector.get_key(sslConn).data)
+
+    def handshake(self, sslConn, state):
+        addr, established = state
+        if not established:
+            try:
+                sslConn.do_handshake()
+            except ssl.SSLWantReadError:
+                self.selector.modify(sslConn, selectors.EVENT_READ, state)
+                return
+            except ssl.SSLWantWriteError:
+                self.selector.modify(sslConn, selectors.EVENT_WRITE, state)
+                return
+            except (ssl.SSLError, socket.error):
+                self.close(sslConn)
                 return
-            wrappedConn = ssl.wrap_socket(conn,
-                                server_side=True,
-                                certfile = self.certFile,
-                                keyfile = self.keyFile,
-                                ssl_version=self.sslVersion)
-            handler.ready = True
-            handler(wrappedConn, addr)
-            conn.close()
+            state[1] = True
+            self.selector.modify(sslConn, selectors.EVENT_READ, state)
+            if not sslConn.pending():
+                # wait for the request to arrive
+                return
+        self.selector.unregister(sslConn)
+        del self.deadlines[sslConn]
+        sslConn.setblocking(True)
+        self.listener.pool.put((sslConn, addr))
+
+    def close(self, sslConn):
+        self.selector.unregister(sslConn)
+        del self.deadlines[sslConn]
+        sslConn.close()
+
+    def expireHandshakes(self):
+        now = time.time()
+        for sslConn in [conn for conn, deadline in self.deadlines.items() if deadline < now]:
+            self.close(sslConn)
     
 
+class SelectorListener(ThreadedSocketListener):
+    """
+    Event-driven listener.
+
+    One selector loop accepts connections, reads request heads and keeps
+    idle keep-alive connections parked. A connection is handed to the
+    worker threads only once a complete request head has arrived, so
+    idle connections cost a file descriptor instead of a thread.
+
+    The handler has to provide handleRequest(conn, addr, readBuffer) which
+    serves a single request from readBuffer and returns True if the
+    connection may be kept alive.
+
+    Parked connections are closed when they stay idle for keepAliveTimeout
+    seconds or, once the first bytes of a request arrived, when the head
+    is not complete within headerTimeout seconds. Deadlines are kept on a
+    TimerWheel advanced by the selector loop.
+    """
+
+    def __init__(self, port = None, handler = None, timeout = None, nThreads = None,
+                 keepAliveTimeout = 5.0, maxHeadSize = 65536, minThreads = None, maxQueue = None, maxWait = None,
+                 headerTimeout = 10.0):
+        ThreadedSocketListener.__init__(self, port, handler, timeout, nThreads, minThreads, maxQueue, maxWait)
+        self.keepAliveTimeout = keepAliveTimeout
+        self.headerTimeout = headerTimeout
+        self.maxHeadSize = maxHeadSize
+        self.selector = selectors.DefaultSelector()
+        self.timers = TimerWheel(resolution = 0.25)
+        self.connections = {}
+        self.returned = Queue.Queue()
+        self.wakeupReader, self.wakeupWriter = socket.socketpair()
+        self.wakeupReader.setblocking(False)
+
+    def serve(self, listenSocket = None):
+        self.pool.start()
+        cycle = 0
+        try:
+            if listenSocket is None:
+                listenSocket = self.listen()
+            listenSocket.setblocking(False)
+            self.selector.register(listenSocket, selectors.EVENT_READ, None)
+            self.selector.register(self.wakeupReader, selectors.EVENT_READ, None)
+            while True:
+                for key, mask in self.selector.select(timeout=self.timers.resolution):
+                    if key.fileobj is listenSocket:
+                        cycle += self.acceptConnections(listenSocket)
+                    elif key.fileobj is self.wakeupReader:
+                        self.parkReturned()
+                    else:
+                        self.readHead(key.fileobj, key.data)
+                self.expireConnections()
+
+        except KeyboardInterrupt:
+            self.selector.unregister(listenSocket)
+            self.stopAccepting(listenSocket)
+            # parked connections are idle or have not sent a complete head yet
+            for sock in list(self.connections):
+                self.expire(sock)
+            self.drain()
+            print("Served %s connections." % cycle)
+        except Exception as e:
+            print("Listener on port %s failed: %s" % (self.port, e))
+            self.clearThreads()
+            if listenSocket is not None:
+                listenSocket.close()
+
+    def acceptConnections(self, listenSocket):
+        accepted = 0
+        while True:
+            try:
+                conn, addr = listenSocket.accept()
+            except (BlockingIOError, InterruptedError):
+                return accepted
+            accepted += 1
+            tuneSocket(conn)
+            self.park(ReadBuffer(conn), addr)
+
+    def park(self, readBuffer, addr):
+        readBuffer.sock.setblocking(False)
+        self.connections[readBuffer.sock] = self.timers.schedule(self.keepAliveTimeout, self.expire, readBuffer.sock)
+        self.selector.register(readBuffer.sock, selectors.EVENT_READ, (readBuffer, addr))
+
+    def unpark(self, sock):
+        self.selector.unregister(sock)
+        self.connections.pop(sock).cancel()
+
+    def parkReturned(self):
+        try:
+            while self.wakeupReader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while True:
+            try:
+                readBuffer, addr = self.returned.get_nowait()
+            except Queue.Empty:
+                return
+            self.park(readBuffer, addr)
+
+    def readHead(self, sock, connInfo):
+        readBuffer, addr = connInfo
+        idle = not len(readBuffer)
+        try:
+            received = readBuffer.fill()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+        if not received:
+            self.unpark(sock)
+            sock.close()
+            return
+        # oversized heads are dispatched as well; the handler rejects them
+        if readBuffer.find(b'\r\n\r\n') >= 0 or len(readBuffer) > self.maxHeadSize:
+            self.unpark(sock)
+            sock.setblocking(True)
+            self.pool.put((readBuffer, addr))
+        elif idle:
+            # a request started; the keep-alive deadline becomes a header deadline
+            self.connections[sock].reschedule(self.headerTimeout)
+
+    def expireConnections(self):
+        self.timers.expire()
+
+    def expire(self, sock):
+        self.unpark(sock)
+        sock.close()
+
+    def dispatch(self, conn, addr):
+        self.pool.put((ReadBuffer(conn), addr))
+
+    def handleConnection(self, readBuffer, addr):
+        keepAlive = True
+        with self.activeLock:
+            self.active.add(readBuffer.sock)
+        # serve pipelined requests already buffered right away
+        while keepAlive:
+            try:
+                keepAlive = self.handler.handleRequest(readBuffer.sock, addr, readBuffer)
+            except Exception as e:
+                print(e)
+                keepAlive = False
+            if readBuffer.find(b'\r\n\r\n') < 0:
+                break
+        with self.activeLock:
+            self.active.discard(readBuffer.sock)
+        if readBuffer.detached:
+            return
+        if keepAlive and not self.draining:
+            self.returned.put((readBuffer, addr))
+            self.wakeupWriter.send(b'\0')
+        else:
+            readBuffer.sock.close()
+
+    def shedConnection(self, readBuffer, addr):
+        ThreadedSocketListener.shedConnection(self, readBuffer.sock, addr)
+
+
+class PreforkListener(object):
+    """
+    Pre-fork master.
+
+    Forks nProcesses workers which each run a listener built by
+    listenerFactory() on the listening socket. The socket is bound once
+    by the master and inherited by the workers or, with reusePort, bound
+    by every worker itself using SO_REUSEPORT so the kernel balances
+    accepts between them. The master supervises the workers and respawns
+    the ones which die.
+
+    Workers shut down gracefully on SIGTERM: they stop accepting and
+    finish the requests in flight before they exit. reloadSignal (SIGHUP)
+    replaces all workers by a new generation. upgradeSignal (SIGUSR2)
+    re-executes the master, e.g. after new code has been deployed; the
+    listening socket is inherited across exec() and the new master
+    retires the old workers once its own workers run. Either way the
+    listening socket stays open, so no connection is refused or reset.
+    """
+
+    respawnDelay = 1.0
+    handoverDelay = 1.0
+    reloadSignal = signal.SIGHUP
+    upgradeSignal = signal.SIGUSR2
+    retireVariable = "PYTTP_RETIRE_PIDS"
+
+    def __init__(self, listenerFactory, port = None, nProcesses = None, reusePort = False):
+        self.listenerFactory = listenerFactory
+        if port != None:
+            self.port = port
+        else:
+            self.port = 80
+        if nProcesses:
+            self.nProcesses = nProcesses
+        else:
+            self.nProcesses = multiprocessing.cpu_count()
+        self.reusePort = reusePort
+        self.listenSocket = None
+        self.workers = {}
+        self.retired = set()
+        self.running = False
+
+    def spawn(self, wid):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = (wid, time.time())
+            return pid
+        exitCode = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(self.reloadSignal, signal.SIG_IGN)
+            signal.signal(self.upgradeSignal, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, self.interrupt)
+            if self.reusePort:
+                listenSocket = openListenSocket(self.port, reusePort = True)
+            else:
+                listenSocket = self.listenSocket
+            listener = self.listenerFactory()
+            listener.sharedSocket = not self.reusePort
+            listener.serve(listenSocket)
+        except KeyboardInterrupt:
+            pass
+        except BaseException as e:
+            print("Worker %s: %s" % (wid, e))
+            exitCode = 1
+        finally:
+            os._exit(exitCode)
+
+    def interrupt(self, signum, frame):
+        raise KeyboardInterrupt
+
+    def serve(self):
+        if not self.reusePort:
+            self.listenSocket = openListenSocket(self.port)
+        else:
+            inherited = inheritedListenSocket()
+            if inherited is not None:
+                inherited.close()
+        self.running = True
+        signal.signal(signal.SIGTERM, self.interrupt)
+        for wid in range(self.nProcesses):
+            self.spawn(wid)
+        previous = os.environ.pop(self.retireVariable, "")
+        if previous:
+            time.sleep(self.handoverDelay)
+            self.retire(int(pid) for pid in previous.split(","))
+        signal.signal(self.reloadSignal, self.reload)
+        signal.signal(self.upgradeSignal, self.upgrade)
+        try:
+            while self.running:
+                try:
+                    pid, status = os.wait()
+                except InterruptedError:
+                    continue
+                except ChildProcessError:
+                    break
+                self.retired.discard(pid)
+                wid, started = self.workers.pop(pid, (None, None))
+                if wid is None or not self.running:
+                    continue
+                print("Worker %s (pid %s) exited with status %s; respawning." % (wid, pid, status))
+                if time.time() - started < self.respawnDelay:
+                    time.sleep(self.respawnDelay)
+                self.spawn(wid)
+        except KeyboardInterrupt:
+            pass
+        self.shutdown()
+
+    def retire(self, pids):
+        """Tell workers to finish their requests and exit."""
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                continue
+            self.retired.add(pid)
+
+    def reload(self, signum = None, frame = None):
+        """
+        Start a new generation of workers and retire the current one as
+        soon as the new workers had handoverDelay seconds to come up.
+        """
+        print("Reloading workers.")
+        old = list(self.workers)
+        self.workers = {}
+        for wid in range(self.nProcesses):
+            self.spawn(wid)
+        time.sleep(self.handoverDelay)
+        self.retire(old)
+
+    def upgrade(self, signum = None, frame = None):
+        """
+        Replace the master by a new instance of the program. The old
+        workers keep serving until the new master retires them.
+        """
+        print("Upgrading master.")
+        env = dict(os.environ)
+        env[self.retireVariable] = ",".join(str(pid) for pid in list(self.workers) + list(self.retired))
+        if self.listenSocket is not None:
+            self.listenSocket.set_inheritable(True)
+            env[LISTEN_FD_VARIABLE] = str(self.listenSocket.fileno())
+        argv = getattr(sys, "orig_argv", None) or [sys.executable] + sys.argv
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execve(sys.executable, argv, env)
+
+    def shutdown(self):
+        self.running = False
+        pids = list(self.workers) + list(self.retired)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers = {}
+        self.retired = set()
+        if self.listenSocket:
+            self.listenSocket.close()
+
+
 if __name__ == "__main__":
 
     bigString = "Hello World!"*100000
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import gzip
+import mimetypes
+import os
+import sys
+
+from pyttp.apps import Compressor
+
+
+def wants_sidecar(filename, min_size=256):
+    """Whether filename is a file FileServer would serve compressed if it could."""
+    mime, enc = mimetypes.guess_type(filename)
+    if enc is not None or mime is None or not Compressor.compressible_type(mime):
+        return False
+    return os.path.getsize(filename) >= min_size
+
+
+def precompress_file(filename, level=9, max_ratio=0.9):
+    """
+    Write filename.gz next to filename, unless it is up to date already.
+    The sidecar gets the modification time of filename, which marks it as
+    up to date. Returns the size of the sidecar, or None if compression
+    does not get the file below max_ratio of its size; a stale sidecar is
+    removed then.
+    """
+    sidecar = filename + '.gz'
+    stat = os.stat(filename)
+    try:
+        sidecar_stat = os.stat(sidecar)
+        if sidecar_stat.st_mtime_ns == stat.st_mtime_ns:
+            return sidecar_stat.st_size
+    except OSError:
+        pass
+    with open(filename, 'rb') as f:
+        data = f.read()
+    compressed = gzip.compress(data, level, mtime=int(stat.st_mtime))
+    if len(compressed) > len(data) * max_ratio:
+        if os.path.exists(sidecar):
+            os.unlink(sidecar)
+        return None
+    temporary = sidecar + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(compressed)
+    os.utime(temporary, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(temporary, sidecar)
+    return len(compressed)
+
+
+def precompress(directory, level=9, min_size=256, max_ratio=0.9):
+    """
+    Create gzip sidecars for all compressible files below directory.
+    Yields filename, size and sidecar size (None if there is none) of
+    every file considered.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            if not os.path.isfile(filename) or not wants_sidecar(filename, min_size):
+                continue
+            yield filename, os.path.getsize(filename), precompress_file(filename, level, max_ratio)
+
+
+if __name__ == "__main__":
+
+    level = 9
+    directories = []
+    for arg in sys.argv[1:]:
+        if len(arg) == 2 and arg[0] == '-' and arg[1].isdigit() and arg[1] != '0':
+            level = int(arg[1])
+        else:
+            directories.append(arg)
+    if not directories:
+        print("Usage: python -m pyttp.precompress [-1..-9] DIRECTORY [DIRECTORY ...]")
+        print("Writes foo.css.gz next to foo.css for FileServer(..., precompressed=True).")
+        sys.exit(1)
+
+    total, total_compressed = 0, 0
+    for directory in directories:
+        for filename, size, compressed in precompress(directory, level):
+            if compressed is None:
+                print("%s: %d bytes, not worth compressing" % (filename, size))
+                compressed = size
+            else:
+                print("%s: %d -> %d bytes" % (filename, size, compressed))
+            total += size
+            total_compressed += compressed
+    if total:
+        print("%d -> %d bytes (%.1f%%)" % (total, total_compressed, 100. * total_compressed / total))
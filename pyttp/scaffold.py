@@ -20,8 +20,7 @@ def make_controller_root(
                        ('/.*', controller_app)])
     return root_app
 
-def wrap_root(root_app, port=8080, nThreads=1, **kwargs):
-    print(nThreads)
+def wrap_root(root_app, port=8080, nThreads=None, **kwargs):
     return WSGIListener(root_app, port, nThreads=nThreads, **kwargs)
 
 def make_controller_listener(controller,
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import collections
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+from pyttp.timers import TimerWheel
+
+
+HEARTBEAT = b": heartbeat\n\n"
+
+WOULD_BLOCK = (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+
+def formatEvent(data, event = None, id = None, retry = None):
+    """Serialize an event in the text/event-stream format."""
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    lines = []
+    if id is not None:
+        lines.append("id: %s" % id)
+    if event is not None:
+        lines.append("event: %s" % event)
+    if retry is not None:
+        lines.append("retry: %d" % retry)
+    for line in data.splitlines() or [""]:
+        lines.append("data: %s" % line)
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+class EventStream(object):
+    """
+    Subscription of a single client to some channels of a Broker.
+
+    Published events are appended to a buffer of at most maxBuffered
+    bytes; a client falling so far behind is evicted. Served by
+    WSGIHandler, the connection is handed over to the EventStreamHub,
+    which writes the buffer without tying up a thread. Other servers
+    simply iterate the stream, which blocks until events arrive and
+    yields a heartbeat comment every heartbeatInterval seconds.
+    """
+
+    maxBuffered = 262144
+
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = channels
+        self.lock = threading.Condition()
+        self.pending = bytearray()
+        self.closed = False
+        self.evicted = False
+        self.lastWrite = time.time()
+        self.hub = None
+        self.conn = None
+        self.timer = None
+        self.events = 0
+
+    def push(self, frame):
+        """Queue a serialized event; returns False if the client is gone."""
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.pending) + len(frame) > self.maxBuffered:
+                self.evicted = True
+                self.closed = True
+                del self.pending[:]
+                self.lock.notify_all()
+            else:
+                wasEmpty = not self.pending
+                self.pending += frame
+                self.lock.notify_all()
+                if not wasEmpty or self.hub is None:
+                    return True
+        if self.evicted:
+            self.broker.unsubscribe(self)
+        if self.hub is not None:
+            self.hub.wake(self)
+        return not self.evicted
+
+    def send(self, data, event = None, id = None, retry = None):
+        """Send an event to this client only."""
+        return self.push(formatEvent(data, event, id, retry))
+
+    def close(self):
+        """End the stream once the buffered events went out."""
+        self.broker.unsubscribe(self)
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.lock.notify_all()
+        if self.hub is not None:
+            self.hub.wake(self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            if not self.pending and not self.closed:
+                self.lock.wait(self.broker.heartbeatInterval)
+            if self.pending:
+                data = bytes(self.pending)
+                del self.pending[:]
+                return data
+            if self.closed:
+                raise StopIteration
+        return HEARTBEAT
+
+    next = __next__
+
+
+class Broker(object):
+    """
+    Publish/subscribe broker for Server-Sent Events.
+
+        broker = Broker()
+        stream = broker.subscribe("news")
+        broker.publish("news", "hello", event="greeting")
+
+    An event is serialized once and appended to the buffers of all its
+    subscribers, so publishing costs little per client and never blocks
+    on a slow one. Slow consumers are evicted instead; evicted counts them.
+    """
+
+    heartbeatInterval = 15.0
+
+    def __init__(self):
+        self.channels = collections.defaultdict(set)
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def subscribe(self, *channels):
+        stream = EventStream(self, channels)
+        with self.lock:
+            for channel in channels:
+                self.channels[channel].add(stream)
+        return stream
+
+    def unsubscribe(self, stream):
+        with self.lock:
+            for channel in stream.channels:
+                subscribers = self.channels.get(channel)
+                if subscribers is not None and stream in subscribers:
+                    subscribers.discard(stream)
+                    if not subscribers:
+                        del self.channels[channel]
+                    if stream.evicted:
+                        self.evicted += 1
+
+    def publish(self, channel, data, event = None, id = None, retry = None):
+        """Send an event to all subscribers of channel; returns how many got it."""
+        frame = formatEvent(data, event, id, retry)
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        return sum(1 for stream in subscribers if stream.push(frame))
+
+    def subscriberCount(self, channel):
+        with self.lock:
+            return len(self.channels.get(channel, ()))
+
+
+class EventStreamHub(threading.Thread):
+    """
+    Writes event streams to their clients from a single thread.
+
+    Connections sit in a selector; they are watched for writability while
+    events are buffered and for readability to notice clients going away.
+    Streams silent for heartbeatInterval seconds get a comment line, so
+    dead clients are detected and proxies keep the connection open.
+    """
+
+    default = None
+    defaultLock = threading.Lock()
+
+    def __init__(self):
+        threading.Thread.__init__(self, name = "EventStreamHub")
+        self.daemon = True
+        self.selector = selectors.DefaultSelector()
+        self.wakeupReader, self.wakeupWriter = socket.socketpair()
+        self.wakeupReader.setblocking(False)
+        self.wakeupWriter.setblocking(False)
+        self.selector.register(self.wakeupReader, selectors.EVENT_READ)
+        self.changes = collections.deque()
+        self.streams = set()
+        self.timers = TimerWheel(resolution = 0.5)
+
+    @classmethod
+    def getDefault(cls):
+        """The process-wide hub, started on first use."""
+        with cls.defaultLock:
+            if cls.default is None:
+                cls.default = EventStreamHub()
+                cls.default.start()
+            return cls.default
+
+    def add(self, stream, conn):
+        """Take over conn, whose response head was sent already, to serve stream."""
+        stream.conn = conn
+        stream.hub = self
+        self.wake(stream)
+
+    def wake(self, stream):
+        self.changes.append(stream)
+        try:
+            self.wakeupWriter.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def drain(self):
+        """End all streams; clients are expected to reconnect elsewhere."""
+        for stream in list(self.streams):
+            stream.close()
+
+    def run(self):
+        while True:
+            for key, events in self.selector.select(self.timers.resolution):
+                if key.fileobj is self.wakeupReader:
+                    try:
+                        while self.wakeupReader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                stream = key.data
+                if events & selectors.EVENT_READ:
+                    self.receive(stream)
+                if events & selectors.EVENT_WRITE:
+                    self.update(stream)
+            while self.changes:
+                stream = self.changes.popleft()
+                if stream.conn is not None and stream not in self.streams:
+                    self.register(stream)
+                self.update(stream)
+            self.timers.expire()
+
+    def register(self, stream):
+        self.streams.add(stream)
+        stream.conn.setblocking(False)
+        stream.timer = self.timers.schedule(stream.broker.heartbeatInterval, self.heartbeat, stream)
+
+    def receive(self, stream):
+        try:
+            # clients have nothing to say; anything but EOF is discarded
+            received = stream.conn.recv(4096)
+        except WOULD_BLOCK:
+            return
+        except OSError:
+            received = b''
+        if not received:
+            self.drop(stream)
+
+    def flush(self, stream):
+        with stream.lock:
+            try:
+                sent = stream.conn.send(stream.pending)
+            except WOULD_BLOCK:
+                return True
+            except OSError:
+                return False
+            del stream.pending[:sent]
+            stream.lastWrite = time.time()
+        return True
+
+    def update(self, stream):
+        """Write what is buffered and adjust the events stream is selected for."""
+        if stream.conn is None:
+            return
+        if stream.pending and not self.flush(stream):
+            self.drop(stream)
+            return
+        with stream.lock:
+            done = stream.evicted or (stream.closed and not stream.pending)
+            events = selectors.EVENT_READ
+            if stream.pending:
+                events |= selectors.EVENT_WRITE
+        if done:
+            self.drop(stream)
+            return
+        if not stream.events:
+            self.selector.register(stream.conn, events, stream)
+        elif events != stream.events:
+            self.selector.modify(stream.conn, events, stream)
+        stream.events = events
+
+    def heartbeat(self, stream):
+        if stream.conn is None:
+            return
+        interval = stream.broker.heartbeatInterval
+        idle = time.time() - stream.lastWrite
+        if idle >= interval - self.timers.resolution:
+            stream.push(HEARTBEAT)
+            idle = 0
+        stream.timer = self.timers.schedule(interval - idle, self.heartbeat, stream)
+
+    def drop(self, stream):
+        conn = stream.conn
+        if conn is None:
+            return
+        stream.conn = None
+        if stream.events:
+            self.selector.unregister(conn)
+            stream.events = 0
+        if stream.timer is not None:
+            stream.timer.cancel()
+        self.streams.discard(stream)
+        try:
+            conn.close()
+        except OSError:
+            pass
+        stream.close()
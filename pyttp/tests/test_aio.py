@@ -0,0 +1,155 @@
+import asyncio
+import socket
+import threading
+import time
+import unittest
+
+from pyttp.aio import AsyncListener, isAsyncApp
+from pyttp.controller import AsyncControllerWSGIApp, Controller, ControllerResponse, expose
+from pyttp.network import openListenSocket
+from pyttp.wsgi import DummyLogger
+
+
+class Root(Controller):
+
+    @expose
+    async def index(self, request):
+        await asyncio.sleep(0.01)
+        return ControllerResponse("async index")
+
+    @expose
+    def plain(self, request):
+        return ControllerResponse("plain")
+
+
+def wsgi_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response("200 OK", [('Content-Type', 'text/plain')])
+    return iter([environ['PATH_INFO'].encode(), b":", body])
+
+
+class AsyncListenerTestCase(unittest.TestCase):
+
+    app = None
+    nThreads = 2
+    bodyTimeout = 30.0
+    keepAliveTimeout = 5.0
+
+    def setUp(self):
+        listenSocket = openListenSocket(0)
+        self.port = listenSocket.getsockname()[1]
+        listener = AsyncListener(self.app, self.port, nThreads=self.nThreads, bodyTimeout=self.bodyTimeout,
+                                 keepAliveTimeout=self.keepAliveTimeout, logger=DummyLogger(quiet=True))
+        thread = threading.Thread(target=listener.serve, args=(listenSocket,))
+        thread.daemon = True
+        thread.start()
+
+    def request(self, data):
+        client = socket.create_connection(("127.0.0.1", self.port), timeout=2.0)
+        client.sendall(data)
+        client.shutdown(socket.SHUT_WR)
+        response = b''
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+        client.close()
+        return response
+
+
+class AsyncAppTests(AsyncListenerTestCase):
+
+    app = AsyncControllerWSGIApp(Root())
+
+    def test_is_async(self):
+        self.assertTrue(isAsyncApp(self.app))
+        self.assertFalse(isAsyncApp(wsgi_app))
+
+    def test_coroutine_and_plain_actions(self):
+        response = self.request(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n"
+                                b"GET /plain HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        self.assertEqual(response.count(b"HTTP/1.1 200 OK"), 2)
+        self.assertIn(b"Content-Length: 11\r\n\r\nasync index", response)
+        self.assertTrue(response.endswith(b"\r\n\r\nplain"))
+
+
+class ThreadedAppTests(AsyncListenerTestCase):
+
+    app = staticmethod(wsgi_app)
+
+    def test_streamed_body_and_pipelining(self):
+        response = self.request(b"POST /a HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+                                b"GET /b HTTP/1.0\r\n\r\n")
+        first, second = response.split(b"HTTP/1.1 200 OK")[1:]
+        self.assertIn(b"Transfer-Encoding: chunked", first)
+        self.assertIn(b"2\r\n/a\r\n1\r\n:\r\n5\r\nhello\r\n0\r\n\r\n", first)
+        self.assertIn(b"Connection: close", second)
+        self.assertTrue(second.endswith(b"\r\n\r\n/b:"))
+
+
+class ConnectionCloseTests(AsyncListenerTestCase):
+
+    app = staticmethod(wsgi_app)
+    keepAliveTimeout = 0.3
+
+    def receiveAll(self, client):
+        data = b''
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                return data
+            data += chunk
+
+    def test_idle_keep_alive_timeout(self):
+        with self.assertNoLogs("asyncio", level="ERROR"):
+            client = socket.create_connection(("127.0.0.1", self.port), timeout=2.0)
+            client.sendall(b"GET /a HTTP/1.1\r\n\r\n")
+            response = self.receiveAll(client)
+            client.close()
+            time.sleep(0.1)
+        self.assertTrue(response.endswith(b"2\r\n/a\r\n1\r\n:\r\n0\r\n\r\n"))
+
+    def test_truncated_head(self):
+        with self.assertNoLogs("asyncio", level="ERROR"):
+            self.assertEqual(self.request(b"GET /a HTTP/1.1\r\nHost"), b'')
+            time.sleep(0.1)
+
+
+class StalledBodyTests(AsyncListenerTestCase):
+
+    app = staticmethod(wsgi_app)
+    nThreads = 1
+    bodyTimeout = 0.3
+
+    def test_stalled_body_releases_thread(self):
+        stalled = socket.create_connection(("127.0.0.1", self.port), timeout=2.0)
+        stalled.sendall(b"POST /a HTTP/1.1\r\nContent-Length: 100\r\n\r\nhello")
+        # the only pool thread is stuck reading the body until the timeout
+        response = self.request(b"POST /b HTTP/1.0\r\nContent-Length: 2\r\n\r\nok")
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK"))
+        self.assertTrue(response.endswith(b"/b:ok"))
+        response = b''
+        while True:
+            chunk = stalled.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+        stalled.close()
+        self.assertTrue(response.startswith(b"HTTP/1.1 500"))
+
+
+class StalledAsyncBodyTests(AsyncListenerTestCase):
+
+    app = AsyncControllerWSGIApp(Root())
+    nThreads = 1
+    bodyTimeout = 0.3
+
+    def test_stalled_chunked_body(self):
+        stalled = socket.create_connection(("127.0.0.1", self.port), timeout=2.0)
+        stalled.sendall(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n")
+        self.assertEqual(stalled.recv(65536), b'')
+        stalled.close()
+        # chunked bodies are decoded by the pool thread, which must be free again
+        response = self.request(b"POST / HTTP/1.0\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nok\r\n0\r\n\r\n")
+        self.assertTrue(response.endswith(b"async index"))
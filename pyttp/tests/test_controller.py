@@ -0,0 +1,51 @@
+import unittest
+
+from pyttp.controller import (ControllerWSGIApp, Controller, ControllerResponse,
+                              expose, hash_etag)
+
+
+class Root(Controller):
+
+    @expose
+    @hash_etag
+    def page(self, request, name="world"):
+        return ControllerResponse("Hello, %s!" % name)
+
+    @expose
+    def plain(self, request):
+        return ControllerResponse("Hello!")
+
+
+class HashETagTests(unittest.TestCase):
+
+    def call(self, path, **headers):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': ''}
+        environ.update(headers)
+        response = {}
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+        body = ControllerWSGIApp(Root())(environ, start_response)
+        return response['status'], response['headers'], b''.join(body)
+
+    def test_not_modified(self):
+        status, headers, body = self.call('/page/')
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(body, b"Hello, world!")
+        etag = headers['ETag']
+        status, headers, body = self.call('/page/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, "304 Not Modified")
+        self.assertEqual(headers['ETag'], etag)
+        self.assertEqual(body, b"")
+
+    def test_changed_body(self):
+        etag = self.call('/page/')[1]['ETag']
+        status, headers, body = self.call('/page/mars/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, "200 OK")
+        self.assertNotEqual(headers['ETag'], etag)
+        self.assertEqual(body, b"Hello, mars!")
+
+    def test_opt_in(self):
+        status, headers, body = self.call('/plain/', HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(status, "200 OK")
+        self.assertNotIn('ETag', headers)
@@ -0,0 +1,68 @@
+import unittest
+
+from pyttp.core import (IncrementalRequestParser, RequestParser, RequestParserException,
+                        RequestLineTooLong, RequestHeaderFieldsTooLarge)
+
+
+class IncrementalRequestParserTests(unittest.TestCase):
+
+    def test_parse_in_pieces(self):
+        data = b"GET /foo?bar=1 HTTP/1.1\r\nHost: example.org\r\nX-Foo:  spam \r\n\r\nbody"
+        parser = IncrementalRequestParser()
+        consumed = 0
+        for end in range(1, len(data) + 1):
+            consumed += parser.feed(data[:end], consumed)
+            if parser.done:
+                break
+        self.assertTrue(parser.done)
+        self.assertEqual(data[consumed:], b"body")
+        request = parser.request
+        self.assertEqual(request.type.verb, "GET")
+        self.assertEqual(request.type.resource, "/foo?bar=1")
+        self.assertEqual(request.type.version, "1.1")
+        self.assertEqual([(h.name, h.value) for h in request.headers],
+                         [("Host", "example.org"), ("X-Foo", "spam")])
+
+    def test_incomplete(self):
+        parser = IncrementalRequestParser()
+        consumed = parser.feed(b"GET / HTTP/1.1\r\nHost: exa")
+        self.assertFalse(parser.done)
+        self.assertEqual(consumed, len(b"GET / HTTP/1.1\r\n"))
+
+    def test_leading_empty_lines(self):
+        parser = IncrementalRequestParser()
+        parser.feed(b"\r\nGET / HTTP/1.0\r\n\r\n")
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.request.type.version, "1.0")
+
+    def test_request_line_limit(self):
+        parser = IncrementalRequestParser(maxRequestLine=20)
+        self.assertRaises(RequestLineTooLong, parser.feed, b"GET /" + b"a" * 30)
+
+    def test_header_limits(self):
+        parser = IncrementalRequestParser(maxHeaderSize=20)
+        self.assertRaises(RequestHeaderFieldsTooLarge, parser.feed,
+                          b"GET / HTTP/1.1\r\nX-Foo: " + b"a" * 30)
+        parser = IncrementalRequestParser(maxHeaders=2)
+        self.assertRaises(RequestHeaderFieldsTooLarge, parser.feed,
+                          b"GET / HTTP/1.1\r\nA: 1\r\nB: 2\r\nC: 3\r\n\r\n")
+
+    def test_malformed(self):
+        for data in [b"GET /\r\n\r\n", b"GET / FOO/1.1\r\n\r\n",
+                     b"GET / HTTP/1.1\r\nNoColon\r\n\r\n",
+                     b"GET / HTTP/1.1\r\nHost : a\r\n\r\n",
+                     b"GET / HTTP/1.1\r\nHost: a\r\n folded\r\n\r\n"]:
+            self.assertRaises(RequestParserException, IncrementalRequestParser().feed, data)
+        try:
+            IncrementalRequestParser().feed(b"BREW / HTTP/1.1\r\n\r\n")
+        except RequestParserException as e:
+            self.assertEqual(e.status, "501 Not Implemented")
+
+
+class RequestParserTests(unittest.TestCase):
+
+    def test_parse(self):
+        request, payload = RequestParser().parse(
+            b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 4\r\n\r\nbody")
+        self.assertEqual(payload, b"body")
+        self.assertEqual(request.headers[-1].name, "Content-Length")
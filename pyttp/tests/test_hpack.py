@@ -0,0 +1,75 @@
+import unittest
+
+from pyttp.hpack import (Decoder, Encoder, HPACKError, decodeInteger, encodeInteger,
+                         huffmanDecode, huffmanEncode)
+
+
+class IntegerTests(unittest.TestCase):
+
+    def test_rfc_examples(self):
+        # RFC 7541, C.1
+        self.assertEqual(encodeInteger(10, 5), b'\x0a')
+        self.assertEqual(encodeInteger(1337, 5), b'\x1f\x9a\x0a')
+        self.assertEqual(encodeInteger(42, 8), b'\x2a')
+        self.assertEqual(decodeInteger(b'\x1f\x9a\x0a', 0, 5), (1337, 3))
+
+    def test_truncated(self):
+        self.assertRaises(HPACKError, decodeInteger, b'\x1f\x9a', 0, 5)
+
+
+class HuffmanTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        for data in (b'', b'www.example.com', b'no-cache', bytes(range(256))):
+            self.assertEqual(huffmanDecode(huffmanEncode(data)), data)
+
+    def test_rfc_example(self):
+        self.assertEqual(huffmanEncode(b'www.example.com'),
+                         bytes.fromhex("f1e3c2e5f23a6ba0ab90f4ff"))
+
+    def test_invalid_padding(self):
+        self.assertRaises(HPACKError, huffmanDecode, huffmanEncode(b'a') + b'\xff\xff\xff\xff')
+
+
+class CodingTests(unittest.TestCase):
+
+    def test_rfc_requests(self):
+        # RFC 7541, C.4: three requests sharing a dynamic table
+        decoder = Decoder()
+        self.assertEqual(decoder.decode(bytes.fromhex("828684418cf1e3c2e5f23a6ba0ab90f4ff")),
+                         [(":method", "GET"), (":scheme", "http"), (":path", "/"),
+                          (":authority", "www.example.com")])
+        self.assertEqual(decoder.decode(bytes.fromhex("828684be5886a8eb10649cbf")),
+                         [(":method", "GET"), (":scheme", "http"), (":path", "/"),
+                          (":authority", "www.example.com"), ("cache-control", "no-cache")])
+        self.assertEqual(decoder.decode(bytes.fromhex("828785bf408825a849e95ba97d7f8925a849e95bb8e8b4bf")),
+                         [(":method", "GET"), (":scheme", "https"), (":path", "/index.html"),
+                          (":authority", "www.example.com"), ("custom-key", "custom-value")])
+
+    def test_round_trip(self):
+        encoder = Encoder()
+        decoder = Decoder()
+        headers = [(":status", "200"), ("content-type", "text/html"), ("set-cookie", "a=b"),
+                   ("x-custom", "value")]
+        for i in range(3):
+            block = encoder.encode(headers)
+            self.assertEqual(decoder.decode(block), headers)
+        # repeated headers are served from the dynamic table
+        self.assertLess(len(block), 10)
+
+    def test_table_size_update(self):
+        encoder = Encoder()
+        decoder = Decoder()
+        self.assertEqual(decoder.decode(encoder.encode([("x-a", "1")])), [("x-a", "1")])
+        self.assertEqual(decoder.table.size, 36)
+        encoder.setMaxTableSize(0)
+        self.assertEqual(decoder.decode(encoder.encode([("x-a", "1")])), [("x-a", "1")])
+        self.assertEqual(encoder.table.size, 0)
+        self.assertEqual(decoder.table.size, 0)
+
+    def test_invalid_index(self):
+        self.assertRaises(HPACKError, Decoder().decode, b'\xff\x00')
+
+
+if __name__ == '__main__':
+    unittest.main()
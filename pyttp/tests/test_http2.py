@@ -0,0 +1,163 @@
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from pyttp.hpack import Encoder
+from pyttp.http2 import DATA, END_HEADERS, END_STREAM, GOAWAY, HEADERS, PREFACE, SETTINGS
+from pyttp.http2 import HTTP2Client, HTTP2Connection, isHTTP2, packFrame, readFrame
+from pyttp.network import ReadBuffer, openListenSocket
+from pyttp.wsgi import DummyLogger, WSGIListener
+
+
+def app(environ, start_response):
+    path = environ['PATH_INFO']
+    if path == "/slow":
+        time.sleep(0.5)
+    elif path == "/stream":
+        start_response("200 OK", [('Content-Type', 'text/plain')])
+        return (b'x' * 50000 for i in range(10))
+    elif path == "/error":
+        raise ValueError(path)
+    elif path == "/write":
+        write = start_response("200 OK", [('Content-Type', 'text/plain')])
+        write("written ")
+        return [b"returned"]
+    body = environ['wsgi.input'].read()
+    start_response("200 OK", [('Content-Type', 'text/plain'), ('Connection', 'keep-alive')])
+    return [environ['SERVER_PROTOCOL'].encode(), b" ", path.encode(), b":", body]
+
+
+class HTTP2Tests(unittest.TestCase):
+
+    def setUp(self):
+        listenSocket = openListenSocket(0)
+        self.port = listenSocket.getsockname()[1]
+        listener = WSGIListener(app, self.port, nThreads=4, logger=DummyLogger(quiet=True), keepAliveTimeout=1.0)
+        thread = threading.Thread(target=listener.serve, args=(listenSocket,))
+        thread.daemon = True
+        thread.start()
+        self.client = HTTP2Client("127.0.0.1", self.port, timeout=5.0)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_get(self):
+        status, headers, body = self.client.get("/index")[0]
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b"HTTP/2 /index:")
+        self.assertIn(("content-length", "14"), headers)
+        # connection-specific headers are dropped
+        self.assertNotIn("connection", dict(headers))
+
+    def test_concurrent_streams(self):
+        start = time.time()
+        responses = self.client.get(*["/slow"] * 4)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual([status for status, headers, body in responses], [200] * 4)
+
+    def test_post_body_beyond_window(self):
+        data = b'y' * 200000
+        streamId = self.client.request("POST", "/upload", [("Content-Length", str(len(data)))], data)
+        status, headers, body = self.client.getResponse(streamId)
+        self.assertEqual(body, b"HTTP/2 /upload:" + data)
+
+    def test_streamed_response(self):
+        status, headers, body = self.client.get("/stream")[0]
+        self.assertEqual(len(body), 500000)
+
+    def test_write_callable(self):
+        status, headers, body = self.client.get("/write")[0]
+        self.assertEqual((status, body), (200, b"written returned"))
+
+    def test_error(self):
+        self.assertEqual(self.client.get("/error", "/index")[0][0], 500)
+
+    def test_head(self):
+        status, headers, body = self.client.getResponse(self.client.request("HEAD", "/index"))
+        self.assertEqual((status, body), (200, b''))
+
+    def test_http1_still_served(self):
+        client = socket.create_connection(("127.0.0.1", self.port), timeout=2.0)
+        client.sendall(b"GET /plain HTTP/1.0\r\n\r\n")
+        response = b''
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+        client.close()
+        self.assertTrue(response.startswith(b"HTTP/1.1 200"))
+        self.assertTrue(response.endswith(b"HTTP/1.0 /plain:"))
+
+    def test_idle_connection_goes_away(self):
+        frameType = None
+        while frameType != GOAWAY:
+            frameType, flags, streamId, payload = readFrame(self.client.readBuffer)
+        self.assertEqual(struct.unpack(">II", payload), (0, 0))
+
+
+class SlowPeerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.started = threading.Event()
+        self.connection = HTTP2Connection(self.app, self.server, ('127.0.0.1', 0), 80, logger=DummyLogger(quiet=True))
+        thread = threading.Thread(target=self.connection.serve)
+        thread.daemon = True
+        thread.start()
+        self.encoder = Encoder()
+        self.client.sendall(PREFACE + packFrame(SETTINGS, 0, 0))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def app(self, environ, start_response):
+        self.started.set()
+        body = environ['wsgi.input'].read(5)
+        start_response("200 OK", [('Content-Type', 'text/plain')])
+        return [body]
+
+    def request(self, streamId, method, endStream):
+        block = self.encoder.encode([(":method", method), (":scheme", "http"), (":path", "/"),
+                                     (":authority", "localhost")])
+        self.client.sendall(packFrame(HEADERS, END_HEADERS | (END_STREAM if endStream else 0), streamId, block))
+
+    def test_blocked_send_does_not_stall_reader(self):
+        time.sleep(0.1)
+        # as if a response were being sent to a client that does not read
+        with self.connection.writeLock:
+            self.request(1, "POST", False)
+            self.client.sendall(packFrame(DATA, 0, 1, b"hello"))
+            # the application has read the body and waits to send WINDOW_UPDATE
+            self.assertTrue(self.started.wait(1.0))
+            time.sleep(0.1)
+            self.started.clear()
+            self.request(3, "GET", True)
+            self.assertTrue(self.started.wait(1.0))
+
+
+class DetectionTests(unittest.TestCase):
+
+    def test_preface(self):
+        server, client = socket.socketpair()
+        client.sendall(PREFACE[:10])
+        client.sendall(PREFACE[10:] + packFrame(SETTINGS, 0, 0))
+        self.assertTrue(isHTTP2(server, ReadBuffer(server)))
+        server.close()
+        client.close()
+
+    def test_http1(self):
+        server, client = socket.socketpair()
+        client.sendall(b"GET / HTTP/1.0\r\n\r\n")
+        readBuffer = ReadBuffer(server)
+        self.assertFalse(isHTTP2(server, readBuffer))
+        self.assertEqual(readBuffer.read(), b"GET / HTTP/1.0\r\n\r\n")
+        server.close()
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
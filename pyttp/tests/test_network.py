@@ -0,0 +1,529 @@
+import os
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from pyttp.network import ReadBuffer, WriteBuffer, WorkerPool, ThreadedSocketListener, SocketExhausted, BufferLimitExceeded
+from pyttp.network import SelectorListener, ThreadedSSLListener
+from pyttp.network import openListenSocket, LISTEN_FD_VARIABLE, MappedFile, fileChunks, sendBuffers
+
+
+CERT_FILE = os.path.join(os.path.dirname(__file__), "test_cert.pem")
+KEY_FILE = os.path.join(os.path.dirname(__file__), "test_key.pem")
+# a second certificate for localhost, to be reloaded
+CERT_FILE2 = os.path.join(os.path.dirname(__file__), "test_cert2.pem")
+KEY_FILE2 = os.path.join(os.path.dirname(__file__), "test_key2.pem")
+
+
+def clientContext():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def tlsSocketPair():
+    """A connected pair of TLS sockets, server side first."""
+    sock, peer = socket.socketpair()
+    serverContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    serverContext.load_cert_chain(CERT_FILE, KEY_FILE)
+    wrapped = []
+    handshake = threading.Thread(target=lambda: wrapped.append(clientContext().wrap_socket(peer)))
+    handshake.start()
+    sock = serverContext.wrap_socket(sock, server_side=True)
+    handshake.join()
+    return sock, wrapped[0]
+
+
+class PathHandler(object):
+    """Answers every request with its path until asked to close."""
+
+    def handleRequest(self, conn, addr, readBuffer):
+        while readBuffer.find(b'\r\n\r\n') < 0:
+            if not readBuffer.fill():
+                return False
+        head = readBuffer.read(readBuffer.find(b'\r\n\r\n') + 4)
+        path = head.split(b' ')[1]
+        conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(path), path))
+        return b"Connection: close" not in head
+
+    def __call__(self, conn, addr):
+        readBuffer = ReadBuffer(conn)
+        try:
+            while self.handleRequest(conn, addr, readBuffer):
+                pass
+        except (socket.error, ssl.SSLError):
+            pass
+        conn.close()
+
+
+def serveInBackground(listener, listenSocket = None):
+    """Run listener in a daemon thread; returns its port."""
+    if listenSocket is None:
+        listenSocket = openListenSocket(0)
+    thread = threading.Thread(target=listener.serve, args=(listenSocket,))
+    thread.daemon = True
+    thread.start()
+    return listenSocket.getsockname()[1]
+
+
+def readResponses(sock, count):
+    """The bodies of up to count responses; fewer if the peer closes."""
+    data = b''
+    bodies = []
+    while len(bodies) < count:
+        end = data.find(b'\r\n\r\n')
+        if end >= 0:
+            length = int(data[:end].split(b"Content-Length: ")[1].split(b"\r\n")[0])
+            if len(data) >= end + 4 + length:
+                bodies.append(data[end + 4:end + 4 + length])
+                data = data[end + 4 + length:]
+                continue
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return bodies
+
+
+class ReadBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.buffer = ReadBuffer(self.sock)
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def test_read_until(self):
+        self.peer.sendall(b"GET / HTTP/1.1\r\nHost: a\r\n\r\nbody")
+        head = self.buffer.readUntil(b"\r\n\r\n")
+        self.assertEqual(head, b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+        self.assertEqual(len(self.buffer), 4)
+        self.assertEqual(self.buffer.read(), b"body")
+
+    def test_read_until_split_terminator(self):
+        self.peer.sendall(b"GET / HTTP/1.1\r\n\r")
+        self.buffer.fill()
+        self.peer.sendall(b"\nrest")
+        self.assertEqual(self.buffer.readUntil(b"\r\n\r\n"), b"GET / HTTP/1.1\r\n\r\n")
+        self.assertEqual(self.buffer.read(2), b"re")
+
+    def test_exhausted(self):
+        self.peer.sendall(b"GET / HTTP/1.1\r\n")
+        self.peer.close()
+        self.assertRaises(SocketExhausted, self.buffer.readUntil, b"\r\n\r\n")
+
+    def test_limit(self):
+        self.peer.sendall(b"x" * 100)
+        self.assertRaises(BufferLimitExceeded, self.buffer.readUntil, b"\r\n\r\n", 50)
+
+
+class WriteBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.peer.settimeout(1.0)
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def test_coalesce(self):
+        output = WriteBuffer(self.sock, bufferSize=1024, flushDelay=10)
+        for i in range(10):
+            output.write(b"chunk", b"\r\n")
+        self.peer.setblocking(False)
+        self.assertRaises(BlockingIOError, self.peer.recv, 1024)
+        output.flush()
+        self.peer.setblocking(True)
+        self.assertEqual(self.peer.recv(1024), b"chunk\r\n" * 10)
+
+    def test_large_piece(self):
+        output = WriteBuffer(self.sock, bufferSize=16, flushDelay=10)
+        output.write(b"head")
+        output.write(b"x" * 16)
+        self.assertEqual(self.peer.recv(1024), b"head" + b"x" * 16)
+
+    def test_flush_delay(self):
+        output = WriteBuffer(self.sock, bufferSize=1024, flushDelay=0.01)
+        output.write(b"event")
+        self.assertEqual(self.peer.recv(1024), b"event")
+
+    def test_blocked_writer_does_not_stall_flusher(self):
+        slow, slowPeer = socket.socketpair()
+        slow.settimeout(1.5)
+        blocked = WriteBuffer(slow, bufferSize=1024, flushDelay=0.01)
+        # schedule a delayed flush, then block in a large write to a peer
+        # which does not read while holding the buffer
+        blocked.write(b"event")
+        writer = threading.Thread(target=self.assertRaises, args=(socket.timeout, blocked.write, b"x" * 10000000))
+        writer.start()
+        time.sleep(0.1)
+        start = time.time()
+        output = WriteBuffer(self.sock, bufferSize=1024, flushDelay=0.01)
+        output.write(b"event")
+        self.assertEqual(self.peer.recv(1024), b"event")
+        self.assertLess(time.time() - start, 0.5)
+        writer.join()
+        slow.close()
+        slowPeer.close()
+
+
+class TLSWriteBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = tlsSocketPair()
+        self.sock.settimeout(5.0)
+        self.peer.settimeout(5.0)
+
+    def tearDown(self):
+        self.sock.close()
+        self.peer.close()
+
+    def receive(self, length):
+        data = b''
+        while len(data) < length:
+            data += self.peer.recv(length - len(data))
+        return data
+
+    def test_non_blocking_send(self):
+        data = os.urandom(4 * 1024 * 1024)
+        start = time.time()
+        rest = sendBuffers(self.sock, [data], nonBlocking=True)
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual(len(rest), 1)
+        self.assertEqual(self.sock.gettimeout(), 5.0)
+        receiver = threading.Thread(target=lambda: self.received.append(self.receive(len(data) + 5)))
+        self.received = []
+        receiver.start()
+        sendBuffers(self.sock, rest + [b"after"])
+        receiver.join()
+        self.assertEqual(self.received[0], data + b"after")
+
+    def test_slow_client_does_not_stall_flusher(self):
+        stalled = WriteBuffer(self.sock, bufferSize=16 * 1024 * 1024, flushDelay=0.01)
+        stalled.write(b"x" * 4 * 1024 * 1024)
+        time.sleep(0.1)
+        other, otherPeer = tlsSocketPair()
+        try:
+            otherPeer.settimeout(1.0)
+            output = WriteBuffer(other, bufferSize=1024, flushDelay=0.01)
+            output.write(b"event")
+            self.assertEqual(otherPeer.recv(1024), b"event")
+        finally:
+            other.close()
+            otherPeer.close()
+        self.assertTrue(stalled.pending)
+        self.received = []
+        receiver = threading.Thread(target=lambda: self.received.append(self.receive(4 * 1024 * 1024)))
+        receiver.start()
+        stalled.flush()
+        receiver.join()
+        self.assertEqual(self.received[0], b"x" * 4 * 1024 * 1024)
+
+
+class WorkerPoolTests(unittest.TestCase):
+
+    def test_grow_and_shrink(self):
+        release = threading.Event()
+        done = []
+        def work(i):
+            release.wait()
+            done.append(i)
+        pool = WorkerPool(work, minThreads=1, maxThreads=3, idleTimeout=0.1)
+        pool.start()
+        for i in range(5):
+            pool.put((i,))
+        time.sleep(0.1)
+        self.assertEqual(pool.threadCount, 3)
+        self.assertEqual(pool.busyWorkers, 3)
+        self.assertEqual(pool.queueDepth, 2)
+        release.set()
+        time.sleep(0.5)
+        self.assertEqual(sorted(done), list(range(5)))
+        self.assertEqual(pool.threadCount, 1)
+        pool.stop()
+        self.assertEqual(pool.threadCount, 0)
+
+    def test_shed_full_and_expired(self):
+        release = threading.Event()
+        done = []
+        shed = []
+        def work(i):
+            release.wait()
+            done.append(i)
+        pool = WorkerPool(work, minThreads=1, maxThreads=1, maxQueue=2, maxWait=0.2,
+                          shed=shed.append)
+        pool.start()
+        pool.put((0,))
+        time.sleep(0.05)
+        self.assertTrue(pool.put((1,)))
+        self.assertTrue(pool.put((2,)))
+        self.assertFalse(pool.put((3,)))
+        self.assertEqual(shed, [3])
+        time.sleep(0.3)
+        release.set()
+        time.sleep(0.1)
+        self.assertEqual(done, [0])
+        self.assertEqual(sorted(shed), [1, 2, 3])
+        stats = pool.stats()
+        self.assertEqual(stats["shedFull"], 1)
+        self.assertEqual(stats["shedExpired"], 2)
+        pool.stop()
+
+    def test_stop_saturated(self):
+        release = threading.Event()
+        shed = []
+        pool = WorkerPool(lambda i: release.wait(), minThreads=2, maxThreads=2, maxQueue=1,
+                          shed=shed.append)
+        pool.start()
+        for i in range(3):
+            self.assertTrue(pool.put((i,)))
+            time.sleep(0.05)
+        self.assertEqual(pool.queueDepth, 1)
+        stopper = threading.Thread(target=pool.stop)
+        stopper.start()
+        time.sleep(0.05)
+        # the waiting item made room for the stop while both workers are busy
+        self.assertEqual(shed, [2])
+        release.set()
+        stopper.join(1.0)
+        self.assertFalse(stopper.is_alive())
+        self.assertEqual(pool.threadCount, 0)
+
+
+class ShedConnectionTests(unittest.TestCase):
+
+    def test_overload_response(self):
+        listener = ThreadedSocketListener(0, None, nThreads=1)
+        server, client = socket.socketpair()
+        client.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        listener.shedConnection(server, None)
+        response = b''
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            response += data
+        client.close()
+        head, body = response.split(b"\r\n\r\n", 1)
+        self.assertTrue(head.startswith(b"HTTP/1.1 503 Service Unavailable\r\n"))
+        self.assertIn(b"Retry-After: 5", head)
+        self.assertEqual(body, b"Service Unavailable\n")
+
+
+class SelectorListenerTests(unittest.TestCase):
+
+    def setUp(self):
+        listener = SelectorListener(0, PathHandler(), nThreads=1)
+        self.port = serveInBackground(listener)
+
+    def test_keep_alive_and_pipelining(self):
+        # parked idle connections do not take the only worker thread
+        idle = [socket.create_connection(("127.0.0.1", self.port), timeout=2.0) for i in range(3)]
+        client = socket.create_connection(("127.0.0.1", self.port), timeout=2.0)
+        client.sendall(b"GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\n")
+        self.assertEqual(readResponses(client, 2), [b"/a", b"/b"])
+        time.sleep(0.1)
+        client.sendall(b"GET /c HTTP/1.1\r\n")
+        time.sleep(0.1)
+        client.sendall(b"Connection: close\r\n\r\n")
+        self.assertEqual(readResponses(client, 2), [b"/c"])
+        client.close()
+        for sock in idle:
+            sock.sendall(b"GET /d HTTP/1.1\r\nConnection: close\r\n\r\n")
+            self.assertEqual(readResponses(sock, 2), [b"/d"])
+            sock.close()
+
+
+# a pre-fork server on the port of the socket handed over in PYTTP_LISTEN_FD
+HANDOFF_SERVER = """
+import os, sys
+from pyttp.network import PreforkListener, ThreadedSocketListener
+
+class Handler(object):
+    def __call__(self, conn, addr):
+        conn.recv(65536)
+        body = b"%d" % os.getppid()
+        conn.sendall(b"HTTP/1.1 200 OK\\r\\nContent-Length: %d\\r\\n\\r\\n%s" % (len(body), body))
+        conn.close()
+
+port = int(sys.argv[1])
+PreforkListener(lambda: ThreadedSocketListener(port, Handler(), nThreads=1), port, nProcesses=1).serve()
+"""
+
+
+class SSLListenerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.certFile = os.path.join(self.directory, "cert.pem")
+        self.keyFile = os.path.join(self.directory, "key.pem")
+        shutil.copy(CERT_FILE, self.certFile)
+        shutil.copy(KEY_FILE, self.keyFile)
+        self.listener = ThreadedSSLListener(self.certFile, self.keyFile, port=0, handler=PathHandler(), nThreads=2,
+                                            handshakeTimeout=0.5)
+        self.port = serveInBackground(self.listener)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def connect(self):
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=2.0)
+        return clientContext().wrap_socket(sock)
+
+    def request(self, client, path):
+        client.sendall(b"GET " + path + b" HTTP/1.1\r\n\r\n")
+        return readResponses(client, 1)
+
+    def certificate(self, filename):
+        with open(filename) as f:
+            return ssl.PEM_cert_to_DER_cert(f.read())
+
+    def test_reload_certificate(self):
+        before = self.connect()
+        self.assertEqual(before.getpeercert(binary_form=True), self.certificate(CERT_FILE))
+        self.assertEqual(self.request(before, b"/a"), [b"/a"])
+        shutil.copy(CERT_FILE2, self.certFile)
+        shutil.copy(KEY_FILE2, self.keyFile)
+        self.listener.reloadCertificate()
+        after = self.connect()
+        self.assertEqual(after.getpeercert(binary_form=True), self.certificate(CERT_FILE2))
+        self.assertEqual(self.request(after, b"/b"), [b"/b"])
+        # established connections are not affected
+        self.assertEqual(self.request(before, b"/c"), [b"/c"])
+        before.close()
+        after.close()
+
+    def test_stalled_handshakes(self):
+        # more stalled clients than worker threads: one sends nothing,
+        # the others a partial ClientHello
+        stalled = [socket.create_connection(("127.0.0.1", self.port), timeout=5.0) for i in range(4)]
+        for sock in stalled[1:]:
+            sock.sendall(b"\x16\x03\x01\x02\x00\x01\x00\x01\xfc\x03\x03")
+        time.sleep(0.1)
+        start = time.time()
+        client = self.connect()
+        self.assertEqual(self.request(client, b"/a"), [b"/a"])
+        self.assertLess(time.time() - start, 0.5)
+        client.close()
+        # and are dropped after handshakeTimeout
+        for sock in stalled:
+            self.assertEqual(sock.recv(4096), b'')
+            sock.close()
+        self.assertLess(time.time() - start, 3.0)
+
+
+class ListenSocketTests(unittest.TestCase):
+
+    def setUp(self):
+        self.busy = openListenSocket(0)
+        self.port = self.busy.getsockname()[1]
+
+    def tearDown(self):
+        self.busy.close()
+
+    def test_bind_gives_up(self):
+        start = time.time()
+        self.assertRaises(OSError, openListenSocket, self.port, bindTimeout=0.6)
+        self.assertLess(time.time() - start, 2.0)
+
+    def test_inherited_socket(self):
+        os.environ[LISTEN_FD_VARIABLE] = str(self.busy.fileno())
+        inherited = openListenSocket(self.port)
+        self.assertNotIn(LISTEN_FD_VARIABLE, os.environ)
+        self.assertEqual(inherited.fileno(), self.busy.fileno())
+        inherited.detach()
+
+    def test_inherited_socket_with_reuse_port(self):
+        fd = self.busy.dup().detach()
+        inode = os.fstat(fd).st_ino
+        os.environ[LISTEN_FD_VARIABLE] = str(fd)
+        listenSocket = openListenSocket(0, reusePort=True)
+        self.assertNotIn(LISTEN_FD_VARIABLE, os.environ)
+        self.assertNotEqual(listenSocket.getsockname()[1], self.port)
+        # closed; the descriptor may have been reused by the new socket
+        try:
+            self.assertNotEqual(os.fstat(fd).st_ino, inode)
+        except OSError:
+            pass
+        listenSocket.close()
+
+    def test_prefork_handoff(self):
+        # the port stays bound here, so the server can only use the inherited socket
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+        env[LISTEN_FD_VARIABLE] = str(self.busy.fileno())
+        server = subprocess.Popen([sys.executable, "-c", HANDOFF_SERVER, str(self.port)], env=env,
+                                  pass_fds=[self.busy.fileno()], stdout=subprocess.DEVNULL,
+                                  start_new_session=True)
+        try:
+            client = socket.create_connection(("127.0.0.1", self.port), timeout=10.0)
+            client.sendall(b"GET / HTTP/1.1\r\n\r\n")
+            self.assertEqual(readResponses(client, 1), [b"%d" % server.pid])
+            client.close()
+        finally:
+            # workers retire gracefully on SIGTERM to the master
+            server.terminate()
+            try:
+                server.wait(10.0)
+            except subprocess.TimeoutExpired:
+                os.killpg(server.pid, signal.SIGKILL)
+                raise
+
+    def test_serve_bind_failure(self):
+        listener = ThreadedSocketListener(self.port, None, nThreads=1)
+        listener.listen = lambda: openListenSocket(self.port, bindTimeout=0)
+        # the bind error is reported, not masked by closing a missing socket
+        listener.serve()
+
+
+class MappedFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.content = os.urandom(300000)
+        self.file = tempfile.TemporaryFile()
+        self.file.write(self.content)
+        self.file.seek(0)
+
+    def tearDown(self):
+        self.file.close()
+
+    def test_shared_mapping(self):
+        first = MappedFile.acquire(self.file.fileno())
+        with open("/proc/self/fd/%d" % self.file.fileno(), "rb") as other:
+            second = MappedFile.acquire(other.fileno())
+        self.assertIs(first, second)
+        self.assertEqual(first.refs, 2)
+        first.release()
+        self.assertIn(first.key, MappedFile.mappings)
+        second.release()
+        self.assertNotIn(first.key, MappedFile.mappings)
+
+    def test_chunks(self):
+        self.file.seek(1000)
+        chunks = list(fileChunks(self.file, 290000, 65536))
+        self.assertTrue(all(isinstance(chunk, memoryview) for chunk in chunks))
+        self.assertEqual(b"".join(chunks), self.content[1000:291000])
+        self.assertEqual(self.file.tell(), 291000)
+        self.assertEqual(MappedFile.mappings, {})
+
+    def test_small_reads(self):
+        chunks = list(fileChunks(self.file, 1000, 65536))
+        self.assertEqual(chunks, [self.content[:1000]])
+
+    def test_closed_early(self):
+        chunks = fileChunks(self.file, len(self.content))
+        next(chunks)
+        self.assertEqual(len(MappedFile.mappings), 1)
+        chunks.close()
+        self.assertEqual(MappedFile.mappings, {})
+
@@ -0,0 +1,52 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyttp.precompress import precompress
+
+
+class PrecompressTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = {"app.js": b"function f(x) { return x * 2; }\n" * 100,
+                      "sub/page.html": b"<p>Hello, world!</p>\n" * 100,
+                      "tiny.css": b"p { }",
+                      "logo.png": b"\0" * 1000,
+                      "random.txt": os.urandom(1000)}
+        for name, data in self.files.items():
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_sidecars(self):
+        results = dict((os.path.relpath(filename, self.directory), compressed)
+                       for filename, size, compressed in precompress(self.directory))
+        self.assertEqual(sorted(results), ["app.js", "random.txt", "sub/page.html"])
+        self.assertIsNone(results["random.txt"])
+        self.assertFalse(os.path.exists(self.path("random.txt.gz")))
+        for name in ("app.js", "sub/page.html"):
+            with gzip.open(self.path(name + ".gz")) as f:
+                self.assertEqual(f.read(), self.files[name])
+            self.assertEqual(os.stat(self.path(name + ".gz")).st_mtime_ns,
+                             os.stat(self.path(name)).st_mtime_ns)
+
+    def test_refresh(self):
+        list(precompress(self.directory))
+        with open(self.path("app.js"), "ab") as f:
+            f.write(b"f(1);\n")
+        stat = os.stat(self.path("app.js"))
+        os.utime(self.path("app.js"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        list(precompress(self.directory))
+        with gzip.open(self.path("app.js.gz")) as f:
+            self.assertEqual(f.read(), self.files["app.js"] + b"f(1);\n")
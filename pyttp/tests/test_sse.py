@@ -0,0 +1,114 @@
+import socket
+import threading
+import time
+import unittest
+
+from pyttp.controller import ControllerWSGIApp, Controller, EventStreamResponse, expose
+from pyttp.network import ReadBuffer, openListenSocket
+from pyttp.sse import HEARTBEAT, Broker, formatEvent
+from pyttp.wsgi import DummyLogger, WSGIListener
+
+
+class QuickBroker(Broker):
+
+    heartbeatInterval = 0.5
+
+
+broker = QuickBroker()
+
+
+class Root(Controller):
+
+    @expose
+    def events(self, request):
+        return EventStreamResponse(broker.subscribe("news"))
+
+
+class FormatTests(unittest.TestCase):
+
+    def test_format(self):
+        self.assertEqual(formatEvent("hello"), b"data: hello\n\n")
+        self.assertEqual(formatEvent("two\nlines", event="note", id=7, retry=1000),
+                         b"id: 7\nevent: note\nretry: 1000\ndata: two\ndata: lines\n\n")
+
+
+class BrokerTests(unittest.TestCase):
+
+    def test_fan_out(self):
+        broker = Broker()
+        streams = [broker.subscribe("a") for i in range(3)]
+        other = broker.subscribe("b")
+        self.assertEqual(broker.publish("a", "x"), 3)
+        self.assertEqual(next(streams[0]), b"data: x\n\n")
+        self.assertEqual(other.pending, b"")
+
+    def test_slow_consumer_evicted(self):
+        broker = Broker()
+        stream = broker.subscribe("a")
+        stream.maxBuffered = 100
+        self.assertEqual(broker.publish("a", "x" * 50), 1)
+        self.assertEqual(broker.publish("a", "x" * 50), 0)
+        self.assertTrue(stream.evicted)
+        self.assertEqual(broker.subscriberCount("a"), 0)
+        self.assertEqual(broker.evicted, 1)
+        self.assertRaises(StopIteration, next, stream)
+
+    def test_iteration_heartbeat(self):
+        stream = QuickBroker().subscribe("a")
+        self.assertEqual(next(stream), HEARTBEAT)
+        stream.close()
+        self.assertRaises(StopIteration, next, stream)
+
+
+class EventStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        listenSocket = openListenSocket(0)
+        self.port = listenSocket.getsockname()[1]
+        listener = WSGIListener(ControllerWSGIApp(Root()), self.port, nThreads=1, logger=DummyLogger(quiet=True))
+        thread = threading.Thread(target=listener.serve, args=(listenSocket,))
+        thread.daemon = True
+        thread.start()
+
+    def subscribe(self):
+        client = socket.create_connection(("127.0.0.1", self.port), timeout=2.0)
+        client.sendall(b"GET /events HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        readBuffer = ReadBuffer(client)
+        head = readBuffer.readUntil(b"\r\n\r\n")
+        return client, readBuffer, head
+
+    def waitFor(self, condition):
+        deadline = time.time() + 2.0
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_stream(self):
+        clients = [self.subscribe() for i in range(5)]
+        # a single worker thread served all of them
+        client, readBuffer, head = clients[0]
+        self.assertTrue(head.startswith(b"HTTP/1.1 200"))
+        self.assertIn(b"Content-Type: text/event-stream\r\n", head)
+        self.assertTrue(self.waitFor(lambda: broker.subscriberCount("news") == 5))
+        self.assertEqual(broker.publish("news", "hello", event="greeting"), 5)
+        for client, readBuffer, head in clients:
+            self.assertEqual(readBuffer.readUntil(b"\n\n"), b"event: greeting\ndata: hello\n\n")
+        # silent streams get heartbeats
+        self.assertEqual(clients[0][1].readUntil(b"\n\n"), HEARTBEAT)
+        for client, readBuffer, head in clients:
+            client.close()
+        self.assertTrue(self.waitFor(lambda: broker.subscriberCount("news") == 0))
+
+    def test_close_ends_response(self):
+        client, readBuffer, head = self.subscribe()
+        self.assertTrue(self.waitFor(lambda: broker.subscriberCount("news") == 1))
+        stream = list(broker.channels["news"])[0]
+        stream.send("bye")
+        stream.close()
+        self.assertEqual(readBuffer.readUntil(b"\n\n"), b"data: bye\n\n")
+        self.assertEqual(readBuffer.fill(), 0)
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import time
+import unittest
+
+from pyttp.timers import TimerWheel
+
+
+class TimerWheelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TimerWheel(resolution=0.1, nSlots=8)
+        self.fired = []
+
+    def test_expire_due_only(self):
+        now = time.time()
+        self.wheel.schedule(0.2, self.fired.append, "soon")
+        self.wheel.schedule(5.0, self.fired.append, "later")
+        self.assertEqual(self.wheel.expire(now + 0.1), 0)
+        self.assertEqual(self.wheel.expire(now + 0.4), 1)
+        self.assertEqual(self.fired, ["soon"])
+        self.assertEqual(len(self.wheel), 1)
+        # several revolutions later
+        self.assertEqual(self.wheel.expire(now + 5.2), 1)
+        self.assertEqual(self.fired, ["soon", "later"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel_and_reschedule(self):
+        now = time.time()
+        cancelled = self.wheel.schedule(0.2, self.fired.append, "cancelled")
+        moved = self.wheel.schedule(0.2, self.fired.append, "moved")
+        self.assertTrue(cancelled.cancel())
+        self.assertTrue(moved.reschedule(1.0))
+        self.wheel.expire(now + 0.5)
+        self.assertEqual(self.fired, [])
+        self.wheel.expire(now + 1.2)
+        self.assertEqual(self.fired, ["moved"])
+        self.assertFalse(moved.cancel())
+        self.assertFalse(cancelled.reschedule(1.0))
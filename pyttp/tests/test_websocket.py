@@ -0,0 +1,150 @@
+import os
+import socket
+import struct
+import threading
+import unittest
+
+from pyttp.network import ReadBuffer, openListenSocket
+from pyttp.websocket import (BINARY, CLOSE, CONTINUATION, PING, PONG, TEXT, WebSocketHandler,
+                             acceptKey, packFrame, readFrame)
+from pyttp.wsgi import DummyLogger, WSGIListener
+
+
+class EchoHandler(WebSocketHandler):
+
+    protocols = ["echo"]
+    closed = []
+
+    def onOpen(self, ws):
+        ws.send("hello")
+
+    def onMessage(self, ws, message):
+        if message.text == "close":
+            ws.close(4000, "bye")
+        elif message.binary:
+            ws.send(message.data[::-1])
+        else:
+            ws.send(message.text.upper())
+
+    def onClose(self, ws, code, reason):
+        self.closed.append(code)
+
+
+def app(environ, start_response):
+    start_response("200 OK", [('Content-Type', 'text/plain')])
+    return [b"plain"]
+
+
+class WebSocketTests(unittest.TestCase):
+
+    def setUp(self):
+        listenSocket = openListenSocket(0)
+        self.port = listenSocket.getsockname()[1]
+        listener = WSGIListener(app, self.port, nThreads=2, logger=DummyLogger(quiet=True),
+                                websockets={"/echo": EchoHandler})
+        thread = threading.Thread(target=listener.serve, args=(listenSocket,))
+        thread.daemon = True
+        thread.start()
+
+    def connect(self, path="/echo", version="13"):
+        client = socket.create_connection(("127.0.0.1", self.port), timeout=2.0)
+        client.sendall(("GET %s HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+                        "Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                        "Sec-WebSocket-Protocol: chat, echo\r\n"
+                        "Sec-WebSocket-Version: %s\r\n\r\n" % (path, version)).encode())
+        readBuffer = ReadBuffer(client)
+        head = readBuffer.readUntil(b"\r\n\r\n")
+        return client, readBuffer, head
+
+    def send(self, client, opcode, payload, fin=True):
+        client.sendall(packFrame(opcode, payload, fin, os.urandom(4)))
+
+    def receive(self, readBuffer):
+        while True:
+            frame = readFrame(readBuffer, 1 << 24, masked=False)
+            if frame is not None:
+                return frame
+            if not readBuffer.fill():
+                return None
+
+    def test_accept_key(self):
+        # RFC 6455, 1.3
+        self.assertEqual(acceptKey("dGhlIHNhbXBsZSBub25jZQ=="), "s3pPLMBiTxaQ9kYGzzhZRbK+xOo=")
+
+    def test_handshake_and_echo(self):
+        client, readBuffer, head = self.connect()
+        self.assertTrue(head.startswith(b"HTTP/1.1 101"))
+        self.assertIn(b"Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n", head)
+        self.assertIn(b"Sec-WebSocket-Protocol: echo\r\n", head)
+        self.assertEqual(self.receive(readBuffer), (True, TEXT, b"hello"))
+        self.send(client, TEXT, "grüße".encode("utf-8"))
+        self.assertEqual(self.receive(readBuffer), (True, TEXT, "GRÜSSE".encode("utf-8")))
+        self.send(client, BINARY, b"\x00\x01\x02" * 30000)
+        self.assertEqual(self.receive(readBuffer), (True, BINARY, b"\x02\x01\x00" * 30000))
+        client.close()
+
+    def test_fragments_and_ping(self):
+        client, readBuffer, head = self.connect()
+        self.receive(readBuffer)
+        self.send(client, TEXT, b"frag", fin=False)
+        # control frames may be interleaved with fragments
+        self.send(client, PING, b"p")
+        self.send(client, CONTINUATION, b"mented", fin=False)
+        self.send(client, CONTINUATION, b"!")
+        self.assertEqual(self.receive(readBuffer), (True, PONG, b"p"))
+        self.assertEqual(self.receive(readBuffer), (True, TEXT, b"FRAGMENTED!"))
+        client.close()
+
+    def test_messages_in_order(self):
+        client, readBuffer, head = self.connect()
+        self.receive(readBuffer)
+        client.sendall(b''.join(packFrame(TEXT, b"m%d" % i, True, os.urandom(4)) for i in range(200)))
+        for i in range(200):
+            self.assertEqual(self.receive(readBuffer)[2], b"M%d" % i)
+        client.close()
+
+    def test_server_close(self):
+        client, readBuffer, head = self.connect()
+        self.receive(readBuffer)
+        self.send(client, TEXT, b"close")
+        self.assertEqual(self.receive(readBuffer), (True, CLOSE, struct.pack(">H", 4000) + b"bye"))
+        self.send(client, CLOSE, struct.pack(">H", 4000))
+        self.assertEqual(self.receive(readBuffer), None)
+        client.close()
+
+    def test_client_close(self):
+        client, readBuffer, head = self.connect()
+        self.receive(readBuffer)
+        self.send(client, CLOSE, struct.pack(">H", 1000))
+        self.assertEqual(self.receive(readBuffer), (True, CLOSE, struct.pack(">H", 1000)))
+        self.assertEqual(self.receive(readBuffer), None)
+        client.close()
+
+    def test_unmasked_frame(self):
+        client, readBuffer, head = self.connect()
+        self.receive(readBuffer)
+        client.sendall(packFrame(TEXT, b"unmasked"))
+        self.assertEqual(self.receive(readBuffer), (True, CLOSE, struct.pack(">H", 1002)))
+        self.assertEqual(self.receive(readBuffer), None)
+        client.close()
+
+    def test_invalid_utf8(self):
+        client, readBuffer, head = self.connect()
+        self.receive(readBuffer)
+        self.send(client, TEXT, b"\xff\xfe")
+        self.assertEqual(self.receive(readBuffer), (True, CLOSE, struct.pack(">H", 1007)))
+        client.close()
+
+    def test_bad_version(self):
+        client, readBuffer, head = self.connect(version="8")
+        self.assertTrue(head.startswith(b"HTTP/1.1 400"))
+        client.close()
+
+    def test_unregistered_path(self):
+        client, readBuffer, head = self.connect(path="/other")
+        self.assertTrue(head.startswith(b"HTTP/1.1 200"))
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,671 @@
+import hashlib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+from pyttp.apps import Compressor, FileCache, FileRange, FileServer
+from pyttp.network import ReadBuffer
+from pyttp.wsgi import DummyLogger, FileWrapper, WSGIHandler
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+    start_response("200 OK", [('Content-Type', 'text/plain')])
+    return [environ['PATH_INFO'].encode() + b":" + body]
+
+
+class HandlerTestCase(unittest.TestCase):
+
+    app = staticmethod(echo_app)
+
+    def setUp(self):
+        self.conn, self.client = socket.socketpair()
+        self.client.settimeout(1.0)
+        self.readBuffer = ReadBuffer(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+        self.client.close()
+
+    def handle(self, **options):
+        handler = WSGIHandler(self.app, 80, logger=DummyLogger(quiet=True), **options)
+        return handler.handleRequest(self.conn, ('127.0.0.1', 0), self.readBuffer)
+
+    def receive(self):
+        try:
+            self.conn.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        data = b''
+        try:
+            while True:
+                chunk = self.client.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            pass
+        return data
+
+
+class WSGIHandlerTests(HandlerTestCase):
+
+    def test_pipelined_bodies(self):
+        self.client.sendall(b"POST /a HTTP/1.1\r\nHost: x\r\nContent-Length: 3\r\n\r\nabc"
+                            b"PUT /b HTTP/1.1\r\nHost: x\r\nContent-Length: 2\r\n\r\nde"
+                            b"GET /c HTTP/1.1\r\nHost: x\r\n\r\n")
+        self.assertTrue(self.handle())
+        self.assertTrue(self.handle())
+        self.assertTrue(self.handle())
+        self.assertEqual(len(self.readBuffer), 0)
+        data = self.receive()
+        self.assertIn(b"/a:abc", data)
+        self.assertIn(b"/b:de", data)
+        self.assertIn(b"/c:", data)
+
+    def test_unread_body_is_drained(self):
+        self.app = lambda environ, start_response: (start_response("200 OK", []), [b"ok"])[1]
+        self.client.sendall(b"POST /a HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+                            b"GET /b HTTP/1.1\r\n\r\n")
+        self.assertTrue(self.handle())
+        self.assertEqual(self.readBuffer.read(), b"GET /b HTTP/1.1\r\n\r\n")
+
+    def test_trickled_head_times_out(self):
+        self.client.sendall(b"GET / HTTP/1.1\r\n")
+        start = time.time()
+        self.assertFalse(self.handle(headerTimeout=0.3))
+        self.assertLess(time.time() - start, 2.0)
+
+    def test_partly_read_body_does_not_abort_response(self):
+        def app(environ, start_response):
+            environ['wsgi.input'].read(100000)
+            start_response("200 OK", [('Content-Type', 'text/plain')])
+            def slow():
+                time.sleep(0.5)
+                yield b"done"
+            return slow()
+        self.app = app
+        body = b"x" * 200000
+        sender = threading.Thread(target=self.client.sendall,
+                                  args=(b"POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body,))
+        sender.start()
+        # the response outlasts bodyTimeout; the rest of the body is drained
+        self.assertTrue(self.handle(bodyTimeout=0.2))
+        sender.join()
+        self.assertTrue(self.receive().endswith(b"Content-Length: 4\r\n\r\ndone"))
+
+    def test_drain_closes_idle_connection(self):
+        handler = WSGIHandler(self.app, 80, logger=DummyLogger(quiet=True))
+        thread = threading.Thread(target=handler, args=(self.conn, ('127.0.0.1', 0)))
+        self.client.sendall(b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n")
+        thread.start()
+        self.assertIn(b"/a:", self.client.recv(65536))
+        time.sleep(0.1)
+        handler.drain()
+        thread.join(1.0)
+        self.assertFalse(thread.is_alive())
+
+    def test_connection_close(self):
+        self.client.sendall(b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+        self.assertFalse(self.handle())
+
+    def test_header_limit(self):
+        self.client.sendall(b"GET / HTTP/1.1\r\nX-Foo: " + b"a" * 100 + b"\r\n\r\n")
+        self.assertFalse(self.handle(maxHeaderSize=50))
+        self.assertTrue(self.receive().startswith(b"HTTP/1.1 431 "))
+
+
+def read_all_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response("200 OK", [('Content-Type', 'text/plain')])
+    return [environ['PATH_INFO'].encode() + b":" + body]
+
+
+def digest_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response("200 OK", [('Content-Type', 'text/plain')])
+    return [hashlib.sha1(body).hexdigest().encode()]
+
+
+def readline_app(environ, start_response):
+    lines = environ['wsgi.input'].readlines()
+    start_response("200 OK", [('Content-Type', 'text/plain')])
+    return [b"|".join(lines)]
+
+
+class RequestBodyTests(HandlerTestCase):
+
+    app = staticmethod(read_all_app)
+
+    def test_chunked(self):
+        self.client.sendall(b"POST /a HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+                            b"5;ext=1\r\nhello\r\n1\r\n \r\nA\r\n0123456789\r\n"
+                            b"0\r\nX-Trailer: yes\r\n\r\n"
+                            b"GET /b HTTP/1.1\r\n\r\n")
+        self.assertTrue(self.handle())
+        self.assertEqual(self.readBuffer.read(), b"GET /b HTTP/1.1\r\n\r\n")
+        self.assertTrue(self.receive().endswith(b"/a:hello 0123456789"))
+
+    def test_chunked_readline(self):
+        self.app = readline_app
+        self.client.sendall(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+                            b"5\r\nab\ncd\r\n3\r\nef\n\r\n1\r\ng\r\n0\r\n\r\n")
+        self.assertTrue(self.handle())
+        self.assertTrue(self.receive().endswith(b"ab\n|cdef\n|g"))
+
+    def test_invalid_chunk_size(self):
+        self.client.sendall(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n")
+        self.assertFalse(self.handle())
+        self.assertTrue(self.receive().startswith(b"HTTP/1.1 400 "))
+
+    def test_ambiguous_framing(self):
+        self.client.sendall(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n"
+                            b"Content-Length: 3\r\n\r\n0\r\n\r\n")
+        self.assertFalse(self.handle())
+        self.assertTrue(self.receive().startswith(b"HTTP/1.1 400 "))
+
+    def test_unknown_transfer_encoding(self):
+        self.client.sendall(b"POST / HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\n")
+        self.assertFalse(self.handle())
+        self.assertTrue(self.receive().startswith(b"HTTP/1.1 501 "))
+
+    def test_large_body(self):
+        self.app = digest_app
+        data = os.urandom(1000000)
+        thread = threading.Thread(target=self.client.sendall,
+                                  args=(b"PUT /big HTTP/1.1\r\nContent-Length: 1000000\r\n\r\n" + data,))
+        thread.start()
+        self.assertTrue(self.handle())
+        thread.join()
+        self.assertTrue(self.receive().endswith(hashlib.sha1(data).hexdigest().encode()))
+
+    def test_expect_continue(self):
+        self.client.sendall(b"POST /a HTTP/1.1\r\nContent-Length: 5\r\nExpect: 100-continue\r\n\r\n")
+        thread = threading.Thread(target=self.handle)
+        thread.start()
+        self.assertEqual(self.client.recv(65536), b"HTTP/1.1 100 Continue\r\n\r\n")
+        self.client.sendall(b"hello")
+        thread.join(1.0)
+        self.assertTrue(self.receive().endswith(b"/a:hello"))
+
+    def test_expect_continue_unread(self):
+        self.app = lambda environ, start_response: (start_response("403 Forbidden", []), [b"no"])[1]
+        self.client.sendall(b"POST /a HTTP/1.1\r\nContent-Length: 5\r\nExpect: 100-continue\r\n\r\n")
+        # the client may never send the body, so the connection is not reused
+        self.assertFalse(self.handle())
+        self.assertTrue(self.receive().startswith(b"HTTP/1.1 403 "))
+
+    def test_unknown_expectation(self):
+        self.client.sendall(b"POST / HTTP/1.1\r\nContent-Length: 1\r\nExpect: magic\r\n\r\nx")
+        self.assertFalse(self.handle())
+        self.assertTrue(self.receive().startswith(b"HTTP/1.1 417 "))
+
+
+def generator_app(*chunks, **kwargs):
+    headers = kwargs.get('headers', [])
+    def app(environ, start_response):
+        start_response("200 OK", list(headers))
+        for chunk in chunks:
+            yield chunk
+    return app
+
+
+class FramingTests(HandlerTestCase):
+
+    def request(self, request=b"GET / HTTP/1.1\r\n\r\n"):
+        self.client.sendall(request)
+        keepAlive = self.handle()
+        head, _, body = self.receive().partition(b"\r\n\r\n")
+        return keepAlive, head, body
+
+    def test_list_response(self):
+        self.app = lambda environ, start_response: (start_response("200 OK", []), ["foo", b"bar"])[1]
+        keepAlive, head, body = self.request()
+        self.assertIn(b"Content-Length: 6", head)
+        self.assertEqual(body, b"foobar")
+
+    def test_single_chunk_generator(self):
+        self.app = generator_app("h\xe9llo")
+        keepAlive, head, body = self.request()
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertIn(b"Content-Length: 6", head)
+        self.assertEqual(body, "h\xe9llo".encode())
+
+    def test_chunked_generator(self):
+        self.app = generator_app("foo", b"", "bar")
+        keepAlive, head, body = self.request()
+        self.assertTrue(keepAlive)
+        self.assertIn(b"Transfer-Encoding: chunked", head)
+        self.assertEqual(body, b"3\r\nfoo\r\n3\r\nbar\r\n0\r\n\r\n")
+
+    def test_http10_generator(self):
+        self.app = generator_app("foo", "bar")
+        keepAlive, head, body = self.request(b"GET / HTTP/1.0\r\n\r\n")
+        self.assertFalse(keepAlive)
+        self.assertNotIn(b"Transfer-Encoding", head)
+        self.assertEqual(body, b"foobar")
+
+    def test_app_content_length(self):
+        self.app = generator_app("foo", "bar", headers=[('Content-Length', '6')])
+        keepAlive, head, body = self.request()
+        self.assertTrue(keepAlive)
+        self.assertEqual(head.count(b"Content-Length"), 1)
+        self.assertEqual(body, b"foobar")
+
+    def test_head(self):
+        self.app = generator_app("foo")
+        keepAlive, head, body = self.request(b"HEAD / HTTP/1.1\r\n\r\n")
+        self.assertIn(b"Content-Length: 3", head)
+        self.assertEqual(body, b"")
+
+
+def html_app(*chunks, **kwargs):
+    headers = [('Content-Type', 'text/html; charset=UTF-8')] + kwargs.get('headers', [])
+    if kwargs.get('listed'):
+        return lambda environ, start_response: (start_response("200 OK", list(headers)), list(chunks))[1]
+    return generator_app(*chunks, headers=headers)
+
+
+def dechunk(body):
+    data = b''
+    while True:
+        size, _, body = body.partition(b"\r\n")
+        size = int(size, 16)
+        if not size:
+            return data
+        data += body[:size]
+        body = body[size + 2:]
+
+
+class CompressorTests(HandlerTestCase):
+
+    page = "<p>Hello, world!</p>" * 100
+
+    def request(self, accept=b"gzip, deflate", verb=b"GET"):
+        self.client.sendall(verb + b" / HTTP/1.1\r\nAccept-Encoding: " + accept + b"\r\n\r\n")
+        keepAlive = self.handle()
+        head, _, body = self.receive().partition(b"\r\n\r\n")
+        return keepAlive, head, body
+
+    def test_negotiate(self):
+        compressor = Compressor(None)
+        self.assertEqual(compressor.negotiate("gzip, deflate, br"), "gzip")
+        self.assertEqual(compressor.negotiate("deflate;q=1, gzip;q=0.5"), "deflate")
+        self.assertEqual(compressor.negotiate("gzip;q=0, *"), "deflate")
+        self.assertEqual(compressor.negotiate("*;q=0.1"), "gzip")
+        self.assertEqual(compressor.negotiate("identity, br"), None)
+        self.assertEqual(compressor.negotiate(""), None)
+
+    def test_streamed(self):
+        self.app = Compressor(html_app(*[self.page[i:i + 100] for i in range(0, len(self.page), 100)]))
+        keepAlive, head, body = self.request()
+        self.assertTrue(keepAlive)
+        self.assertIn(b"Content-Encoding: gzip", head)
+        self.assertIn(b"Vary: Accept-Encoding", head)
+        self.assertIn(b"Transfer-Encoding: chunked", head)
+        self.assertEqual(zlib.decompress(dechunk(body), 16 + zlib.MAX_WBITS), self.page.encode())
+
+    def test_listed(self):
+        self.app = Compressor(html_app(self.page, listed=True, headers=[('Vary', 'Cookie'), ('ETag', '"v1"')]), level=9)
+        keepAlive, head, body = self.request(b"deflate")
+        self.assertIn(b"Content-Encoding: deflate", head)
+        self.assertIn(b"Content-Length: %d" % len(body), head)
+        self.assertIn(b"Vary: Cookie, Accept-Encoding", head)
+        self.assertIn(b'ETag: W/"v1"', head)
+        self.assertLess(len(body), len(self.page) // 10)
+        self.assertEqual(zlib.decompress(body), self.page.encode())
+
+    def test_identity(self):
+        self.app = Compressor(html_app(self.page, self.page))
+        keepAlive, head, body = self.request(b"identity")
+        self.assertNotIn(b"Content-Encoding", head)
+        self.assertIn(b"Vary: Accept-Encoding", head)
+        self.assertEqual(dechunk(body), 2 * self.page.encode())
+
+    def test_tiny_body(self):
+        self.app = Compressor(html_app("<p>", "tiny</p>"))
+        keepAlive, head, body = self.request()
+        self.assertNotIn(b"Content-Encoding", head)
+        self.assertIn(b"Content-Length: 11", head)
+        self.assertEqual(body, b"<p>tiny</p>")
+
+    def test_incompressible_type(self):
+        self.app = Compressor(generator_app(self.page, headers=[('Content-Type', 'image/png')]))
+        keepAlive, head, body = self.request()
+        self.assertNotIn(b"Content-Encoding", head)
+        self.assertNotIn(b"Vary", head)
+        self.assertEqual(body, self.page.encode())
+
+    def test_head(self):
+        self.app = Compressor(html_app(self.page))
+        keepAlive, head, body = self.request(verb=b"HEAD")
+        self.assertIn(b"Content-Encoding: gzip", head)
+        self.assertEqual(body, b"")
+
+
+class FileWrapperTests(HandlerTestCase):
+
+    def setUp(self):
+        super(FileWrapperTests, self).setUp()
+        self.document_root = tempfile.mkdtemp()
+        self.content = os.urandom(20000)
+        with open(os.path.join(self.document_root, "data.bin"), "wb") as f:
+            f.write(self.content)
+        self.app = FileServer(self.document_root)
+
+    def tearDown(self):
+        super(FileWrapperTests, self).tearDown()
+        shutil.rmtree(self.document_root)
+
+    def test_sendfile(self):
+        self.client.sendall(b"GET /data.bin HTTP/1.1\r\n\r\n")
+        self.assertTrue(self.handle())
+        head, _, body = self.receive().partition(b"\r\n\r\n")
+        self.assertIn(b"Content-Length: 20000", head)
+        self.assertNotIn(b"Transfer-Encoding", head)
+        self.assertEqual(body, self.content)
+
+    def test_compressor_keeps_sendfile(self):
+        self.app = Compressor(self.app)
+        self.client.sendall(b"GET /data.bin HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n")
+        self.assertTrue(self.handle())
+        head, _, body = self.receive().partition(b"\r\n\r\n")
+        self.assertIn(b"Content-Length: 20000", head)
+        self.assertNotIn(b"Content-Encoding", head)
+        self.assertEqual(body, self.content)
+
+    def test_mapped_iteration(self):
+        content = os.urandom(400000)
+        filename = os.path.join(self.document_root, "large.bin")
+        with open(filename, "wb") as f:
+            f.write(content)
+        wrapper = FileWrapper(FileRange(open(filename, "rb"), 1000, 300000))
+        self.assertEqual(wrapper.remaining(), 300000)
+        chunks = list(wrapper)
+        wrapper.close()
+        self.assertTrue(all(isinstance(chunk, memoryview) for chunk in chunks))
+        self.assertEqual(b"".join(chunks), content[1000:301000])
+
+    def test_pipe(self):
+        def app(environ, start_response):
+            reader, writer = os.pipe()
+            os.write(writer, self.content)
+            os.close(writer)
+            start_response("200 OK", [('Content-Type', 'application/octet-stream')])
+            return environ['wsgi.file_wrapper'](os.fdopen(reader, "rb"), 4096)
+        self.app = app
+        self.client.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        self.assertTrue(self.handle())
+        head, _, body = self.receive().partition(b"\r\n\r\n")
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertIn(b"Transfer-Encoding: chunked", head)
+        chunks = []
+        while body:
+            size, _, body = body.partition(b"\r\n")
+            chunks.append(body[:int(size, 16)])
+            body = body[int(size, 16) + 2:]
+        self.assertEqual(b"".join(chunks), self.content)
+
+    def get(self, *headers):
+        self.client.sendall(b"\r\n".join((b"GET /data.bin HTTP/1.1",) + headers) + b"\r\n\r\n")
+        self.assertTrue(self.handle())
+        head, _, body = self.receive().partition(b"\r\n\r\n")
+        return head, body
+
+    def test_range(self):
+        head, body = self.get(b"Range: bytes=1000-1999")
+        self.assertTrue(head.startswith(b"HTTP/1.1 206 Partial Content\r\n"))
+        self.assertIn(b"Content-Range: bytes 1000-1999/20000", head)
+        self.assertIn(b"Content-Length: 1000", head)
+        self.assertEqual(body, self.content[1000:2000])
+
+    def test_suffix_range_without_file_wrapper(self):
+        app = self.app
+        def no_wrapper(environ, start_response):
+            del environ['wsgi.file_wrapper']
+            return app(environ, start_response)
+        self.app = no_wrapper
+        head, body = self.get(b"Range: bytes=-500")
+        self.assertIn(b"Content-Range: bytes 19500-19999/20000", head)
+        self.assertEqual(body, self.content[-500:])
+
+    def test_multiple_ranges(self):
+        head, body = self.get(b"Range: bytes=0-9, 5-19, 19000-")
+        self.assertTrue(head.startswith(b"HTTP/1.1 206 Partial Content\r\n"))
+        boundary = head.split(b"boundary=")[1].split(b"\r\n")[0]
+        self.assertIn(b"Content-Length: %d" % len(body), head)
+        parts = body.split(b"--" + boundary)
+        self.assertEqual(parts[0], b"")
+        self.assertEqual(parts[-1], b"--\r\n")
+        expected = [(0, 19), (19000, 19999)]
+        for part, (first, last) in zip(parts[1:-1], expected):
+            partHead, _, data = part.partition(b"\r\n\r\n")
+            self.assertIn(b"Content-Range: bytes %d-%d/20000" % (first, last), partHead)
+            self.assertEqual(data, self.content[first:last + 1] + b"\r\n")
+
+    def test_unsatisfiable_range(self):
+        head, body = self.get(b"Range: bytes=20000-")
+        self.assertTrue(head.startswith(b"HTTP/1.1 416 "))
+        self.assertIn(b"Content-Range: bytes */20000", head)
+
+    def test_invalid_range_is_ignored(self):
+        head, body = self.get(b"Range: bytes=9-1")
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertIn(b"Accept-Ranges: bytes", head)
+        self.assertEqual(body, self.content)
+
+    def reconnect(self):
+        HandlerTestCase.tearDown(self)
+        HandlerTestCase.setUp(self)
+
+    def header(self, head, name):
+        return head.split(name + b": ")[1].split(b"\r\n")[0]
+
+    def test_if_none_match(self):
+        head, body = self.get()
+        etag = self.header(head, b"ETag")
+        self.reconnect()
+        head, body = self.get(b"If-None-Match: W/\"other\", " + etag)
+        self.assertTrue(head.startswith(b"HTTP/1.1 304 Not Modified\r\n"))
+        self.assertIn(b"ETag: " + etag, head)
+        self.assertIn(b"Cache-Control: ", head)
+        self.assertNotIn(b"Content-Length", head)
+        self.assertNotIn(b"Content-Type", head)
+        self.assertEqual(body, b"")
+
+    def test_if_modified_since(self):
+        lastModified = self.header(self.get()[0], b"Last-Modified")
+        self.reconnect()
+        head, body = self.get(b"If-Modified-Since: " + lastModified)
+        self.assertTrue(head.startswith(b"HTTP/1.1 304 Not Modified\r\n"))
+        self.reconnect()
+        head, body = self.get(b"If-Modified-Since: Thu, 01 Jan 1970 00:00:00 GMT")
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertEqual(body, self.content)
+
+    def test_etag_changes_with_file(self):
+        head, body = self.get()
+        etag = self.header(head, b"ETag")
+        with open(os.path.join(self.document_root, "data.bin"), "ab") as f:
+            f.write(b"more")
+        self.reconnect()
+        head, body = self.get(b"If-None-Match: " + etag)
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertNotEqual(self.header(head, b"ETag"), etag)
+        self.assertEqual(body, self.content + b"more")
+
+    def test_if_range(self):
+        head, body = self.get()
+        etag = self.header(head, b"ETag")
+        self.reconnect()
+        head, body = self.get(b"Range: bytes=0-99", b"If-Range: " + etag)
+        self.assertTrue(head.startswith(b"HTTP/1.1 206 "))
+        self.reconnect()
+        head, body = self.get(b"Range: bytes=0-99", b"If-Range: W/" + etag)
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 "))
+        lastModified = self.header(head, b"Last-Modified")
+        self.reconnect()
+        head, body = self.get(b"Range: bytes=0-99", b"If-Range: " + lastModified)
+        self.assertTrue(head.startswith(b"HTTP/1.1 206 "))
+        self.assertEqual(body, self.content[:100])
+        self.reconnect()
+        head, body = self.get(b"Range: bytes=0-99", b"If-Range: Thu, 01 Jan 1970 00:00:00 GMT")
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 "))
+        self.assertEqual(body, self.content)
+
+
+class CachedFileTests(FileWrapperTests):
+    """Runs the file tests with every file revalidated from the cache."""
+
+    def setUp(self):
+        super(CachedFileTests, self).setUp()
+        self.cache = FileCache(max_size=50000, max_file_size=30000, revalidate=0)
+        self.app = FileServer(self.document_root, cache=self.cache)
+
+    def test_sendfile(self):
+        for i in range(3):
+            self.client.sendall(b"GET /data.bin HTTP/1.1\r\n\r\n")
+            self.assertTrue(self.handle())
+        head, _, body = self.receive().partition(b"\r\n\r\n")
+        self.assertIn(b"Content-Length: 20000", head)
+        self.assertTrue(body.startswith(self.content))
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+        self.assertEqual(self.cache.size, 20000)
+
+    def test_revalidation_interval(self):
+        self.cache.revalidate = 60
+        self.get()
+        with open(os.path.join(self.document_root, "data.bin"), "wb") as f:
+            f.write(b"new")
+        self.reconnect()
+        head, body = self.get()
+        self.assertEqual(body, self.content)
+        self.cache.revalidate = 0
+        self.reconnect()
+        head, body = self.get()
+        self.assertEqual(body, b"new")
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_removed_file(self):
+        self.get()
+        os.unlink(os.path.join(self.document_root, "data.bin"))
+        self.reconnect()
+        self.client.sendall(b"GET /data.bin HTTP/1.1\r\n\r\n")
+        self.handle()
+        self.assertTrue(self.receive().startswith(b"HTTP/1.1 404 "))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_eviction(self):
+        for name in ("a", "b", "c"):
+            with open(os.path.join(self.document_root, name), "wb") as f:
+                f.write(name.encode() * 20000)
+        with open(os.path.join(self.document_root, "large"), "wb") as f:
+            f.write(b"l" * 40000)
+        for name in (b"a", b"b", b"a", b"c", b"large"):
+            self.reconnect()
+            self.client.sendall(b"GET /" + name + b" HTTP/1.1\r\n\r\n")
+            self.assertTrue(self.handle())
+        self.assertEqual(sorted(key[1] for key in self.cache.entries), ["/a", "/c"])
+        self.assertEqual(self.cache.size, 40000)
+
+
+class PrecompressedTests(HandlerTestCase):
+
+    def setUp(self):
+        super(PrecompressedTests, self).setUp()
+        self.document_root = tempfile.mkdtemp()
+        self.content = b"body { color: red }\n" * 100
+        self.filename = os.path.join(self.document_root, "site.css")
+        with open(self.filename, "wb") as f:
+            f.write(self.content)
+        with open(self.filename + ".gz", "wb") as f:
+            f.write(self.gzip(self.content))
+        self.app = FileServer(self.document_root, precompressed=True, cache=FileCache())
+
+    def tearDown(self):
+        super(PrecompressedTests, self).tearDown()
+        shutil.rmtree(self.document_root)
+
+    def gzip(self, data):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def get(self, path=b"/site.css", accept=b"gzip, deflate"):
+        self.reconnect()
+        self.client.sendall(b"GET " + path + b" HTTP/1.1\r\nAccept-Encoding: " + accept + b"\r\n\r\n")
+        self.assertTrue(self.handle())
+        head, _, body = self.receive().partition(b"\r\n\r\n")
+        return head, body
+
+    def reconnect(self):
+        HandlerTestCase.tearDown(self)
+        HandlerTestCase.setUp(self)
+
+    def test_sidecar(self):
+        for i in range(2):
+            head, body = self.get()
+            self.assertIn(b"Content-Type: text/css", head)
+            self.assertIn(b"Content-Encoding: gzip", head)
+            self.assertIn(b"Vary: Accept-Encoding", head)
+            self.assertIn(b"Content-Length: %d" % len(body), head)
+            self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), self.content)
+        gzipped = head.split(b"ETag: ")[1].split(b"\r\n")[0]
+        head, body = self.get(accept=b"identity")
+        self.assertNotIn(b"Content-Encoding", head)
+        self.assertIn(b"Vary: Accept-Encoding", head)
+        self.assertNotIn(gzipped, head)
+        self.assertEqual(body, self.content)
+        self.assertEqual((self.app.cache.hits, len(self.app.cache)), (1, 2))
+
+    def test_sidecar_not_modified(self):
+        etag = self.get()[0].split(b"ETag: ")[1].split(b"\r\n")[0]
+        head, body = self.get(accept=b"gzip\r\nIf-None-Match: " + etag)
+        self.assertTrue(head.startswith(b"HTTP/1.1 304 Not Modified\r\n"))
+        self.assertIn(b"Vary: Accept-Encoding", head)
+        self.assertNotIn(b"Content-Encoding", head)
+        self.assertNotIn(b"Content-Type", head)
+        self.assertEqual(body, b"")
+
+    def test_stale_sidecar(self):
+        stat = os.stat(self.filename)
+        os.utime(self.filename + ".gz", ns=(stat.st_atime_ns, stat.st_mtime_ns - 10**9))
+        head, body = self.get()
+        self.assertNotIn(b"Content-Encoding", head)
+        self.assertEqual(body, self.content)
+
+    def test_source_modified_after_cached_hit(self):
+        self.app.cache.revalidate = 0
+        for i in range(2):
+            head, body = self.get()
+            self.assertIn(b"Content-Encoding: gzip", head)
+        self.assertEqual(self.app.cache.hits, 1)
+        stat = os.stat(self.filename + ".gz")
+        os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        head, body = self.get()
+        self.assertNotIn(b"Content-Encoding", head)
+        self.assertEqual(body, self.content)
+        self.assertEqual(self.app.cache.hits, 1)
+
+    def test_sidecar_created_later(self):
+        os.unlink(self.filename + ".gz")
+        for i in range(2):
+            head, body = self.get()
+            self.assertNotIn(b"Content-Encoding", head)
+        self.assertEqual(list(self.app.cache.entries), [(self.document_root, "/site.css", None)])
+        self.assertEqual(self.app.cache.hits, 1)
+        with open(self.filename + ".gz", "wb") as f:
+            f.write(self.gzip(self.content))
+        head, body = self.get()
+        self.assertIn(b"Content-Encoding: gzip", head)
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), self.content)
+
+    def test_gzip_file(self):
+        head, body = self.get(b"/site.css.gz")
+        self.assertIn(b"Content-Type: application/gzip", head)
+        self.assertNotIn(b"Content-Encoding", head)
+
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import math
+import threading
+import time
+
+
+class Timer(object):
+    """
+    A callback scheduled on a TimerWheel.
+    """
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.slot = None
+        self.active = True
+
+    def cancel(self):
+        """Returns False if the timer already fired."""
+        return self.wheel.cancel(self)
+
+    def reschedule(self, delay):
+        """Move the deadline to delay seconds from now; False if the timer already fired."""
+        return self.wheel.reschedule(self, delay)
+
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel.
+
+    Timers are hashed by their deadline into one of nSlots buckets of
+    resolution seconds each, so scheduling and cancelling cost the same
+    no matter how many connections are tracked. A bucket may hold timers
+    of later revolutions; expire() only fires the ones which are due.
+
+    Callbacks run with the wheel locked, so once cancel() returned the
+    callback is guaranteed not to run anymore. They have to be quick.
+    """
+
+    default = None
+    defaultLock = threading.Lock()
+
+    def __init__(self, resolution = 0.1, nSlots = 512):
+        self.resolution = resolution
+        self.nSlots = nSlots
+        self.slots = [set() for i in range(nSlots)]
+        self.lock = threading.RLock()
+        self.current = int(time.time() / resolution)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) delay seconds from now."""
+        timer = Timer(self, time.time() + delay, callback, args)
+        with self.lock:
+            self.insert(timer)
+        return timer
+
+    def insert(self, timer):
+        tick = max(int(math.ceil(timer.deadline / self.resolution)), self.current)
+        timer.slot = self.slots[tick % self.nSlots]
+        timer.slot.add(timer)
+        self.count += 1
+
+    def cancel(self, timer):
+        with self.lock:
+            if not timer.active:
+                return False
+            timer.active = False
+            timer.slot.discard(timer)
+            self.count -= 1
+            return True
+
+    def reschedule(self, timer, delay):
+        with self.lock:
+            if not timer.active:
+                return False
+            timer.slot.discard(timer)
+            self.count -= 1
+            timer.deadline = time.time() + delay
+            self.insert(timer)
+            return True
+
+    def expire(self, now = None):
+        """
+        Fire all timers due at now (default: the current time).
+        Returns the number of timers fired.
+        """
+        if now is None:
+            now = time.time()
+        fired = 0
+        with self.lock:
+            last = int(now / self.resolution)
+            # a full revolution visits every bucket
+            for tick in range(max(self.current, last - self.nSlots + 1), last + 1):
+                slot = self.slots[tick % self.nSlots]
+                due = [timer for timer in slot if timer.deadline <= now]
+                for timer in due:
+                    slot.discard(timer)
+                    timer.active = False
+                    self.count -= 1
+                for timer in due:
+                    try:
+                        timer.callback(*timer.args)
+                    except Exception as e:
+                        print(e)
+                fired += len(due)
+            self.current = max(self.current, last + 1)
+        return fired
+
+    @classmethod
+    def getDefault(cls):
+        """The process-wide wheel, driven by a TimerThread."""
+        with cls.defaultLock:
+            if cls.default is None:
+                cls.default = TimerWheel()
+                TimerThread(cls.default).start()
+            return cls.default
+
+
+class TimerThread(threading.Thread):
+    """
+    Background thread advancing a TimerWheel once per tick.
+    """
+
+    def __init__(self, wheel):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.wheel = wheel
+
+    def run(self):
+        while True:
+            time.sleep(self.wheel.resolution)
+            self.wheel.expire()
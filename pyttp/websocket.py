@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import base64
+import collections
+import hashlib
+import selectors
+import socket
+import ssl
+import struct
+import threading
+import time
+import traceback
+
+from pyttp.core import PyTTPException
+from pyttp.network import WorkerPool
+from pyttp.timers import TimerWheel
+
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# opcodes
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xa
+
+# close codes
+NORMAL_CLOSURE = 1000
+GOING_AWAY = 1001
+PROTOCOL_ERROR = 1002
+UNSUPPORTED_DATA = 1003
+NO_STATUS = 1005
+ABNORMAL_CLOSURE = 1006
+INVALID_DATA = 1007
+POLICY_VIOLATION = 1008
+MESSAGE_TOO_BIG = 1009
+INTERNAL_ERROR = 1011
+
+WOULD_BLOCK = (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+
+class WebSocketError(PyTTPException):
+    """
+    Protocol violation by the client; the connection is closed with code.
+    """
+
+    def __init__(self, code, msg):
+        self.code = code
+        self.msg = msg
+
+    def __str__(self):
+        return "WebSocket: %s (close code %s)" % (self.msg, self.code)
+
+
+class WebSocketClosed(PyTTPException):
+    """
+    Raised when sending on a closed WebSocket or when the client does not
+    read fast enough to make room in the send buffer.
+    """
+
+
+def acceptKey(key):
+    """Sec-WebSocket-Accept value for the client's Sec-WebSocket-Key."""
+    digest = hashlib.sha1((key.strip() + GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+
+def handshakeResponse(key, protocol = None):
+    lines = ["HTTP/1.1 101 Switching Protocols",
+             "Upgrade: websocket",
+             "Connection: Upgrade",
+             "Sec-WebSocket-Accept: %s" % acceptKey(key)]
+    if protocol:
+        lines.append("Sec-WebSocket-Protocol: %s" % protocol)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+def mask(data, key):
+    """XOR data with the 4 byte masking key; masking and unmasking are the same."""
+    n = len(data)
+    if not n:
+        return b''
+    keyStream = (key * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(keyStream, "big")).to_bytes(n, "big")
+
+
+def packFrame(opcode, payload = b'', fin = True, maskKey = None):
+    """
+    Frame payload. Servers send unmasked frames; clients pass a
+    maskKey, which os.urandom(4) provides.
+    """
+    n = len(payload)
+    head = bytearray([(0x80 if fin else 0) | opcode])
+    maskBit = 0x80 if maskKey else 0
+    if n < 126:
+        head.append(maskBit | n)
+    elif n < 65536:
+        head.append(maskBit | 126)
+        head += struct.pack(">H", n)
+    else:
+        head.append(maskBit | 127)
+        head += struct.pack(">Q", n)
+    if maskKey:
+        return bytes(head) + maskKey + mask(payload, maskKey)
+    return bytes(head) + payload
+
+
+def readFrame(readBuffer, maxSize, masked = True):
+    """
+    Consume one complete frame from readBuffer without touching the socket.
+    Returns fin, opcode and the unmasked payload, or None if the frame
+    did not arrive completely yet.
+    """
+    head = readBuffer.peek(14)
+    if len(head) < 2:
+        return None
+    fin = bool(head[0] & 0x80)
+    opcode = head[0] & 0x0f
+    if head[0] & 0x70:
+        raise WebSocketError(PROTOCOL_ERROR, "Reserved bits set")
+    if bool(head[1] & 0x80) != masked:
+        raise WebSocketError(PROTOCOL_ERROR, "Client frames have to be masked")
+    length = head[1] & 0x7f
+    offset = 2
+    if length == 126:
+        offset = 4
+        if len(head) < offset:
+            return None
+        length = struct.unpack(">H", head[2:4])[0]
+    elif length == 127:
+        offset = 10
+        if len(head) < offset:
+            return None
+        length = struct.unpack(">Q", head[2:10])[0]
+    if length > maxSize:
+        raise WebSocketError(MESSAGE_TOO_BIG, "Frame of %s bytes" % length)
+    keySize = 4 if masked else 0
+    if len(readBuffer) < offset + keySize + length:
+        return None
+    readBuffer.read(offset)
+    if masked:
+        key = readBuffer.read(4)
+        return fin, opcode, mask(readBuffer.read(length), key)
+    return fin, opcode, readBuffer.read(length)
+
+
+def parseClose(payload):
+    """Close code and reason of a CLOSE frame."""
+    if not payload:
+        return NO_STATUS, ""
+    if len(payload) == 1:
+        raise WebSocketError(PROTOCOL_ERROR, "Truncated close code")
+    code = struct.unpack(">H", payload[:2])[0]
+    if code < 1000 or code in (1004, NO_STATUS, ABNORMAL_CLOSURE, 1015) or 1015 < code < 3000 or code >= 5000:
+        raise WebSocketError(PROTOCOL_ERROR, "Invalid close code %s" % code)
+    try:
+        reason = payload[2:].decode("utf-8")
+    except UnicodeDecodeError:
+        raise WebSocketError(INVALID_DATA, "Close reason is not UTF-8")
+    return code, reason
+
+
+class Message(object):
+    """
+    A complete, reassembled message. data holds the payload; text
+    messages have it decoded in text as well, binary ones have text
+    set to None.
+    """
+
+    def __init__(self, opcode, data):
+        self.opcode = opcode
+        self.data = data
+        self.binary = opcode == BINARY
+        if self.binary:
+            self.text = None
+        else:
+            try:
+                self.text = data.decode("utf-8")
+            except UnicodeDecodeError:
+                raise WebSocketError(INVALID_DATA, "Text message is not UTF-8")
+
+    def __repr__(self):
+        return "Message(%r)" % (self.data if self.binary else self.text)
+
+
+class WebSocketHandler(object):
+    """
+    Base class for handlers registered with WSGIHandler's websockets
+    option. One instance is created per connection; its callbacks are
+    called in order, never concurrently, from a thread of the hub's
+    WorkerPool, so they may block or send without stalling other
+    connections. protocols lists the subprotocols the handler speaks,
+    preferred first.
+    """
+
+    protocols = []
+
+    def onOpen(self, ws):
+        pass
+
+    def onMessage(self, ws, message):
+        pass
+
+    def onClose(self, ws, code, reason):
+        pass
+
+
+class WebSocket(object):
+    """
+    Server side of a WebSocket connection, owned by a WebSocketHub.
+
+    send() may be called from any thread. Frames are only queued there
+    and written by the hub; once more than highWater bytes are queued
+    send() blocks until the client caught up, and gives up after
+    sendTimeout seconds by closing the connection. In the other direction
+    the hub stops reading from the connection while maxPending messages
+    wait for the handler, which pushes back on the client through TCP.
+    """
+
+    maxMessageSize = 1048576
+    highWater = 1048576
+    sendTimeout = 30.0
+    maxPending = 64
+    closeTimeout = 5.0
+
+    def __init__(self, conn, readBuffer, environ, handler, protocol = None):
+        self.conn = conn
+        self.readBuffer = readBuffer
+        self.environ = environ
+        self.handler = handler
+        self.protocol = protocol
+        self.hub = None
+        self.lock = threading.Condition()
+        self.outgoing = bytearray()
+        self.inbox = collections.deque()
+        self.scheduled = False
+        self.paused = False
+        self.fragments = None
+        self.fragmentOpcode = None
+        self.closeSent = False
+        self.closeReceived = False
+        self.closeDelivered = False
+        self.closing = False
+        self.closed = False
+        self.aborted = False
+        self.awaitingPong = False
+        self.events = 0
+        self.timer = None
+
+    def send(self, data):
+        """Send a message: str as text, bytes as binary message."""
+        if isinstance(data, str):
+            self.sendFrame(TEXT, data.encode("utf-8"))
+        else:
+            self.sendFrame(BINARY, bytes(data))
+
+    def ping(self, data = b''):
+        self.sendFrame(PING, data)
+
+    def sendFrame(self, opcode, payload):
+        frame = packFrame(opcode, payload)
+        with self.lock:
+            deadline = time.time() + self.sendTimeout
+            while len(self.outgoing) > self.highWater and not self.closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    # slow consumer
+                    self.aborted = True
+                    self.hub.wake(self)
+                    raise WebSocketClosed("Client does not read")
+                self.lock.wait(remaining)
+            if self.closed or self.closeSent:
+                raise WebSocketClosed("WebSocket closed")
+            wasEmpty = not self.outgoing
+            self.outgoing += frame
+        if wasEmpty:
+            self.hub.wake(self)
+
+    def close(self, code = NORMAL_CLOSURE, reason = ""):
+        """Start the closing handshake; the connection closes once the client answered."""
+        with self.lock:
+            if self.closed or self.closeSent:
+                return
+            self.closeSent = True
+            self.outgoing += packFrame(CLOSE, struct.pack(">H", code) + reason.encode("utf-8")[:123])
+        self.hub.wake(self)
+
+    def queue(self, frame):
+        """Queue a frame without waiting for buffer space; used by the hub."""
+        with self.lock:
+            self.outgoing += frame
+
+    def receiveFrames(self):
+        """Process the complete frames in readBuffer; runs in the hub thread."""
+        while not self.closeReceived:
+            frame = readFrame(self.readBuffer, self.maxMessageSize)
+            if frame is None:
+                return
+            fin, opcode, payload = frame
+            if opcode >= CLOSE:
+                if not fin or len(payload) > 125:
+                    raise WebSocketError(PROTOCOL_ERROR, "Invalid control frame")
+                if opcode == PING:
+                    if not self.closeSent:
+                        self.queue(packFrame(PONG, payload))
+                elif opcode == CLOSE:
+                    code, reason = parseClose(payload)
+                    self.closeReceived = True
+                    with self.lock:
+                        if not self.closeSent:
+                            self.closeSent = True
+                            echo = payload[:2] if code != NO_STATUS else b''
+                            self.outgoing += packFrame(CLOSE, echo)
+                    self.deliver(("close", code, reason))
+                elif opcode != PONG:
+                    raise WebSocketError(PROTOCOL_ERROR, "Unknown opcode %s" % opcode)
+            elif opcode == CONTINUATION:
+                if self.fragments is None:
+                    raise WebSocketError(PROTOCOL_ERROR, "Continuation without a message")
+                self.fragments += payload
+                if len(self.fragments) > self.maxMessageSize:
+                    raise WebSocketError(MESSAGE_TOO_BIG, "Message exceeds %s bytes" % self.maxMessageSize)
+                if fin:
+                    message = Message(self.fragmentOpcode, bytes(self.fragments))
+                    self.fragments = self.fragmentOpcode = None
+                    self.deliver(("message", message))
+            elif opcode in (TEXT, BINARY):
+                if self.fragments is not None:
+                    raise WebSocketError(PROTOCOL_ERROR, "Message interleaved with a fragmented one")
+                if fin:
+                    self.deliver(("message", Message(opcode, payload)))
+                else:
+                    self.fragments = bytearray(payload)
+                    self.fragmentOpcode = opcode
+            else:
+                raise WebSocketError(PROTOCOL_ERROR, "Unknown opcode %s" % opcode)
+
+    def deliver(self, event):
+        """Queue an event for the handler; the close event is delivered only once."""
+        with self.lock:
+            if self.closeDelivered:
+                return
+            if event[0] == "close":
+                self.closeDelivered = True
+            self.inbox.append(event)
+            if len(self.inbox) >= self.maxPending:
+                self.paused = True
+            schedule = not self.scheduled
+            self.scheduled = True
+        if schedule:
+            self.hub.pool.put((self,))
+
+    def __repr__(self):
+        return "WebSocket(%s)" % self.environ.get('PATH_INFO')
+
+
+class WebSocketHub(threading.Thread):
+    """
+    Holds upgraded connections in a selector, so idle WebSockets cost a
+    registration rather than a thread.
+
+    All socket I/O happens in the hub thread: it reads and parses frames,
+    answers pings, and writes what WebSocket.send() queued. Complete
+    messages are passed to the handlers through a WorkerPool of up to
+    nThreads threads. Connections silent for pingInterval seconds are
+    pinged and closed if they stay silent for another pingInterval.
+    """
+
+    default = None
+    defaultLock = threading.Lock()
+    pingInterval = 30.0
+
+    def __init__(self, nThreads = 16):
+        threading.Thread.__init__(self, name = "WebSocketHub")
+        self.daemon = True
+        self.selector = selectors.DefaultSelector()
+        self.wakeupReader, self.wakeupWriter = socket.socketpair()
+        self.wakeupReader.setblocking(False)
+        self.wakeupWriter.setblocking(False)
+        self.selector.register(self.wakeupReader, selectors.EVENT_READ)
+        self.changes = collections.deque()
+        self.connections = set()
+        self.timers = TimerWheel(resolution = 0.5)
+        self.pool = WorkerPool(self.dispatch, 1, nThreads)
+
+    @classmethod
+    def getDefault(cls):
+        """The process-wide hub, started on first use."""
+        with cls.defaultLock:
+            if cls.default is None:
+                cls.default = WebSocketHub()
+                cls.default.pool.start()
+                cls.default.start()
+            return cls.default
+
+    def add(self, ws):
+        """Take over ws; its socket must not be used by anybody else afterwards."""
+        ws.hub = self
+        ws.deliver(("open",))
+        self.wake(ws)
+
+    def wake(self, ws):
+        self.changes.append(ws)
+        try:
+            self.wakeupWriter.send(b'\0')
+        except (BlockingIOError, OSError):
+            # a wakeup is pending anyway
+            pass
+
+    def drain(self):
+        """Close all connections with "going away"."""
+        for ws in list(self.connections):
+            ws.close(GOING_AWAY)
+
+    def run(self):
+        while True:
+            for key, events in self.selector.select(self.timers.resolution):
+                if key.fileobj is self.wakeupReader:
+                    try:
+                        while self.wakeupReader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                ws = key.data
+                if events & selectors.EVENT_READ:
+                    self.receive(ws)
+                if events & selectors.EVENT_WRITE:
+                    self.update(ws)
+            while self.changes:
+                ws = self.changes.popleft()
+                if ws.hub is self and ws not in self.connections and not ws.closed:
+                    self.register(ws)
+                self.update(ws)
+            self.timers.expire()
+
+    def register(self, ws):
+        self.connections.add(ws)
+        ws.conn.setblocking(False)
+        ws.timer = self.timers.schedule(self.pingInterval, self.keepAlive, ws)
+        # frames sent right behind the handshake are buffered already
+        if len(ws.readBuffer):
+            self.parse(ws)
+
+    def receive(self, ws):
+        try:
+            received = ws.readBuffer.fill()
+            # TLS may hold decrypted data select() does not know about
+            while received and getattr(ws.conn, "pending", None) and ws.conn.pending():
+                received = ws.readBuffer.fill()
+        except WOULD_BLOCK:
+            return
+        except OSError:
+            received = 0
+        if not received:
+            self.drop(ws)
+            return
+        ws.awaitingPong = False
+        if not ws.closing and not ws.timer.reschedule(self.pingInterval):
+            ws.timer = self.timers.schedule(self.pingInterval, self.keepAlive, ws)
+        self.parse(ws)
+        self.update(ws)
+
+    def parse(self, ws):
+        try:
+            ws.receiveFrames()
+        except WebSocketError as e:
+            with ws.lock:
+                if not ws.closeSent:
+                    ws.closeSent = True
+                    ws.outgoing += packFrame(CLOSE, struct.pack(">H", e.code))
+            # nothing the client sends is going to be read anymore
+            ws.closeReceived = True
+            ws.deliver(("close", e.code, e.msg))
+
+    def flush(self, ws):
+        with ws.lock:
+            try:
+                sent = ws.conn.send(ws.outgoing)
+            except WOULD_BLOCK:
+                return
+            except OSError:
+                ws.aborted = True
+                return
+            del ws.outgoing[:sent]
+            if len(ws.outgoing) <= ws.highWater:
+                ws.lock.notify_all()
+
+    def update(self, ws):
+        """Write what is queued and adjust the events ws is selected for."""
+        if ws.closed:
+            return
+        if ws.outgoing:
+            self.flush(ws)
+        if ws.aborted:
+            self.drop(ws)
+            return
+        with ws.lock:
+            if ws.closeSent and not ws.closing:
+                # the client has closeTimeout seconds to answer
+                ws.closing = True
+                ws.timer.cancel()
+                ws.timer = self.timers.schedule(ws.closeTimeout, self.drop, ws)
+            if ws.closeSent and ws.closeReceived and not ws.outgoing:
+                done = True
+            else:
+                done = False
+                events = 0
+                if not ws.paused and not ws.closeReceived:
+                    events |= selectors.EVENT_READ
+                if ws.outgoing:
+                    events |= selectors.EVENT_WRITE
+        if done:
+            self.drop(ws, NORMAL_CLOSURE)
+            return
+        if events != ws.events:
+            if not ws.events:
+                self.selector.register(ws.conn, events, ws)
+            elif not events:
+                self.selector.unregister(ws.conn)
+            else:
+                self.selector.modify(ws.conn, events, ws)
+            ws.events = events
+
+    def keepAlive(self, ws):
+        if ws.awaitingPong:
+            self.drop(ws)
+            return
+        ws.awaitingPong = True
+        ws.queue(packFrame(PING))
+        ws.timer = self.timers.schedule(self.pingInterval, self.keepAlive, ws)
+        self.update(ws)
+
+    def drop(self, ws, code = ABNORMAL_CLOSURE):
+        """Close the socket of ws right away."""
+        if ws.closed:
+            return
+        with ws.lock:
+            ws.closed = True
+            ws.lock.notify_all()
+        if ws.events:
+            self.selector.unregister(ws.conn)
+            ws.events = 0
+        if ws.timer is not None:
+            ws.timer.cancel()
+        self.connections.discard(ws)
+        try:
+            ws.conn.close()
+        except OSError:
+            pass
+        ws.deliver(("close", code, ""))
+
+    def dispatch(self, ws):
+        """Pass the queued events of ws to its handler; runs in a pool thread."""
+        while True:
+            resume = False
+            with ws.lock:
+                if not ws.inbox:
+                    ws.scheduled = False
+                    return
+                event = ws.inbox.popleft()
+                if ws.paused and len(ws.inbox) <= ws.maxPending // 2:
+                    ws.paused = False
+                    resume = True
+            if resume:
+                self.wake(ws)
+            try:
+                if event[0] == "message":
+                    ws.handler.onMessage(ws, event[1])
+                elif event[0] == "open":
+                    ws.handler.onOpen(ws)
+                else:
+                    ws.handler.onClose(ws, event[1], event[2])
+            except WebSocketClosed:
+                pass
+            except Exception:
+                traceback.print_exc()
+                ws.close(INTERNAL_ERROR)
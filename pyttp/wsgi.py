@@ -1,66 +1,56 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 from pyttp import network
-from threading import current_thread
+from pyttp.network import ReadBuffer, WriteBuffer, SocketExhausted
+from pyttp.timers import TimerWheel
+from pyttp.websocket import WebSocket, WebSocketHub, handshakeResponse
+from pyttp.sse import EventStream, EventStreamHub
+from threading import current_thread, Lock
 import os
 import socket
+import stat
 import ssl
 import sys
 import time
 import types
+import itertools
+import functools
 
 from pyttp.core import *
 
+CONTINUE_RESPONSE = b"HTTP/1.1 100 Continue\r\n\r\n"
+
 class DummyLogger(object):
 
+    def __init__(self, quiet = False):
+        self.quiet = quiet
+
     def log(self, severity, message):
-        if __debug__:
+        if __debug__ and not self.quiet:
             print("%s: %s" % (severity, message))
 
 
-class SocketExhausted(Exception):
-    pass
-
 class DefaultHandler(object):
 
 
     def __init__(self, *args):
         pass
 
-    def readRequest(self, conn, addr):
-        request = b''
-        last4 = b''
-        verb = conn.recv(4)
+    maxRequestLine = 8190
+    maxHeaders = 100
+    maxHeaderSize = 8190
+
+    def readRequest(self, conn, addr, readBuffer=None):
+        if readBuffer is None:
+            readBuffer = ReadBuffer(conn)
+        if not len(readBuffer) and not readBuffer.fill():
+            raise SocketExhausted
         self.start_time = time.time()
-        request += verb
-        ready = True
-        if verb == b"POST":
-            while True:
-                try:
-                    data = conn.recv(1)
-                except:
-                    ready = False
-                    break
-                if len(last4) == 4:
-                    last4 = last4[1:]
-                last4 += data
-                request += data
-                if not data:
-                    raise SocketExhausted
-                if last4 == b'\r\n\r\n':
-                    break
-        else:
-            while True:
-                try:
-                    data = conn.recv(1024)
-                except:
-                    break
-                request += data
-                if not data:
-                    raise SocketExhausted
-                if data.endswith(b'\r\n\r\n'):
-                    break
-        return ready, RequestParser().parse(request)
+        parser = IncrementalRequestParser(self.maxRequestLine, self.maxHeaders, self.maxHeaderSize)
+        while not readBuffer.feed(parser):
+            if not readBuffer.fill():
+                raise SocketExhausted
+        return True, (parser.request, b'')
 
 
     def buildEchoResponse(self, req, payload):
@@ -87,50 +77,158 @@ class DefaultHandler(object):
 
 class SocketFileWrapper(object):
     """
-    Wrap file around socket object.
-    Useful for non-blocking sockets because operations
-    like readline() forget incomplete lines when the
-    socket is not ready to be read.
+    Wrap file around the request body of a connection.
+    The body is delimited by Content-Length (length) or, if chunked is
+    set, decoded from chunked transfer encoding. Reads go through the
+    connection's ReadBuffer and never pass the end of the body, so bytes
+    of a pipelined request stay in the buffer for the next request;
+    large reads are received straight into the result instead.
+    sendContinue is called before the body is first received from the
+    socket, to send an interim 100 response to clients expecting one.
+    Once the body has to be received from the socket, the connection
+    is aborted if it is not closed within timeout seconds. Discarding
+    the unread rest with drain() gets its own deadline of drainTimeout.
     """
 
-    def __init__(self, sock):
-        self.sock = sock
-        self.buf = b""
+    maxChunkLine = 4096
+    drainTimeout = 5.0
 
+    def __init__(self, readBuffer, length=0, timeout=None, chunked=False, sendContinue=None):
+        self.readBuffer = readBuffer
+        self.sock = readBuffer.sock
+        # of the whole body, or of the current chunk if chunked
+        self.remaining = length
+        self.chunked = chunked
+        self.ended = not chunked and not length
+        self.chunkStarted = False
+        self.sendContinue = sendContinue
+        self.timeout = timeout
+        self.deadline = None
 
-    def read(self, n):
-        while len(self.buf) < n:
-            s = self.sock.recv(1024)
-            self.buf += s
-            if s == b'':
+
+    def prepareReceive(self):
+        if self.sendContinue is not None:
+            sendContinue, self.sendContinue = self.sendContinue, None
+            sendContinue()
+        if self.deadline is None and self.timeout:
+            self.deadline = TimerWheel.getDefault().schedule(self.timeout, network.abortConnection, self.sock)
+
+
+    def fill(self):
+        self.prepareReceive()
+        return self.readBuffer.fill()
+
+
+    def fillTo(self, n):
+        while len(self.readBuffer) < n:
+            if not self.fill():
                 break
-        if len(self.buf) < n:
-            rBuf = self.buf
-            self.buf = b''
-            return rBuf
-        rBuf = self.buf[:n]
-        self.buf = self.buf[n:]
-        return rBuf
+
+
+    def readLine(self):
+        """A line of chunked framing; these are bounded by maxChunkLine."""
+        while True:
+            index = self.readBuffer.find(b'\n')
+            if index >= 0:
+                return self.readBuffer.read(index + 1)
+            if len(self.readBuffer) > self.maxChunkLine:
+                raise RequestParserException("Chunk header too long", None)
+            if not self.fill():
+                raise SocketExhausted
+
+
+    def nextChunk(self):
+        if self.chunkStarted and self.readLine() != b'\r\n':
+            raise RequestParserException("Chunk not terminated by CRLF", None)
+        self.chunkStarted = True
+        size = self.readLine().split(b';', 1)[0].strip()
+        try:
+            if not size or size.strip(b'0123456789abcdefABCDEF'):
+                raise ValueError
+            self.remaining = int(size, 16)
+        except ValueError:
+            raise RequestParserException("Invalid chunk size", size)
+        if not self.remaining:
+            # trailers are discarded
+            while self.readLine() not in (b'\r\n', b'\n'):
+                pass
+            self.end()
+
+
+    def available(self):
+        """Bytes left in the current chunk; 0 once the body was read completely."""
+        while not self.remaining and not self.ended:
+            self.nextChunk()
+        return self.remaining
+
+
+    def end(self):
+        self.ended = True
+        self.close()
+
+
+    def take(self, n):
+        """Read up to n bytes, where n does not exceed the current chunk."""
+        if n - len(self.readBuffer) > ReadBuffer.blockSize:
+            data = bytearray(n)
+            with memoryview(data) as view:
+                got = self.readBuffer.readInto(view)
+                self.prepareReceive()
+                while got < n:
+                    received = self.readBuffer.receiveInto(view[got:])
+                    if not received:
+                        break
+                    got += received
+            del data[got:]
+            data = bytes(data)
+        else:
+            self.fillTo(n)
+            data = self.readBuffer.read(n)
+        self.remaining -= len(data)
+        if not self.remaining and not self.chunked:
+            self.end()
+        return data
+
+
+    def read(self, n=-1):
+        pieces = []
+        if n is None or n < 0:
+            while self.available():
+                piece = self.take(self.remaining)
+                if not piece:
+                    break
+                pieces.append(piece)
+        else:
+            while n > 0 and self.available():
+                piece = self.take(min(n, self.remaining))
+                if not piece:
+                    break
+                pieces.append(piece)
+                n -= len(piece)
+        if len(pieces) == 1:
+            return pieces[0]
+        return b''.join(pieces)
 
 
     def readline(self, max_char=None):
-        while not b'\n' in self.buf:
-            s = self.sock.recv(1024)
-            self.buf += s
-            if s == b'':
+        pieces = []
+        size = 0
+        while True:
+            n = self.available()
+            if max_char is not None and max_char >= 0:
+                n = min(n, max_char - size)
+            if n <= 0:
+                break
+            if not len(self.readBuffer) and not self.fill():
                 break
-            if max_char is not None and len(self.buf) >= max_char:
-                rBuf = self.buf[:max_char]
-                self.buf = self.buf[max_char:]
-                return rBuf
-        delim = self.buf.find(b'\n')+1
-        if delim < 0:
-            rBuf = self.buf
-            self.buf = b''
-            return rBuf
-        rBuf = self.buf[:delim]
-        self.buf = self.buf[delim:]
-        return rBuf
+            delim = self.readBuffer.find(b'\n')
+            if 0 <= delim < n:
+                pieces.append(self.take(delim + 1))
+                break
+            piece = self.take(min(n, len(self.readBuffer)))
+            pieces.append(piece)
+            size += len(piece)
+        return b''.join(pieces)
 
 
     def readlines(self):
@@ -143,6 +241,48 @@ class SocketFileWrapper(object):
         return lines
 
 
+    def __iter__(self):
+        return iter(self.readlines())
+
+
+    def drain(self, maxDrain=1048576):
+        """
+        Discard what the application left unread of the body.
+        Returns False if the remainder is too large to be worth reading,
+        the peer closed the connection or it may still be waiting for
+        the 100 response, i.e. the connection cannot be reused.
+        """
+        if self.ended:
+            return True
+        if self.sendContinue is not None or self.remaining > maxDrain:
+            return False
+        self.clearDeadline()
+        if self.timeout:
+            self.deadline = TimerWheel.getDefault().schedule(self.drainTimeout, network.abortConnection, self.sock)
+        try:
+            while maxDrain > 0 and self.available():
+                piece = self.read(min(self.remaining, ReadBuffer.blockSize))
+                if not piece:
+                    return False
+                maxDrain -= len(piece)
+        except (RequestParserException, SocketExhausted, socket.timeout):
+            return False
+        finally:
+            self.clearDeadline()
+        return self.ended
+
+
+    def clearDeadline(self):
+        """Stop the body deadline, e.g. while the response is sent."""
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+
+
+    def close(self):
+        self.clearDeadline()
+
+
     def __getattr__(self, value):
         fObj = self.sock.makefile()
         return getattr(fObj, value)
@@ -151,6 +291,156 @@ class SocketFileWrapper(object):
         self.sock.send(msg)
 
 
+class FileWrapper(object):
+    """
+    wsgi.file_wrapper as described in PEP 333.
+    Iterating yields blocks of blksize bytes; WSGIHandler however
+    recognizes the wrapper and sends the file with sendfile() if it
+    is backed by a seekable regular file and the connection is not
+    encrypted. Other file-like objects such as pipes are just read.
+    From mmapThreshold bytes on, blocks of regular files are slices of
+    a shared network.MappedFile instead of freshly read bytes.
+    """
+
+    mmapThreshold = 262144
+
+    def __init__(self, filelike, blksize=65536):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.chunks = None
+
+    def fileno(self):
+        try:
+            return self.filelike.fileno()
+        except (AttributeError, IOError, ValueError):
+            return None
+
+    def remaining(self):
+        """
+        Number of bytes from the current file position to its end, or
+        None if the wrapped object is not a seekable regular file.
+        """
+        fileno = self.fileno()
+        if fileno is None:
+            return None
+        if hasattr(self.filelike, "remaining"):
+            return self.filelike.remaining()
+        try:
+            fileStat = os.fstat(fileno)
+            if not stat.S_ISREG(fileStat.st_mode):
+                return None
+            return fileStat.st_size - self.filelike.tell()
+        except (OSError, ValueError):
+            return None
+
+    def readBlocks(self):
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        if self.chunks is not None:
+            self.chunks.close()
+        if hasattr(self.filelike, "close"):
+            self.filelike.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.chunks is None:
+            remaining = self.remaining()
+            if remaining is not None:
+                self.chunks = network.fileChunks(self.filelike, remaining, self.blksize, self.mmapThreshold)
+            else:
+                self.chunks = self.readBlocks()
+        return next(self.chunks)
+
+    next = __next__
+
+
+def buildEnviron(req, addr, port, urlScheme="http"):
+    """
+    WSGI environment for a parsed request, apart from wsgi.input
+    and wsgi.errors which depend on the server.
+    """
+    environ = {}
+    for header in req.headers:
+        environ['HTTP_' + header.name.upper().replace("-", "_")] = header.value
+    # setup general environment
+    environ['REQUEST_METHOD'] = req.type.verb
+    environ['SCRIPT_NAME'] = ''
+    try:
+        path, query = req.type.resource.split('?')
+    except:
+        path = req.type.resource
+        query = ''
+    environ['REMOTE_ADDRESS'] = addr[0]
+    environ['REMOTE_PORT'] = addr[1]
+    environ['PATH_INFO'] = path
+    environ['QUERY_STRING'] = query
+    if 'HTTP_CONTENT_TYPE' in environ:
+        environ['CONTENT_TYPE'] = environ['HTTP_CONTENT_TYPE']
+    if 'HTTP_CONTENT_LENGTH' in environ:
+        environ['CONTENT_LENGTH'] = environ['HTTP_CONTENT_LENGTH']
+    environ['SERVER_PORT'] = port
+    if "HTTP_HOST" in environ:
+        environ['SERVER_NAME'] = environ['HTTP_HOST']
+    else:
+        environ['SERVER_NAME'] = 'localhost'
+
+    environ['SERVER_PROTOCOL'] = 'HTTP/' + req.type.version
+
+    #setup special wsgi environment
+    environ['wsgi.version'] = (1, 0)
+    environ['wsgi.url_scheme'] = urlScheme
+    environ['wsgi.file_wrapper'] = FileWrapper
+    environ['wsgi.run_once'] = False
+    environ['wsgi.multithread'] = True
+    environ['wsgi.multiprocess'] = True
+    return environ
+
+
+def requestContentLength(environ):
+    try:
+        contentLength = int(environ.get('CONTENT_LENGTH', 0))
+    except ValueError:
+        raise RequestParserException("Invalid Content-Length!", environ['CONTENT_LENGTH'])
+    if contentLength < 0:
+        raise RequestParserException("Invalid Content-Length!", environ['CONTENT_LENGTH'])
+    return contentLength
+
+
+def requestInput(environ, readBuffer, timeout=None, sendContinue=None):
+    """
+    SocketFileWrapper for the body of a request, framed by chunked
+    transfer encoding or by Content-Length. sendContinue is only used
+    for HTTP/1.1 clients sending "Expect: 100-continue".
+    """
+    contentLength = requestContentLength(environ)
+    chunked = False
+    if "HTTP_TRANSFER_ENCODING" in environ:
+        if environ["HTTP_TRANSFER_ENCODING"].strip().lower() != "chunked":
+            raise RequestParserException("Unsupported Transfer-Encoding", environ["HTTP_TRANSFER_ENCODING"],
+                                         "501 Not Implemented")
+        if "CONTENT_LENGTH" in environ:
+            # ambiguous framing is how requests get smuggled
+            raise RequestParserException("Both Transfer-Encoding and Content-Length", environ["CONTENT_LENGTH"])
+        chunked = True
+    expect = environ.get("HTTP_EXPECT")
+    if expect is not None:
+        if expect.strip().lower() != "100-continue":
+            raise RequestParserException("Unsupported expectation", expect, "417 Expectation Failed")
+        if environ['SERVER_PROTOCOL'] != "HTTP/1.1" or not (chunked or contentLength):
+            sendContinue = None
+    else:
+        sendContinue = None
+    environ['wsgi.input_terminated'] = True
+    return SocketFileWrapper(readBuffer, contentLength, timeout, chunked, sendContinue)
+
+
 def thread_print(msg, *args, **kwargs):
     print("[Thread: {}] {}".format(current_thread(), str(msg)), *args, **kwargs)
 
@@ -161,23 +451,65 @@ class WSGIHandler(DefaultHandler):
     Implements the minimum requirement for environment data.
     Supports chunked transfer encoding if WSGI application returns
     a generator. Otherwise all data is sent in one go.
-    The connection is kept alive if no POST request is sent and the
-    client requests such a connection.
-    A hard-coded timeout of 5 secs is used for the socket connection.
+    The connection is kept alive if the client requests such a
+    connection; request bodies are delimited by Content-Length and
+    whatever the application leaves unread is discarded before the
+    next request is read from the connection.
+    Reads are bounded by deadlines on the shared TimerWheel rather than
+    by per-recv timeouts, so trickling bytes does not keep a thread busy:
+    a request head has to arrive within headerTimeout seconds, a body
+    within bodyTimeout seconds once the handler started receiving it, and
+    idle keep-alive connections are closed after keepAliveTimeout seconds.
+    Expired connections are shut down by the timer thread, which wakes
+    the blocked worker. Single sends time out after sendTimeout seconds.
+    After drain() the connection is closed once the current response was
+    sent, or right away if it is waiting for the next request.
+    Request heads exceeding maxRequestLine, maxHeaders or maxHeaderSize
+    are rejected with 414 or 431 before they are read completely.
+    Small chunks of streamed responses are coalesced into sends of up to
+    writeBufferSize bytes; nothing stays buffered longer than flushDelay
+    seconds.
+    If http2 is set, connections starting with the HTTP/2 preface or
+    negotiating "h2" through ALPN are served by pyttp.http2 instead.
+    websockets maps paths to WebSocketHandler factories; upgrade requests
+    for these paths are answered with the handshake and the connection is
+    handed over to the process-wide WebSocketHub.
+    Applications returning a pyttp.sse.EventStream get the response head
+    sent and the connection handed over to the process-wide EventStreamHub.
     """
 
-    def __init__(self, app, port, debug=None, logger=DummyLogger()):
+    def __init__(self, app, port, debug=None, logger=DummyLogger(),
+                 maxRequestLine=8190, maxHeaders=100, maxHeaderSize=8190,
+                 writeBufferSize=16384, flushDelay=0.02,
+                 headerTimeout=10.0, bodyTimeout=30.0, keepAliveTimeout=5.0, sendTimeout=30.0,
+                 http2=True, websockets=None):
         self.app = app
         self.port = port
+        self.writeBufferSize = writeBufferSize
+        self.flushDelay = flushDelay
+        self.maxRequestLine = maxRequestLine
+        self.maxHeaders = maxHeaders
+        self.maxHeaderSize = maxHeaderSize
+        self.headerTimeout = headerTimeout
+        self.bodyTimeout = bodyTimeout
+        self.keepAliveTimeout = keepAliveTimeout
+        self.sendTimeout = sendTimeout
+        self.deadline = None
+        self.requestsServed = 0
+        self.draining = False
+        self.idleConn = None
+        self.http2 = http2
+        self.websockets = websockets or {}
+        self.http2Connection = None
+        self.lock = Lock()
         self.status = None
         self.headers = None
         self.logger = logger
         self.debug = debug
-        self.prePayload = ""
+        self.prePayload = []
         self.ready = True
         self.exc_info = None
         self.waitForResponse = True
-        self.firstChunk = ""
 
     def start_response(self, status, headers, exc_info=None):
         """start_response callback as defined by WSGI (PEP 333)"""
@@ -190,207 +522,566 @@ class WSGIHandler(DefaultHandler):
         return self.write
 
     def write(self, msg):
-        self.prePayload += msg
+        self.prePayload.append(self._toBytes(msg))
+
+
+    def _toBytes(self, chunk):
+        if isinstance(chunk, str):
+            return chunk.encode()
+        return chunk
 
 
     def _chunkify(self, chunk):
-        """Calculates chunk size and returns ready-to-send chunk.
+        """Calculates chunk size and returns the pieces of a ready-to-send chunk.
         Arguments:
         chunk -- chunked data to chunkify;
         """
-        chunkLength = len(chunk)
-        chunkSize = hex(chunkLength)[2:]
-        if isinstance(chunk, str):
-            return "{}\r\n{}\r\n".format(chunkSize, chunk).encode()
+        chunk = self._toBytes(chunk)
+        chunkSize = hex(len(chunk))[2:]
+        return bytes(chunkSize, encoding="ascii") + b"\r\n", chunk, b"\r\n"
+
+
+    def sendResponse(self, conn, req, payload, connectionSetting):
+        """
+        Send status, headers and body of the application's response.
+        The body is delimited by Content-Length whenever its size is known
+        in advance: for files, lists, single-chunk iterables and responses
+        for which the application set Content-Length itself. Head and body
+        of such responses go out in a single send. Only iterables of
+        unknown length are sent with chunked transfer encoding (or, for
+        HTTP/1.0 clients, by closing the connection).
+        """
+        body = None
+        chunks = None
+        firstChunk = None
+        fileLength = None
+        if isinstance(payload, FileWrapper):
+            fileLength = payload.remaining()
+        if fileLength is not None:
+            pass
+        elif isinstance(payload, (list, tuple)):
+            body = b''.join(self._toBytes(chunk) for chunk in payload)
+        else:
+            chunks = iter(payload)
+            #get first chunk so that start_response will be called now
+            firstChunk = next(chunks, None)
+
+        try:
+            statusCode = int(self.status[:3])
+            statusString = self.status[3:].strip()
+        except Exception as e:
+            statusCode = 200
+            statusString = 'OK'
+        status = Status("HTTP/1.1", statusCode, statusString)
+
+        headers = [Header("Server", "PyTTP/0.0.1")]
+        contentLength = None
+        #add application supplied headers
+        for name, value in self.headers or []:
+            if name.lower() == 'content-length':
+                try:
+                    contentLength = int(value)
+                except ValueError:
+                    pass
+                continue
+            headers.append(Header(name, value))
+
+        prePayload = b''.join(self.prePayload)
+        if chunks is not None and contentLength is None:
+            secondChunk = next(chunks, None)
+            if secondChunk is None:
+                body = self._toBytes(firstChunk or b'')
+                chunks = None
+            else:
+                chunks = itertools.chain([firstChunk, secondChunk], chunks)
+        elif chunks is not None and firstChunk is not None:
+            chunks = itertools.chain([firstChunk], chunks)
+
+        if body is not None:
+            body = prePayload + body
+            contentLength = len(body)
+        elif fileLength is not None:
+            if contentLength is None or contentLength > fileLength + len(prePayload):
+                contentLength = fileLength + len(prePayload)
+
+        chunkedEncoding = False
+        if statusCode in (204, 304) or statusCode < 200:
+            sendBody = False
+        else:
+            sendBody = req.type.verb != "HEAD"
+            if contentLength is not None:
+                headers.append(Header("Content-Length", str(contentLength)))
+            elif req.type.version == "1.1":
+                chunkedEncoding = True
+                headers.append(Header("Transfer-Encoding", "chunked"))
+            else:
+                #HTTP/1.0 knows no chunks; the end of the body is marked by closing
+                connectionSetting = "close"
+                self.ready = False
+        headers.insert(1, Header("Connection", connectionSetting))
+
+        #send headers
+        head = str(Response(status, headers, "")).encode()
+        if self.debug:
+            thread_print(head)
+        if not sendBody:
+            conn.sendall(head)
+        elif body is not None:
+            network.sendBuffers(conn, [head, body])
+        elif fileLength is not None:
+            network.setCork(conn, True)
+            try:
+                conn.sendall(head + prePayload)
+                self.sendFile(conn, payload, contentLength - len(prePayload))
+            finally:
+                network.setCork(conn, False)
+        elif chunkedEncoding:
+            self.logger.log("INFO","Using chunked transfer encoding")
+            output = WriteBuffer(conn, self.writeBufferSize, self.flushDelay)
+            output.write(head)
+            if prePayload:
+                output.write(*self._chunkify(prePayload))
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                output.write(*self._chunkify(chunk))
+            #No payload indicates end of transfer
+            output.write(b"0\r\n\r\n")
+            output.flush()
+        else:
+            output = WriteBuffer(conn, self.writeBufferSize, self.flushDelay)
+            output.write(head, prePayload)
+            remaining = None
+            if contentLength is not None:
+                remaining = contentLength - len(prePayload)
+            for chunk in chunks:
+                chunk = self._toBytes(chunk)
+                if remaining is not None:
+                    chunk = chunk[:remaining]
+                    remaining -= len(chunk)
+                output.write(chunk)
+            output.flush()
+            if remaining:
+                #application sent less than it announced
+                self.ready = False
+
+
+    def sendEventStream(self, conn, req, readBuffer, stream):
+        """
+        Send the response head for an event stream and hand conn over to
+        the EventStreamHub. The stream ends when the connection is closed.
+        """
+        try:
+            statusCode = int(self.status[:3])
+            statusString = self.status[3:].strip()
+        except Exception as e:
+            statusCode = 200
+            statusString = 'OK'
+        headers = [Header("Server", "PyTTP/0.0.1"), Header("Connection", "close")]
+        names = set()
+        for name, value in self.headers or []:
+            if name.lower() not in ('content-length', 'connection', 'transfer-encoding'):
+                headers.append(Header(name, value))
+                names.add(name.lower())
+        if 'content-type' not in names:
+            headers.append(Header("Content-Type", "text/event-stream"))
+        if 'cache-control' not in names:
+            headers.append(Header("Cache-Control", "no-cache"))
+        self.ready = False
+        try:
+            conn.sendall(str(Response(Status("HTTP/1.1", statusCode, statusString), headers, "")).encode())
+        except:
+            stream.close()
+            raise
+        if req.type.verb == "HEAD" or statusCode != 200:
+            stream.close()
+            return False
+        readBuffer.detach()
+        EventStreamHub.getDefault().add(stream, conn)
+        return False
+
+
+    def sendFile(self, conn, fileWrapper, length):
+        """
+        Send length bytes from the current position of the wrapped file.
+        Plain sockets use sendfile() so the data never passes through the
+        interpreter. Encrypted connections get slices of the shared memory
+        mapping of large files, or else blocks read from them.
+        """
+        filelike = fileWrapper.filelike
+        if isinstance(conn, ssl.SSLSocket):
+            chunks = network.fileChunks(filelike, length, fileWrapper.blksize, fileWrapper.mmapThreshold)
+            try:
+                for piece in chunks:
+                    conn.sendall(piece)
+                    length -= len(piece)
+            finally:
+                chunks.close()
         else:
-            return bytes(chunkSize, encoding="ascii") + b"\r\n" + chunk + b"\r\n"
+            length -= conn.sendfile(filelike, filelike.tell(), length)
+        if length > 0:
+            # file shrunk; the announced length cannot be met anymore
+            raise SocketExhausted
+
+
+    def sendError(self, conn, status, payload=None):
+        """
+        Send a minimal error response; the connection will be closed.
+        Unread request data is discarded for a moment so that closing
+        does not reset the connection before the client read the response.
+        """
+        code, _, reason = status.partition(' ')
+        if payload is None:
+            payload = status + "\r\n"
+        payload = payload.encode()
+        headers = [Header("Server", "PyTTP/0.0.1"),
+                   Header("Connection", "close"),
+                   Header("Content-Type", "text/plain"),
+                   Header("Content-Length", str(len(payload)))]
+        resp = Response(Status("HTTP/1.1", code, reason), headers, "")
+        try:
+            conn.sendall(str(resp).encode() + payload)
+            conn.shutdown(socket.SHUT_WR)
+            conn.settimeout(1.0)
+            for i in range(16):
+                if not conn.recv(65536):
+                    break
+        except (socket.error, ssl.SSLError):
+            pass
 
 
     def __call__(self, conn, addr):
-        keepAliveCount = 0
+        readBuffer = ReadBuffer(conn)
+        try:
+            while self.ready:
+                if not self.handleRequest(conn, addr, readBuffer):
+                    break
+        finally:
+            self.clearDeadline()
+            if not readBuffer.detached:
+                conn.close()
+
+
+    def drain(self):
+        with self.lock:
+            self.draining = True
+            if self.idleConn is not None:
+                network.abortConnection(self.idleConn)
+            if self.http2Connection is not None:
+                self.http2Connection.drain()
+
+
+    def waitForRequest(self, conn, readBuffer):
+        """Wait for the next request on a kept-alive connection."""
+        with self.lock:
+            if self.draining:
+                raise SocketExhausted
+            self.idleConn = conn
+        try:
+            received = readBuffer.fill()
+        finally:
+            with self.lock:
+                self.idleConn = None
+        if not received:
+            raise SocketExhausted
+
+
+    def setDeadline(self, conn, timeout):
+        """Abort conn timeout seconds from now, replacing the previous deadline."""
+        self.clearDeadline()
+        if timeout:
+            self.deadline = TimerWheel.getDefault().schedule(timeout, network.abortConnection, conn)
+
+
+    def clearDeadline(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+
+
+    def handleRequest(self, conn, addr, readBuffer=None):
+        """
+        Serve a single request on conn.
+        readBuffer holds data already received on the connection.
+        Returns True if the connection may be kept alive for
+        another request.
+        """
+        try:
+            return self.serveRequest(conn, addr, readBuffer)
+        finally:
+            self.clearDeadline()
+
+
+    def serveRequest(self, conn, addr, readBuffer=None):
+        if readBuffer is None:
+            readBuffer = ReadBuffer(conn)
+        self.status = None
+        self.headers = None
+        self.prePayload = []
+        environ = {}
         socketFileHandle = None
-        while self.ready:
+
+        try:
+            conn.settimeout(self.sendTimeout)
+            #parse request
+            if not len(readBuffer) and self.requestsServed:
+                self.setDeadline(conn, self.keepAliveTimeout)
+                self.waitForRequest(conn, readBuffer)
+            if readBuffer.find(b'\r\n\r\n') < 0:
+                self.setDeadline(conn, self.headerTimeout)
+            if self.http2 and not self.requestsServed:
+                from pyttp import http2
+                if http2.isHTTP2(conn, readBuffer):
+                    self.clearDeadline()
+                    return self.serveHTTP2(conn, addr, readBuffer)
+            self.ready, (req, reqBody) = self.readRequest(conn, addr, readBuffer)
+            self.clearDeadline()
+            self.requestsServed += 1
+            if isinstance(conn, ssl.SSLSocket):
+                urlScheme = "https"
+            else:
+                urlScheme = "http"
+            environ = buildEnviron(req, addr, self.port, urlScheme)
+            environ['pyttp.start_time'] = self.start_time
+            self.logger.log("INFO", "%s:%s requesting \"%s\"" % (addr[0], addr[1], req.type.resource))
+            self.logger.log("INFO", "Headers: \n%s" % req.headers)
+            socketFileHandle = requestInput(environ, readBuffer, self.bodyTimeout,
+                                            functools.partial(conn.sendall, CONTINUE_RESPONSE))
+            if environ.get("HTTP_UPGRADE", "").lower() == "websocket" and environ['PATH_INFO'] in self.websockets:
+                return self.upgradeWebSocket(conn, readBuffer, environ)
+            connectionSetting = environ.get("HTTP_CONNECTION", "keep-alive").lower()
+            if connectionSetting != "keep-alive":
+                self.ready = False
+            environ['wsgi.input'] = socketFileHandle
+            environ['wsgi.errors'] = self.logger
+
+            payload = self.app(environ, self.start_response)
+            # a body left partly unread must not abort the response
+            socketFileHandle.clearDeadline()
+            if isinstance(payload, EventStream):
+                return self.sendEventStream(conn, req, readBuffer, payload)
+            if self.draining:
+                connectionSetting = "close"
+                self.ready = False
             try:
-                #timeout of 5 secs
-                conn.settimeout(5.0)
-                headers = []
-                #parse request
-                self.ready, (req, reqBody) = self.readRequest(conn, addr)
-                environ = {'pyttp.start_time': self.start_time}
-                for header in req.headers:
-                    environ['HTTP_' + header.name.upper().replace("-", "_")] = header.value
-                # setup general environment
-                environ['REQUEST_METHOD'] = req.type.verb
-                environ['SCRIPT_NAME'] = ''
-                try:
-                    path, query = req.type.resource.split('?')
-                except:
-                    path = req.type.resource
-                    query = ''
-
-                self.logger.log("INFO", "%s:%s requesting \"%s\"" % (addr[0], addr[1], req.type.resource))
-                self.logger.log("INFO", "Headers: \n%s" % req.headers)
-                environ['REMOTE_ADDRESS'] = addr[0]
-                environ['REMOTE_PORT'] = addr[1]
-                environ['PATH_INFO'] = path
-                environ['QUERY_STRING'] = query
-                if 'HTTP_CONTENT_TYPE' in environ:
-                    environ['CONTENT_TYPE'] = environ['HTTP_CONTENT_TYPE']
-                if 'HTTP_CONTENT_LENGTH' in environ:
-                    environ['CONTENT_LENGTH'] = environ['HTTP_CONTENT_LENGTH']
-                connectionSetting = environ.get("HTTP_CONNECTION", "keep-alive").lower()
-                if connectionSetting != "keep-alive":
-                    self.ready = False
-                if req.type.verb == "POST":
-                    self.ready = False
-                    connectionSetting = "close"
-                environ['SERVER_PORT'] = self.port
-                if "HTTP_HOST" in environ:
-                    environ['SERVER_NAME'] = environ['HTTP_HOST']
-                else:
-                    environ['SERVER_NAME'] = 'localhost'
-
-                environ['SERVER_PROTOCOL'] = 'HTTP/' + req.type.version
-
-                #setup special wsgi environment
-                environ['wsgi.version'] = (1, 0)
-                environ['wsgi.url_scheme'] = "http"
-                if req.type.verb == "POST" and not socketFileHandle:
-                    socketFileHandle = SocketFileWrapper(conn)
-                    environ['wsgi.input'] = socketFileHandle
-                environ['wsgi.errors'] = self.logger
-                environ['wsgi.run_once'] = False
-                environ['wsgi.multithread'] = True
-                environ['wsgi.multiprocess'] = True
-
-                payload = self.app(environ, self.start_response)
-                if hasattr(payload, "__iter__"):
-                    payload = iter(payload)
-                    #payload is a generator, use chunked transfer encoding
-                    chunkedEncoding = True
-                    #get first chunk so that start_response will be called now
-                    try:
-                        self.firstChunk = next(payload)
-                    except StopIteration:
-                        self.firstChunk = None
-                else:
-                    chunkedEncoding = False
-
-                headers.append(Header("Server", "PyTTP/0.0.1"))
-                headers.append(Header("Connection", connectionSetting))
-                if chunkedEncoding:
-                    headers.append(Header("Transfer-Encoding", "chunked"))
-                try:
-                    #add application supplied headers
-                    for name, value in self.headers:
-                        headers.append(Header(name, value))
-                except:
-                    pass
+                self.sendResponse(conn, req, payload, connectionSetting)
+            finally:
+                if hasattr(payload, "close"):
+                    payload.close()
 
-                try:
-                    statusCode = int(self.status[:3])
-                    statusString = self.status[3:]
-                except Exception as e:
-                    statusCode = '200'
-                    statusString = 'OK'
-                status = Status("HTTP/1.1", statusCode, statusString)
-
-                #send headers
-                resp = Response(status, headers, self.prePayload)
-                resp_payload = str(resp).encode()
-                thread_print(resp_payload)
-                conn.sendall(resp_payload)
-
-                if chunkedEncoding:
-                    self.logger.log("INFO","Using chunked transfer encoding")
-                    if self.firstChunk:
-                        conn.sendall(self._chunkify(self.firstChunk))
-                    for p in payload:
-                        if p == "": continue
-                        chunk = self._chunkify(p)
-                        conn.sendall(chunk)
-                    #No payload indicates end of transfer
-                    conn.sendall(self._chunkify(""))
-                else:
-                    conn.sendall(str(payload))
-
-                self.logger.log("INFO", "End of response")
-
-                if self.exc_info:
-                    type, value, traceback = self.exc_info
-                    raise value
-
-                end_time = time.time()
-                self.logger.log("INFO", "Request took %f ms" % ((end_time - self.start_time) * 1000.))                
-
-            except (socket.timeout, ssl.SSLError, SocketExhausted):
-                try:
-                    conn.close()
-                    environ['wsgi.input'].close()
-                except:
-                    pass
-                break
+            self.logger.log("INFO", "End of response")
 
-            except Exception as e:
-                import traceback
-                formatted_exception = ''.join(traceback.format_exception(*sys.exc_info()))
-                if self.debug:
-                    print("[DEBUG]:", formatted_exception)
-                if self.logger:
-                    self.logger.log("EXC", formatted_exception)
-                else:
-                    traceback.print_exc(file=sys.stdout)
-
-                self.exc_info = None
-                resp = Response(Status("HTTP/1.1", "500", "Internal Error"), headers, formatted_exception)
-                try:
-                    conn.sendall(str(resp))
-                    conn.close()
-                    environ['wsgi.input'].close()
-                except:
-                    pass
-                break
+            if self.ready and not socketFileHandle.drain():
+                self.ready = False
 
-            keepAliveCount += 1
-            self.status = None
-            self.headers = None
-            self.prePayload = ""
-            self.firstChunk = ""
-            chunkedEncoding = False
+            if self.exc_info:
+                type, value, traceback = self.exc_info
+                raise value
+
+            end_time = time.time()
+            self.logger.log("INFO", "Request took %f ms" % ((end_time - self.start_time) * 1000.))                
+
+        except RequestParserException as e:
+            self.logger.log("INFO", "%s:%s sent invalid request: %s" % (addr[0], addr[1], e))
+            self.sendError(conn, e.status)
+            return False
+
+        except (socket.timeout, ssl.SSLError, SocketExhausted):
+            try:
+                conn.close()
+                environ['wsgi.input'].close()
+            except:
+                pass
+            return False
+
+        except Exception as e:
+            import traceback
+            formatted_exception = ''.join(traceback.format_exception(*sys.exc_info()))
+            if self.debug:
+                print("[DEBUG]:", formatted_exception)
+            if self.logger:
+                self.logger.log("EXC", formatted_exception)
+            else:
+                traceback.print_exc(file=sys.stdout)
+
+            self.exc_info = None
+            self.sendError(conn, "500 Internal Error", formatted_exception)
+            try:
+                conn.close()
+                environ['wsgi.input'].close()
+            except:
+                pass
+            return False
 
         try:
             environ['wsgi.input'].close()
         except:
             pass
+        return self.ready
+
+
+    def serveHTTP2(self, conn, addr, readBuffer):
+        """Serve conn as HTTP/2 connection until the client goes away."""
+        from pyttp.http2 import HTTP2Connection
+        self.requestsServed += 1
+        connection = HTTP2Connection(self.app, conn, addr, self.port, readBuffer, self.logger, self.debug,
+                                     idleTimeout=self.keepAliveTimeout)
+        with self.lock:
+            if self.draining:
+                return False
+            self.http2Connection = connection
+        try:
+            connection.serve()
         finally:
-            conn.close()
-
+            with self.lock:
+                self.http2Connection = None
+        return False
+
+
+    def upgradeWebSocket(self, conn, readBuffer, environ):
+        """Complete the WebSocket handshake and hand conn over to the WebSocketHub."""
+        key = environ.get("HTTP_SEC_WEBSOCKET_KEY")
+        if (environ['REQUEST_METHOD'] != "GET" or not key
+                or environ.get("HTTP_SEC_WEBSOCKET_VERSION") != "13"):
+            self.sendError(conn, "400 Bad Request")
+            return False
+        handler = self.websockets[environ['PATH_INFO']]()
+        offered = [protocol.strip() for protocol in environ.get("HTTP_SEC_WEBSOCKET_PROTOCOL", "").split(",")]
+        protocol = None
+        for candidate in handler.protocols:
+            if candidate in offered:
+                protocol = candidate
+                break
+        conn.sendall(handshakeResponse(key, protocol))
+        self.logger.log("INFO", "%s:%s upgraded to WebSocket" % (environ['REMOTE_ADDRESS'], environ['REMOTE_PORT']))
+        self.ready = False
+        readBuffer.detach()
+        WebSocketHub.getDefault().add(WebSocket(conn, readBuffer, environ, handler, protocol))
+        return False
 
 
 class WSGIHandlerDispatcher(object):
 
-    def __init__(self, app, port, debug, logger):
+    """
+    Creates a WSGIHandler per connection.
+    Additional keyword options are passed on to the WSGIHandler.
+    drain() is passed on to all live handlers and to those created
+    afterwards.
+    """
+
+    def __init__(self, app, port, debug, logger, **options):
         self.app = app
         self.port = port
         self.debug = debug
         self.logger = logger
-
+        self.options = options
+        self.draining = False
+        self.handlers = set()
+        self.lock = Lock()
+
+
+    def makeHandler(self):
+        handler = WSGIHandler(self.app, self.port, self.debug, self.logger, **self.options)
+        with self.lock:
+            handler.draining = self.draining
+            self.handlers.add(handler)
+        return handler
+
+    def releaseHandler(self, handler):
+        with self.lock:
+            self.handlers.discard(handler)
+
+    def drain(self):
+        with self.lock:
+            self.draining = True
+            handlers = list(self.handlers)
+        for handler in handlers:
+            handler.drain()
+        if WebSocketHub.default is not None:
+            WebSocketHub.default.drain()
+        if EventStreamHub.default is not None:
+            EventStreamHub.default.drain()
 
     def __call__(self, conn, addr):
-        handler = WSGIHandler(self.app, self.port, self.debug, self.logger)
-        return handler(conn, addr)
+        handler = self.makeHandler()
+        try:
+            return handler(conn, addr)
+        finally:
+            self.releaseHandler(handler)
+
+    def handleRequest(self, conn, addr, readBuffer=None):
+        handler = self.makeHandler()
+        try:
+            return handler.handleRequest(conn, addr, readBuffer)
+        finally:
+            self.releaseHandler(handler)
 
 
 class WSGIListener(network.ThreadedSocketListener):
+    """
+    Threaded WSGI server. Keyword options are passed on to WSGIHandler,
+    among them the connection deadlines headerTimeout, bodyTimeout,
+    keepAliveTimeout and sendTimeout.
+    """
+
+    def __init__(self, app, port, timeout = None, nThreads = None, logger=DummyLogger(), debug=None,
+                 minThreads = None, maxQueue = None, maxWait = None, **options):
+        self.handler = WSGIHandlerDispatcher(app, port, debug, logger, **options)
+        network.ThreadedSocketListener.__init__(self, port, self.handler, timeout, nThreads, minThreads,
+                                                maxQueue, maxWait)
+
+
+class WSGISelectorListener(network.SelectorListener):
+
+    def __init__(self, app, port, timeout = None, nThreads = None, logger=DummyLogger(), debug=None,
+                 keepAliveTimeout = 5.0, minThreads = None, maxQueue = None, maxWait = None,
+                 headerTimeout = 10.0, **options):
+        self.handler = WSGIHandlerDispatcher(app, port, debug, logger, headerTimeout = headerTimeout, **options)
+        network.SelectorListener.__init__(self, port, self.handler, timeout, nThreads, keepAliveTimeout,
+                                          minThreads = minThreads, maxQueue = maxQueue, maxWait = maxWait,
+                                          headerTimeout = headerTimeout)
+
+
+class WSGIPreforkListener(network.PreforkListener):
+    """
+    Pre-fork WSGI server: nProcesses workers, each running a WSGIListener
+    (or a WSGISelectorListener if eventDriven is set) on the shared
+    listening socket.
+    """
+
+    def __init__(self, app, port, nProcesses = None, nThreads = None, timeout = None,
+                 logger=DummyLogger(), debug=None, eventDriven=False, reusePort=False, **options):
+        self.app = app
+        self.timeout = timeout
+        self.nThreads = nThreads
+        self.logger = logger
+        self.debug = debug
+        self.eventDriven = eventDriven
+        self.options = options
+        network.PreforkListener.__init__(self, self.makeListener, port, nProcesses, reusePort)
 
-    def __init__(self, app, port, timeout = None, nThreads = None, logger=DummyLogger(), debug=None):
-        self.handler = WSGIHandlerDispatcher(app, port, debug, logger)
-        network.ThreadedSocketListener.__init__(self, port, self.handler, timeout, nThreads)
+    def makeListener(self):
+        if self.eventDriven:
+            listenerClass = WSGISelectorListener
+        else:
+            listenerClass = WSGIListener
+        return listenerClass(self.app, self.port, self.timeout, self.nThreads,
+                             logger=self.logger, debug=self.debug, **self.options)
 
 
 class WSGISSLListener(network.ThreadedSSLListener):
+    """
+    Threaded WSGI server for TLS connections. Offers HTTP/2 through ALPN
+    unless the http2 option is turned off.
+    """
+
+    alpnProtocols = ["h2", "http/1.1"]
 
-    def __init__(self, certFile, keyFile, sslVersion, app, port, timeout = None, nThreads = None, logger=DummyLogger(), debug=None):
-        self.handler = WSGIHandlerDispatcher(app, port, debug, logger)
-        network.ThreadedSSLListener.__init__(self, certFile, keyFile, sslVersion, port, self.handler, timeout, nThreads)
+    def __init__(self, certFile, keyFile, sslVersion, app, port, timeout = None, nThreads = None, logger=DummyLogger(), debug=None,
+                 handshakeTimeout = 10.0, minThreads = None, maxQueue = None, maxWait = None, **options):
+        if not options.get("http2", True):
+            self.alpnProtocols = ["http/1.1"]
+        self.handler = WSGIHandlerDispatcher(app, port, debug, logger, **options)
+        network.ThreadedSSLListener.__init__(self, certFile, keyFile, sslVersion, port, self.handler, timeout, nThreads,
+                                             handshakeTimeout, minThreads, maxQueue, maxWait)
 